@@ -0,0 +1,274 @@
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <strings.h>
+#include <math.h>
+#include <cjson/cJSON.h>
+#include "alarms.h"
+
+// Level (mm) of the level sensor firmware is offset by +10, the web tier subtracts it as well
+#define LEVEL_SENSOR_OFFSET 10
+
+static const char *LEVEL_STATE_NAMES[] = {"NORMAL", "LOW", "HIGH", "FAULT"};
+static const char *RATE_STATE_NAMES[] = {"STEADY", "RISING", "FALLING"};
+
+void alarms_init(AlarmEngine *engine, double hysteresis, double rate_limit, int rate_window) {
+    memset(engine, 0, sizeof(*engine));
+    engine->hysteresis = hysteresis > 0 ? hysteresis : 0;
+    engine->rate_limit = rate_limit > 0 ? rate_limit : 0;
+    engine->rate_window_ms = (rate_window > 0 ? rate_window : 60) * 1000;
+}
+
+static AlarmParam *tank_param(TankAlarm *tank, const char *name) {
+    if (strcmp(name, "LEVEL_IN_MM") == 0) return &tank->level;
+    if (strcmp(name, "LEVEL_FULL_MM") == 0) return &tank->full;
+    if (strcmp(name, "LEVEL_HIGH_IN_PERC_SET") == 0) return &tank->high_set;
+    if (strcmp(name, "LEVEL_LOW_IN_PERC_SET") == 0) return &tank->low_set;
+    if (strcmp(name, "CAP_PF") == 0) return &tank->cap;
+    if (strcmp(name, "FREQUENCY") == 0) return &tank->frequency;
+    return NULL;
+}
+
+static int tank_complete(const TankAlarm *tank) {
+    return tank->level.mapped && tank->full.mapped && tank->high_set.mapped && tank->low_set.mapped;
+}
+
+static TankAlarm *find_tank(TankAlarm *tanks, int count, int slaveid, int channel) {
+    for (int i = 0; i < count; i++)
+        if (tanks[i].slaveid == slaveid && tanks[i].channel == channel) return &tanks[i];
+    return NULL;
+}
+
+static void delete_state(redisContext *redis, const TankAlarm *tank) {
+    redisReply *reply = redisCommand(redis, "HDEL %s %d:%d", ALARM_STATE_KEY, tank->slaveid, tank->channel);
+    if (reply) freeReplyObject(reply);
+}
+
+// (Re)compile the level sensor channels of every device. Channels that exist before and after
+// keep their alarm state, the stored state of removed ones is deleted. Returns 0, -1 on error
+int alarms_load(AlarmEngine *engine, sqlite3 *db, redisContext *redis) {
+    sqlite3_stmt *stmt;
+    const char *sql =
+        "SELECT d.slaveid, d.devicename, m.parameter_name, m.register_address, m.register_count, "
+        "m.data_type, m.decimal_shift "
+        "FROM iotdevices d JOIN sensor_data_register_mapping m ON d.devices_type_id = m.devices_type_id "
+        "WHERE m.parameter_name IN ('LEVEL_IN_MM', 'LEVEL_FULL_MM', 'LEVEL_HIGH_IN_PERC_SET', "
+        "'LEVEL_LOW_IN_PERC_SET', 'CAP_PF', 'FREQUENCY') "
+        "ORDER BY d.slaveid, m.mapid";
+    if (sqlite3_prepare_v2(db, sql, -1, &stmt, NULL) != SQLITE_OK) return -1;
+
+    TankAlarm *tanks = NULL;
+    int count = 0;
+    int device_start = 0;     // first channel of the current device in tanks
+    int rc = 0;
+    while (sqlite3_step(stmt) == SQLITE_ROW) {
+        int slaveid = sqlite3_column_int(stmt, 0);
+        const char *name = (const char *)sqlite3_column_text(stmt, 2);
+        if (count == 0 || tanks[count - 1].slaveid != slaveid) device_start = count;
+
+        // a parameter name seen again on the device belongs to its next channel
+        int channel = 0;
+        AlarmParam *param = NULL;
+        for (;; channel++) {
+            TankAlarm *tank = find_tank(tanks + device_start, count - device_start, slaveid, channel);
+            if (!tank) {
+                TankAlarm *grown = realloc(tanks, (count + 1) * sizeof(TankAlarm));
+                if (!grown) {
+                    rc = -1;
+                    break;
+                }
+                tanks = grown;
+                tank = &tanks[count++];
+                memset(tank, 0, sizeof(*tank));
+                tank->slaveid = slaveid;
+                tank->channel = channel;
+                const unsigned char *devicename = sqlite3_column_text(stmt, 1);
+                snprintf(tank->devicename, sizeof(tank->devicename), "%s", devicename ? (const char *)devicename : "");
+            }
+            param = tank_param(tank, name ? name : "");
+            if (!param || !param->mapped) break;
+        }
+        if (rc != 0) break;
+        if (!param) continue;
+
+        const char *data_type = (const char *)sqlite3_column_text(stmt, 5);
+        param->mapped = 1;
+        param->address = sqlite3_column_int(stmt, 3);
+        param->count = sqlite3_column_int(stmt, 4) > 1 ? 2 : 1;
+        param->is_signed = !(data_type && strncasecmp(data_type, "uint", 4) == 0);
+        param->decimal_shift = sqlite3_column_int(stmt, 6);
+    }
+    sqlite3_finalize(stmt);
+    if (rc != 0) {
+        free(tanks);
+        return rc;
+    }
+
+    // only channels with a level, a full level and both set points are evaluated
+    int n = 0;
+    for (int i = 0; i < count; i++) {
+        if (!tank_complete(&tanks[i])) continue;
+        TankAlarm *old = find_tank(engine->tanks, engine->tank_count, tanks[i].slaveid, tanks[i].channel);
+        if (old) {
+            tanks[i].evaluated = old->evaluated;
+            tanks[i].level_state = old->level_state;
+            tanks[i].rate_state = old->rate_state;
+            memcpy(tanks[i].samples, old->samples, sizeof(old->samples));
+            memcpy(tanks[i].sample_ms, old->sample_ms, sizeof(old->sample_ms));
+            tanks[i].sample_count = old->sample_count;
+            tanks[i].sample_next = old->sample_next;
+        }
+        tanks[n++] = tanks[i];
+    }
+    for (int i = 0; redis && i < engine->tank_count; i++)
+        if (!find_tank(tanks, n, engine->tanks[i].slaveid, engine->tanks[i].channel))
+            delete_state(redis, &engine->tanks[i]);
+
+    free(engine->tanks);
+    engine->tanks = tanks;
+    engine->tank_count = n;
+    printf("Alarm engine watching %d level sensor channel(s)\n", n);
+    return 0;
+}
+
+static double param_value(const AlarmParam *p, const uint16_t *values) {
+    const uint16_t *regs = values + p->address;
+    double value;
+    if (p->count > 1) {
+        uint32_t raw = (uint32_t)regs[1] << 16 | regs[0];
+        value = p->is_signed ? (double)(int32_t)raw : (double)raw;
+    } else {
+        value = p->is_signed ? (double)(int16_t)regs[0] : (double)regs[0];
+    }
+    for (int k = 0; k < p->decimal_shift; k++) value /= 10;
+    return value;
+}
+
+static int param_in_block(const AlarmParam *p, int count) {
+    return !p->mapped || (p->address >= 0 && p->address + p->count <= count);
+}
+
+static LevelState next_level_state(const AlarmEngine *engine, LevelState state, double pct, double high, double low) {
+    if (pct >= high) return LEVEL_HIGH;
+    if (pct <= low) return LEVEL_LOW;
+    // an active alarm clears once the level is hysteresis points back inside the band
+    if (state == LEVEL_HIGH && pct > high - engine->hysteresis) return LEVEL_HIGH;
+    if (state == LEVEL_LOW && pct < low + engine->hysteresis) return LEVEL_LOW;
+    return LEVEL_NORMAL;
+}
+
+// Level change in percent per minute against the oldest sample inside the rate window,
+// NAN until the samples span a quarter of the window
+static double level_rate(const AlarmEngine *engine, TankAlarm *tank, double pct, uint64_t now_ms) {
+    int newest = (tank->sample_next + ALARM_RATE_SAMPLES - 1) % ALARM_RATE_SAMPLES;
+    if (tank->sample_count == 0 || now_ms - tank->sample_ms[newest] >= (uint64_t)engine->rate_window_ms / ALARM_RATE_SAMPLES) {
+        tank->samples[tank->sample_next] = pct;
+        tank->sample_ms[tank->sample_next] = now_ms;
+        tank->sample_next = (tank->sample_next + 1) % ALARM_RATE_SAMPLES;
+        if (tank->sample_count < ALARM_RATE_SAMPLES) tank->sample_count++;
+    }
+
+    int oldest = -1;
+    for (int k = 0; k < tank->sample_count; k++) {
+        int i = (tank->sample_next + ALARM_RATE_SAMPLES - tank->sample_count + k) % ALARM_RATE_SAMPLES;
+        if (now_ms - tank->sample_ms[i] <= (uint64_t)engine->rate_window_ms) {
+            oldest = i;
+            break;
+        }
+    }
+    if (oldest < 0 || now_ms - tank->sample_ms[oldest] < (uint64_t)engine->rate_window_ms / 4) return NAN;
+    return (pct - tank->samples[oldest]) * 60000.0 / (double)(now_ms - tank->sample_ms[oldest]);
+}
+
+static RateState next_rate_state(const AlarmEngine *engine, RateState state, double rate) {
+    if (engine->rate_limit <= 0 || isnan(rate)) return RATE_STEADY;
+    if (rate >= engine->rate_limit) return RATE_RISING;
+    if (-rate >= engine->rate_limit) return RATE_FALLING;
+    // cleared once the rate dropped below half the limit
+    if (state == RATE_RISING && rate >= engine->rate_limit / 2) return RATE_RISING;
+    if (state == RATE_FALLING && -rate >= engine->rate_limit / 2) return RATE_FALLING;
+    return RATE_STEADY;
+}
+
+// State document of a tank, stored in ALARM_STATE_KEY and published on every transition
+static char *state_json(const TankAlarm *tank, const TankAlarm *previous, double pct, double rate, uint64_t ts_ms) {
+    cJSON *doc = cJSON_CreateObject();
+    cJSON_AddNumberToObject(doc, "slaveid", tank->slaveid);
+    cJSON_AddNumberToObject(doc, "channel", tank->channel);
+    cJSON_AddStringToObject(doc, "device", tank->devicename);
+    cJSON_AddStringToObject(doc, "alarm", LEVEL_STATE_NAMES[tank->level_state]);
+    cJSON_AddStringToObject(doc, "rate", RATE_STATE_NAMES[tank->rate_state]);
+    if (previous) {
+        cJSON_AddStringToObject(doc, "previous", LEVEL_STATE_NAMES[previous->level_state]);
+        cJSON_AddStringToObject(doc, "previousRate", RATE_STATE_NAMES[previous->rate_state]);
+    }
+    if (tank->level_state != LEVEL_FAULT) cJSON_AddNumberToObject(doc, "levelPct", round(pct * 10) / 10);
+    if (!isnan(rate)) cJSON_AddNumberToObject(doc, "ratePctPerMin", round(rate * 100) / 100);
+    cJSON_AddNumberToObject(doc, "ts", (double)ts_ms);
+    char *json = cJSON_PrintUnformatted(doc);
+    cJSON_Delete(doc);
+    return json;
+}
+
+// Evaluate the channels of a device after a complete poll. Transitions are appended to the
+// pipeline: the state hash, a PUBLISH and the capped log. now_ms is monotonic and times the rate
+// of change, ts_ms is the wall clock time reported. Returns the number of commands appended
+int alarms_evaluate(AlarmEngine *engine, redisContext *redis, int slaveid, const uint16_t *values, int count,
+                    uint64_t now_ms, uint64_t ts_ms) {
+    int pending = 0;
+    for (int i = 0; i < engine->tank_count; i++) {
+        TankAlarm *tank = &engine->tanks[i];
+        if (tank->slaveid != slaveid) continue;
+        if (!param_in_block(&tank->level, count) || !param_in_block(&tank->full, count) ||
+            !param_in_block(&tank->high_set, count) || !param_in_block(&tank->low_set, count) ||
+            !param_in_block(&tank->cap, count) || !param_in_block(&tank->frequency, count)) continue;
+
+        double full = param_value(&tank->full, values);
+        int fault = full <= 0 ||
+                    (tank->cap.mapped && param_value(&tank->cap, values) <= 0) ||
+                    (tank->frequency.mapped && param_value(&tank->frequency, values) <= 0);
+        double pct = 0, rate = NAN;
+        LevelState level_state = LEVEL_FAULT;
+        RateState rate_state = RATE_STEADY;
+        if (!fault) {
+            pct = (param_value(&tank->level, values) - LEVEL_SENSOR_OFFSET) * 100 / full;
+            level_state = next_level_state(engine, tank->level_state, pct,
+                                           param_value(&tank->high_set, values), param_value(&tank->low_set, values));
+            rate = level_rate(engine, tank, pct, now_ms);
+            rate_state = next_rate_state(engine, tank->rate_state, rate);
+        } else {
+            tank->sample_count = 0;
+        }
+
+        int changed = level_state != tank->level_state || rate_state != tank->rate_state;
+        if (tank->evaluated && !changed) continue;
+        // after a start only an active alarm is announced, a normal tank just gets its state stored
+        int announce = tank->evaluated || level_state != LEVEL_NORMAL || rate_state != RATE_STEADY;
+        TankAlarm previous = *tank;
+        tank->level_state = level_state;
+        tank->rate_state = rate_state;
+        tank->evaluated = 1;
+
+        char *json = state_json(tank, previous.evaluated ? &previous : NULL, pct, rate, ts_ms);
+        if (!json) continue;
+        if (redisAppendCommand(redis, "HSET %s %d:%d %s", ALARM_STATE_KEY, tank->slaveid, tank->channel, json) == REDIS_OK)
+            pending++;
+        if (announce) {
+            if (redisAppendCommand(redis, "PUBLISH %s %s", ALARM_CHANNEL, json) == REDIS_OK) pending++;
+            if (redisAppendCommand(redis, "LPUSH %s %s", ALARM_LOG_KEY, json) == REDIS_OK) pending++;
+            if (redisAppendCommand(redis, "LTRIM %s 0 %d", ALARM_LOG_KEY, ALARM_LOG_LENGTH - 1) == REDIS_OK) pending++;
+            printf("Alarm: slave %d channel %d %s %s", tank->slaveid, tank->channel,
+                   LEVEL_STATE_NAMES[level_state], RATE_STATE_NAMES[rate_state]);
+            if (!fault) printf(", level %.1f%%", pct);
+            printf("\n");
+        }
+        cJSON_free(json);
+    }
+    return pending;
+}
+
+void alarms_free(AlarmEngine *engine) {
+    free(engine->tanks);
+    engine->tanks = NULL;
+    engine->tank_count = 0;
+}
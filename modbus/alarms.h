@@ -0,0 +1,70 @@
+#ifndef ALARMS_H
+#define ALARMS_H
+
+#include <stdint.h>
+#include <sqlite3.h>
+#include <hiredis/hiredis.h>
+
+#define ALARM_CHANNEL "modbus:alarms"          // every transition is PUBLISHed here as JSON
+#define ALARM_STATE_KEY "modbus:alarm_state"   // hash "<slaveid>:<channel>" -> current state JSON
+#define ALARM_LOG_KEY "modbus:alarm_log"       // newest first, capped at ALARM_LOG_LENGTH
+#define ALARM_LOG_LENGTH 1000
+#define ALARM_RATE_SAMPLES 16                  // level samples spread over the rate window
+
+typedef enum {
+    LEVEL_NORMAL,
+    LEVEL_LOW,
+    LEVEL_HIGH,
+    LEVEL_FAULT           // sensor head disconnected, oscillator stopped or no full level set
+} LevelState;
+
+typedef enum {
+    RATE_STEADY,
+    RATE_RISING,
+    RATE_FALLING
+} RateState;
+
+// A mapped parameter of a level sensor channel, located in the device register block
+typedef struct {
+    int mapped;
+    int address;          // index into the device register block
+    int count;
+    int is_signed;
+    int decimal_shift;
+} AlarmParam;
+
+// One level sensor channel (a tank), compiled from sensor_data_register_mapping
+typedef struct {
+    int slaveid;
+    int channel;          // nth occurrence of the parameter names, as in the web tier
+    char devicename[64];
+    AlarmParam level;     // LEVEL_IN_MM
+    AlarmParam full;      // LEVEL_FULL_MM
+    AlarmParam high_set;  // LEVEL_HIGH_IN_PERC_SET
+    AlarmParam low_set;   // LEVEL_LOW_IN_PERC_SET
+    AlarmParam cap;       // CAP_PF, optional
+    AlarmParam frequency; // FREQUENCY, optional
+    int evaluated;        // a state has been stored since the poller started
+    LevelState level_state;
+    RateState rate_state;
+    double samples[ALARM_RATE_SAMPLES];       // level percentage
+    uint64_t sample_ms[ALARM_RATE_SAMPLES];
+    int sample_count;
+    int sample_next;
+} TankAlarm;
+
+typedef struct {
+    TankAlarm *tanks;
+    int tank_count;
+    double hysteresis;    // percentage points an alarm level has to be left by before it clears
+    double rate_limit;    // percent per minute, 0 disables the rate of change alarm
+    int rate_window_ms;
+} AlarmEngine;
+
+void alarms_init(AlarmEngine *engine, double hysteresis, double rate_limit, int rate_window);
+int alarms_load(AlarmEngine *engine, sqlite3 *db, redisContext *redis);
+int alarms_evaluate(AlarmEngine *engine, redisContext *redis, int slaveid, const uint16_t *values, int count,
+                    uint64_t now_ms, uint64_t ts_ms);
+void alarms_free(AlarmEngine *engine);
+
+#endif
@@ -3,12 +3,37 @@
 #include <stdlib.h>
 #include "config.h"
 
-int load_config(const char *filename, Config *cfg) {
+// [modbus] configures bus 0, [busN] bus N; other sections configure no bus
+static int parse_section(const char *line) {
+    int bus;
+    if (strncmp(line, "[modbus]", 8) == 0) return 0;
+    if (sscanf(line, "[bus%d]", &bus) == 1 && bus > 0 && bus < MAX_BUSES) return bus;
+    return -1;
+}
+
+// Settings of filename on top of those already in cfg. Returns 0, -1 if it cannot be read
+int load_config_overlay(const char *filename, Config *cfg) {
     FILE *fp = fopen(filename, "r");
     if (!fp) return -1;
 
     char line[256];
+    BusConfig *bus = NULL;
     while (fgets(line, sizeof(line), fp)) {
+        char *start = line + strspn(line, " \t");
+        if (*start == '[') {
+            int index = parse_section(start);
+            bus = index >= 0 ? &cfg->buses[index] : NULL;
+            if (bus && !bus->configured) {
+                bus->configured = 1;
+                bus->baudrate = 9600;
+                bus->parity = 'N';
+                bus->data_bits = 8;
+                bus->stop_bits = 1;
+                bus->port = 502;
+            }
+            continue;
+        }
+
         char *eq = strchr(line, '=');
         if (!eq) continue;
 
@@ -22,18 +47,28 @@ int load_config(const char *filename, Config *cfg) {
 
         if (!key || !value) continue;
 
-        if (strcmp(key, "device") == 0) {
-            strncpy(cfg->device, value, sizeof(cfg->device));
-        } else if (strcmp(key, "baudrate") == 0) {
-            cfg->baudrate = atoi(value);
-        } else if (strcmp(key, "parity") == 0) {
-            cfg->parity = value[0];
-        } else if (strcmp(key, "data_bits") == 0) {
-            cfg->data_bits = atoi(value);
-        } else if (strcmp(key, "stop_bits") == 0) {
-            cfg->stop_bits = atoi(value);
+        if (bus && strcmp(key, "type") == 0) {
+            bus->type = strcmp(value, "tcp") == 0 ? BUS_TCP : BUS_RTU;
+        } else if (bus && strcmp(key, "device") == 0) {
+            strncpy(bus->device, value, sizeof(bus->device) - 1);
+        } else if (bus && strcmp(key, "baudrate") == 0) {
+            bus->baudrate = atoi(value);
+        } else if (bus && strcmp(key, "parity") == 0) {
+            bus->parity = value[0];
+        } else if (bus && strcmp(key, "data_bits") == 0) {
+            bus->data_bits = atoi(value);
+        } else if (bus && strcmp(key, "stop_bits") == 0) {
+            bus->stop_bits = atoi(value);
+        } else if (bus && strcmp(key, "host") == 0) {
+            strncpy(bus->host, value, sizeof(bus->host) - 1);
+        } else if (bus && strcmp(key, "port") == 0) {
+            bus->port = atoi(value);
         } else if (strcmp(key, "poll_interval") == 0) {
             cfg->poll_interval = atoi(value);
+        } else if (strcmp(key, "log_interval") == 0) {
+            cfg->log_interval = atoi(value);
+        } else if (strcmp(key, "history_days") == 0) {
+            cfg->history_days = atoi(value);
         } else if (strcmp(key, "db_path") == 0) {
             strncpy(cfg->db_path, value, sizeof(cfg->db_path));
         } else if (strcmp(key, "redis_host") == 0) {
@@ -42,9 +77,26 @@ int load_config(const char *filename, Config *cfg) {
             cfg->redis_port = atoi(value);
         } else if (strcmp(key, "redis_ttl") == 0) {
             cfg->redis_ttl = atoi(value);
+        } else if (strcmp(key, "keyframe_interval") == 0) {
+            cfg->keyframe_interval = atoi(value);
+        } else if (strcmp(key, "register_store") == 0) {
+            strncpy(cfg->register_store, value, sizeof(cfg->register_store) - 1);
+        } else if (strcmp(key, "hysteresis") == 0) {
+            cfg->alarm_hysteresis = atof(value);
+        } else if (strcmp(key, "rate_limit") == 0) {
+            cfg->alarm_rate_limit = atof(value);
+        } else if (strcmp(key, "rate_window") == 0) {
+            cfg->alarm_rate_window = atoi(value);
+        } else if (strcmp(key, "debug") == 0) {
+            cfg->debug = atoi(value);
         }
     }
 
     fclose(fp);
     return 0;
 }
+
+int load_config(const char *filename, Config *cfg) {
+    memset(cfg, 0, sizeof(*cfg));
+    return load_config_overlay(filename, cfg);
+}
@@ -1,20 +1,44 @@
 #ifndef CONFIG_H
 #define CONFIG_H
 
+#define MAX_BUSES 8     // [modbus] is bus 0, [bus1] .. [bus7] the others
+
+typedef enum {
+    BUS_RTU,
+    BUS_TCP
+} BusType;
+
+// One RS-485 line or Modbus TCP gateway, polled by its own worker thread
 typedef struct {
-    char device[64];
+    int configured;
+    BusType type;
+    char device[64];      // rtu: serial port
     int baudrate;
     char parity;
     int data_bits;
     int stop_bits;
+    char host[64];        // tcp: gateway address
+    int port;
+} BusConfig;
+
+typedef struct {
+    BusConfig buses[MAX_BUSES];
     char redis_host[64];
     int redis_port;
     char db_path[128];
     int poll_interval;
     int log_interval;
+    int history_days;
 	int redis_ttl;
+    int keyframe_interval;
+    char register_store[16];
+    double alarm_hysteresis;
+    double alarm_rate_limit;
+    int alarm_rate_window;
+    int debug;
 } Config;
 
 int load_config(const char *filename, Config *cfg);
+int load_config_overlay(const char *filename, Config *cfg);
 
 #endif
@@ -1,6 +1,7 @@
 BEGIN TRANSACTION;
 
 DROP TABLE IF EXISTS iotdata;
+DROP TABLE IF EXISTS iotdata_rollup;
 DROP TABLE IF EXISTS iotdevices;
 DROP TABLE IF EXISTS iot_devices_types;
 DROP TABLE IF EXISTS sensor_data_register_mapping;
@@ -10,8 +11,23 @@ CREATE TABLE IF NOT EXISTS "iotdata" (
 	"ts"	TEXT DEFAULT NULL,
 	"slaveid"	INTEGER,
 	"iotdata"	TEXT,
+	"channel"	INTEGER NOT NULL DEFAULT 0,
 	PRIMARY KEY("id" AUTOINCREMENT)
 );
+CREATE INDEX IF NOT EXISTS "idx_iotdata_slaveid_channel_ts" ON "iotdata" ("slaveid", "channel", "ts");
+
+CREATE TABLE IF NOT EXISTS "iotdata_rollup" (
+	"period"	INTEGER NOT NULL,
+	"bucket"	INTEGER NOT NULL,
+	"slaveid"	INTEGER NOT NULL,
+	"channel"	INTEGER NOT NULL DEFAULT 0,
+	"parameter_name"	TEXT NOT NULL,
+	"min_value"	REAL,
+	"max_value"	REAL,
+	"sum_value"	REAL,
+	"samples"	INTEGER,
+	PRIMARY KEY("period","slaveid","channel","parameter_name","bucket")
+) WITHOUT ROWID;
 
 CREATE TABLE IF NOT EXISTS "iot_devices_types" (
 	"devices_type_id"	INTEGER NOT NULL,
@@ -26,6 +42,7 @@ CREATE TABLE IF NOT EXISTS "iotdevices" (
 	"devices_type_id"	INTEGER,
 	"devicename"	TEXT NOT NULL,	
 	"location"	TEXT,	
+	"bus"	INTEGER NOT NULL DEFAULT 0,
 	PRIMARY KEY("slaveid")
 );
 CREATE TABLE IF NOT EXISTS "sensor_data_register_mapping" (
@@ -38,6 +55,7 @@ CREATE TABLE IF NOT EXISTS "sensor_data_register_mapping" (
 	"decimal_shift"	INTEGER NOT NULL,
 	"unit"	TEXT,
 	"log_to_db"	TEXT DEFAULT 'N' CHECK(UPPER("log_to_db") IN ('Y', 'YES', 'N', 'NO')),
+	"deadband"	REAL NOT NULL DEFAULT 0,
 	PRIMARY KEY("mapid" AUTOINCREMENT)
 );
 INSERT INTO "iotdata" ("id","ts","slaveid","iotdata") VALUES (1,'2025-11-05 18:25:01',1,'{ "Wind Speed": { "value": 1450.0, "unit": "m/s" }, "Wind Level": { "value": 25.0, "unit": "none" } }');
@@ -0,0 +1,316 @@
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <strings.h>
+#include <cjson/cJSON.h>
+#include "historian.h"
+#include "util.h"
+
+// Rollup buckets kept next to the raw iotdata rows: 1 minute and 1 hour min/max/avg
+static const int ROLLUP_PERIODS[] = {60, 3600};
+#define ROLLUP_PERIOD_COUNT (int)(sizeof(ROLLUP_PERIODS) / sizeof(ROLLUP_PERIODS[0]))
+
+static const char *SCHEMA_SQL =
+    "DROP INDEX IF EXISTS idx_iotdata_slaveid_ts;"
+    "CREATE INDEX IF NOT EXISTS idx_iotdata_slaveid_channel_ts ON iotdata (slaveid, channel, ts);"
+    "CREATE TABLE IF NOT EXISTS iotdata_rollup ("
+    "  period INTEGER NOT NULL,"         // bucket length in seconds
+    "  bucket INTEGER NOT NULL,"         // unix time of the bucket start
+    "  slaveid INTEGER NOT NULL,"
+    "  channel INTEGER NOT NULL DEFAULT 0,"
+    "  parameter_name TEXT NOT NULL,"
+    "  min_value REAL,"
+    "  max_value REAL,"
+    "  sum_value REAL,"
+    "  samples INTEGER,"
+    "  PRIMARY KEY (period, slaveid, channel, parameter_name, bucket)"
+    ") WITHOUT ROWID;";
+
+// Rollups written before the channel column existed are moved to channel 0. Those of
+// multi-channel devices mixed every channel and cannot be split after the fact
+static const char *MIGRATE_ROLLUP_SQL =
+    "ALTER TABLE iotdata_rollup RENAME TO iotdata_rollup_unchanneled;";
+static const char *MIGRATE_ROLLUP_COPY_SQL =
+    "INSERT INTO iotdata_rollup (period, bucket, slaveid, channel, parameter_name, min_value, max_value, sum_value, samples) "
+    "SELECT period, bucket, slaveid, 0, parameter_name, min_value, max_value, sum_value, samples "
+    "FROM iotdata_rollup_unchanneled;"
+    "DROP TABLE iotdata_rollup_unchanneled;";
+
+// Raw rows and rollups are stored per sensor channel; older databases get the channel column
+static int migrate_schema(sqlite3 *db) {
+    char *err = NULL;
+    int rc = SQLITE_OK;
+    if (!has_column(db, "iotdata", "channel"))
+        rc = sqlite3_exec(db, "ALTER TABLE iotdata ADD COLUMN channel INTEGER NOT NULL DEFAULT 0", NULL, NULL, &err);
+    int rebuild = rc == SQLITE_OK && table_exists(db, "iotdata_rollup") && !has_column(db, "iotdata_rollup", "channel");
+    if (rebuild) {
+        rc = sqlite3_exec(db, "BEGIN IMMEDIATE", NULL, NULL, &err);
+        if (rc == SQLITE_OK) rc = sqlite3_exec(db, MIGRATE_ROLLUP_SQL, NULL, NULL, &err);
+    }
+    if (rc == SQLITE_OK) rc = sqlite3_exec(db, SCHEMA_SQL, NULL, NULL, &err);
+    if (rebuild && rc == SQLITE_OK) rc = sqlite3_exec(db, MIGRATE_ROLLUP_COPY_SQL, NULL, NULL, &err);
+    if (rebuild) sqlite3_exec(db, rc == SQLITE_OK ? "COMMIT" : "ROLLBACK", NULL, NULL, NULL);
+    if (rc != SQLITE_OK) {
+        fprintf(stderr, "Historian schema error: %s\n", err ? err : sqlite3_errmsg(db));
+        sqlite3_free(err);
+        return -1;
+    }
+    return 0;
+}
+
+static HistoryType parse_history_type(const char *data_type, int count) {
+    if (data_type && strcasecmp(data_type, "hex") == 0) return HISTORY_HEX;
+    if (data_type && strncasecmp(data_type, "uint", 4) == 0) return count > 1 ? HISTORY_UINT32 : HISTORY_UINT16;
+    return count > 1 ? HISTORY_INT32 : HISTORY_INT16;
+}
+
+// The mappings are loaded into new arrays and swapped in on success, a device keeps the time
+// of its last sample across reloads. A parameter name repeated within a device type belongs
+// to the next sensor channel
+static int load_history_params(Historian *h) {
+    sqlite3_stmt *stmt;
+    const char *sql =
+        "SELECT d.slaveid, m.parameter_name, IFNULL(m.unit, ''), m.register_address, m.register_count, "
+        "m.data_type, m.decimal_shift, "
+        "(SELECT COUNT(*) FROM sensor_data_register_mapping e WHERE e.devices_type_id = m.devices_type_id "
+        " AND e.parameter_name = m.parameter_name AND e.mapid < m.mapid) AS channel "
+        "FROM iotdevices d JOIN sensor_data_register_mapping m ON d.devices_type_id = m.devices_type_id "
+        "WHERE UPPER(m.log_to_db) IN ('Y', 'YES') ORDER BY d.slaveid, channel, m.register_address";
+    if (sqlite3_prepare_v2(h->db, sql, -1, &stmt, NULL) != SQLITE_OK) return -1;
+
+    HistoryParam *params = NULL;
+    HistoryDevice *devices = NULL;
+    int param_count = 0, param_capacity = 0, device_count = 0, device_capacity = 0;
+    int rc = 0;
+    while (sqlite3_step(stmt) == SQLITE_ROW) {
+        int slaveid = sqlite3_column_int(stmt, 0);
+        if (device_count == 0 || devices[device_count - 1].slaveid != slaveid) {
+            if (grow_array((void **)&devices, &device_capacity, device_count, sizeof(HistoryDevice)) != 0) {
+                rc = -1;
+                break;
+            }
+            HistoryDevice *dev = &devices[device_count++];
+            dev->slaveid = slaveid;
+            dev->first_param = param_count;
+            dev->param_count = 0;
+            dev->channel_count = 0;
+            dev->last_sample = 0;
+            for (int i = 0; i < h->device_count; i++)
+                if (h->devices[i].slaveid == slaveid) dev->last_sample = h->devices[i].last_sample;
+        }
+        if (grow_array((void **)&params, &param_capacity, param_count, sizeof(HistoryParam)) != 0) {
+            rc = -1;
+            break;
+        }
+
+        HistoryParam *p = &params[param_count++];
+        const unsigned char *name = sqlite3_column_text(stmt, 1);
+        const unsigned char *unit = sqlite3_column_text(stmt, 2);
+        snprintf(p->name, sizeof(p->name), "%s", name ? (const char *)name : "");
+        snprintf(p->unit, sizeof(p->unit), "%s", unit ? (const char *)unit : "");
+        p->address = sqlite3_column_int(stmt, 3);
+        p->count = sqlite3_column_int(stmt, 4);
+        p->type = parse_history_type((const char *)sqlite3_column_text(stmt, 5), p->count);
+        p->decimal_shift = sqlite3_column_int(stmt, 6);
+        p->channel = sqlite3_column_int(stmt, 7);
+        devices[device_count - 1].param_count++;
+        if (p->channel >= devices[device_count - 1].channel_count) devices[device_count - 1].channel_count = p->channel + 1;
+    }
+    sqlite3_finalize(stmt);
+    if (rc != 0) {
+        free(params);
+        free(devices);
+        return rc;
+    }
+
+    free(h->params);
+    free(h->devices);
+    h->params = params;
+    h->param_count = param_count;
+    h->devices = devices;
+    h->device_count = device_count;
+    return 0;
+}
+
+int historian_open(Historian *h, const char *db_path, int log_interval, int retention_days) {
+    memset(h, 0, sizeof(*h));
+    h->log_interval = log_interval > 0 ? log_interval : 5;
+    h->retention_days = retention_days;
+
+    if (sqlite3_open(db_path, &h->db) != SQLITE_OK) {
+        fprintf(stderr, "Historian SQLite open error: %s\n", sqlite3_errmsg(h->db));
+        return -1;
+    }
+    // WAL lets the web tier read history while a batch is being committed. Every process that
+    // opens the database has to see the same -wal and -shm files, the containers therefore
+    // mount the database directory rather than the file
+    sqlite3_busy_timeout(h->db, 2000);
+    sqlite3_exec(h->db, "PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL;", NULL, NULL, NULL);
+
+    if (migrate_schema(h->db) != 0) return -1;
+
+    const char *insert_sql =
+        "INSERT INTO iotdata (ts, slaveid, channel, iotdata) VALUES (datetime(?, 'unixepoch'), ?, ?, ?)";
+    const char *rollup_sql =
+        "INSERT INTO iotdata_rollup (period, bucket, slaveid, channel, parameter_name, min_value, max_value, sum_value, samples) "
+        "VALUES (?1, ?2, ?3, ?4, ?5, ?6, ?6, ?6, 1) "
+        "ON CONFLICT (period, slaveid, channel, parameter_name, bucket) DO UPDATE SET "
+        "min_value = MIN(min_value, excluded.min_value), max_value = MAX(max_value, excluded.max_value), "
+        "sum_value = sum_value + excluded.sum_value, samples = samples + 1";
+    const char *prune_sql = "DELETE FROM iotdata WHERE ts < datetime(?, 'unixepoch')";
+    if (sqlite3_prepare_v2(h->db, insert_sql, -1, &h->insert_row, NULL) != SQLITE_OK ||
+        sqlite3_prepare_v2(h->db, rollup_sql, -1, &h->upsert_rollup, NULL) != SQLITE_OK ||
+        sqlite3_prepare_v2(h->db, prune_sql, -1, &h->prune_rows, NULL) != SQLITE_OK) {
+        fprintf(stderr, "Historian prepare error: %s\n", sqlite3_errmsg(h->db));
+        return -1;
+    }
+
+    if (load_history_params(h) != 0) {
+        fprintf(stderr, "Historian failed to load log_to_db mappings: %s\n", sqlite3_errmsg(h->db));
+        return -1;
+    }
+    printf("Historian logging %d parameter(s) of %d device(s)\n", h->param_count, h->device_count);
+    return 0;
+}
+
+static double decode_param(const HistoryParam *p, const uint16_t *regs) {
+    double value;
+    switch (p->type) {
+    case HISTORY_UINT16: value = regs[0]; break;
+    case HISTORY_INT32:  value = (int32_t)((uint32_t)regs[1] << 16 | regs[0]); break;
+    case HISTORY_UINT32: value = (uint32_t)regs[1] << 16 | regs[0]; break;
+    default:             value = (int16_t)regs[0]; break;
+    }
+    for (int k = 0; k < p->decimal_shift; k++) value /= 10;
+    return value;
+}
+
+// Decode the logged parameters of one device read into the pending batch, one row per
+// sensor channel, at most once per log_interval per device
+void historian_sample(Historian *h, int slaveid, const uint16_t *values, int count, time_t now) {
+    HistoryDevice *dev = NULL;
+    for (int i = 0; i < h->device_count; i++) {
+        if (h->devices[i].slaveid == slaveid) {
+            dev = &h->devices[i];
+            break;
+        }
+    }
+    if (!dev || now - dev->last_sample < h->log_interval) return;
+    if (h->row_count + dev->channel_count > HISTORY_MAX_PENDING ||
+        h->point_count + dev->param_count > HISTORY_MAX_PENDING) historian_flush(h, now);
+    // database unavailable, drop the sample
+    if (h->row_count + dev->channel_count > HISTORY_MAX_PENDING) return;
+
+    cJSON *doc = NULL;
+    int channel = -1;
+    for (int i = dev->first_param; i <= dev->first_param + dev->param_count; i++) {
+        HistoryParam *p = i < dev->first_param + dev->param_count ? &h->params[i] : NULL;
+        if (doc && (!p || p->channel != channel)) {
+            char *json = cJSON_PrintUnformatted(doc);
+            cJSON_Delete(doc);
+            doc = NULL;
+            if (json) h->rows[h->row_count++] = (HistoryRow){now, slaveid, channel, json};
+        }
+        if (!p) break;
+        if (!doc) {
+            doc = cJSON_CreateObject();
+            channel = p->channel;
+        }
+        if (p->address < 0 || p->address + p->count > count) continue;
+
+        cJSON *item = cJSON_CreateObject();
+        if (p->type == HISTORY_HEX) {
+            char hex[4 * 64 + 1] = "";
+            for (int k = 0; k < p->count && k < 64; k++) sprintf(hex + 4 * k, "%04X", values[p->address + k]);
+            cJSON_AddStringToObject(item, "value", hex);
+        } else {
+            double value = decode_param(p, values + p->address);
+            cJSON_AddNumberToObject(item, "value", value);
+            if (h->point_count < HISTORY_MAX_PENDING)
+                h->points[h->point_count++] = (HistoryPoint){now, slaveid, p->channel, p->name, value};
+        }
+        cJSON_AddStringToObject(item, "unit", p->unit[0] ? p->unit : "none");
+        cJSON_AddItemToObject(doc, p->name, item);
+    }
+    dev->last_sample = now;
+}
+
+// Write the pending batch in a single transaction. Returns 0 on success; on failure the
+// batch is kept and retried on the next flush
+int historian_flush(Historian *h, time_t now) {
+    h->last_flush = now;
+    if (h->row_count == 0) return 0;
+
+    if (sqlite3_exec(h->db, "BEGIN IMMEDIATE", NULL, NULL, NULL) != SQLITE_OK) {
+        fprintf(stderr, "Historian begin error: %s\n", sqlite3_errmsg(h->db));
+        return -1;
+    }
+
+    int rc = SQLITE_DONE;
+    for (int i = 0; i < h->row_count && rc == SQLITE_DONE; i++) {
+        sqlite3_bind_int64(h->insert_row, 1, h->rows[i].ts);
+        sqlite3_bind_int(h->insert_row, 2, h->rows[i].slaveid);
+        sqlite3_bind_int(h->insert_row, 3, h->rows[i].channel);
+        sqlite3_bind_text(h->insert_row, 4, h->rows[i].json, -1, SQLITE_STATIC);
+        rc = sqlite3_step(h->insert_row);
+        sqlite3_reset(h->insert_row);
+    }
+    for (int i = 0; i < h->point_count && rc == SQLITE_DONE; i++) {
+        HistoryPoint *pt = &h->points[i];
+        for (int k = 0; k < ROLLUP_PERIOD_COUNT && rc == SQLITE_DONE; k++) {
+            sqlite3_bind_int(h->upsert_rollup, 1, ROLLUP_PERIODS[k]);
+            sqlite3_bind_int64(h->upsert_rollup, 2, pt->ts - pt->ts % ROLLUP_PERIODS[k]);
+            sqlite3_bind_int(h->upsert_rollup, 3, pt->slaveid);
+            sqlite3_bind_int(h->upsert_rollup, 4, pt->channel);
+            sqlite3_bind_text(h->upsert_rollup, 5, pt->name, -1, SQLITE_STATIC);
+            sqlite3_bind_double(h->upsert_rollup, 6, pt->value);
+            rc = sqlite3_step(h->upsert_rollup);
+            sqlite3_reset(h->upsert_rollup);
+        }
+    }
+
+    if (rc != SQLITE_DONE || sqlite3_exec(h->db, "COMMIT", NULL, NULL, NULL) != SQLITE_OK) {
+        fprintf(stderr, "Historian write error: %s\n", sqlite3_errmsg(h->db));
+        sqlite3_exec(h->db, "ROLLBACK", NULL, NULL, NULL);
+        return -1;
+    }
+
+    for (int i = 0; i < h->row_count; i++) cJSON_free(h->rows[i].json);
+    h->row_count = 0;
+    h->point_count = 0;
+    return 0;
+}
+
+// Pick up changed log_to_db mappings. Pending rollup points point at the current parameter
+// names, so the batch is flushed first and its points dropped if that fails
+int historian_reload(Historian *h, time_t now) {
+    if (historian_flush(h, now) != 0) h->point_count = 0;
+    if (load_history_params(h) != 0) {
+        fprintf(stderr, "Historian failed to reload log_to_db mappings: %s\n", sqlite3_errmsg(h->db));
+        return -1;
+    }
+    printf("Historian logging %d parameter(s) of %d device(s)\n", h->param_count, h->device_count);
+    return 0;
+}
+
+// Called from the poll loop: flushes every HISTORY_FLUSH_INTERVAL and prunes hourly
+void historian_tick(Historian *h, time_t now) {
+    if (now - h->last_flush >= HISTORY_FLUSH_INTERVAL) historian_flush(h, now);
+
+    if (h->retention_days > 0 && now - h->last_prune >= 3600) {
+        h->last_prune = now;
+        sqlite3_bind_int64(h->prune_rows, 1, now - (time_t)h->retention_days * 86400);
+        sqlite3_step(h->prune_rows);
+        sqlite3_reset(h->prune_rows);
+    }
+}
+
+void historian_close(Historian *h) {
+    historian_flush(h, time(NULL));
+    sqlite3_finalize(h->insert_row);
+    sqlite3_finalize(h->upsert_rollup);
+    sqlite3_finalize(h->prune_rows);
+    sqlite3_close(h->db);
+    free(h->params);
+    free(h->devices);
+}
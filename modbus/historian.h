@@ -0,0 +1,79 @@
+#ifndef HISTORIAN_H
+#define HISTORIAN_H
+
+#include <stdint.h>
+#include <time.h>
+#include <sqlite3.h>
+
+#define HISTORY_MAX_PENDING 4096     // buffered samples before a flush is forced
+#define HISTORY_FLUSH_INTERVAL 30    // seconds between batched transactions
+
+typedef enum {
+    HISTORY_INT16,
+    HISTORY_UINT16,
+    HISTORY_INT32,
+    HISTORY_UINT32,
+    HISTORY_HEX
+} HistoryType;
+
+// A sensor_data_register_mapping row with log_to_db = 'Y'/'YES' for one device
+typedef struct {
+    char name[64];
+    char unit[16];
+    int channel;          // nth occurrence of the name in the device type, as in the web tier
+    int address;          // index into the device register block
+    int count;
+    HistoryType type;
+    int decimal_shift;
+} HistoryParam;
+
+typedef struct {
+    int slaveid;
+    int first_param;      // params of a device are ordered by channel
+    int param_count;
+    int channel_count;
+    time_t last_sample;
+} HistoryDevice;
+
+typedef struct {
+    time_t ts;
+    int slaveid;
+    int channel;
+    char *json;           // iotdata.iotdata document of one channel, owned
+} HistoryRow;
+
+typedef struct {
+    time_t ts;
+    int slaveid;
+    int channel;
+    const char *name;     // points into params
+    double value;
+} HistoryPoint;
+
+typedef struct {
+    sqlite3 *db;          // own connection, the poller's handle stays free
+    sqlite3_stmt *insert_row;
+    sqlite3_stmt *upsert_rollup;
+    sqlite3_stmt *prune_rows;
+    HistoryParam *params;     // reloaded by historian_reload()
+    int param_count;
+    HistoryDevice *devices;
+    int device_count;
+    HistoryRow rows[HISTORY_MAX_PENDING];
+    int row_count;
+    HistoryPoint points[HISTORY_MAX_PENDING];
+    int point_count;
+    int log_interval;     // seconds between samples of one device
+    int retention_days;   // raw iotdata rows older than this are pruned, rollups are kept
+    time_t last_flush;
+    time_t last_prune;
+} Historian;
+
+int historian_open(Historian *h, const char *db_path, int log_interval, int retention_days);
+void historian_sample(Historian *h, int slaveid, const uint16_t *values, int count, time_t now);
+int historian_flush(Historian *h, time_t now);
+void historian_tick(Historian *h, time_t now);
+int historian_reload(Historian *h, time_t now);
+void historian_close(Historian *h);
+
+#endif
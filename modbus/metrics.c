@@ -0,0 +1,62 @@
+#include <stdio.h>
+#include "metrics.h"
+
+const int METRICS_BUCKETS_MS[METRICS_BUCKET_COUNT] = {5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000};
+
+void histogram_observe(Histogram *h, uint64_t ms) {
+    h->count++;
+    h->sum_ms += ms;
+    for (int i = 0; i < METRICS_BUCKET_COUNT; i++)
+        if (ms <= (uint64_t)METRICS_BUCKETS_MS[i]) h->buckets[i]++;
+}
+
+static void stats_push(StatsHash *s, const char *text) {
+    if (s->argc == (int)(sizeof(s->argv) / sizeof(s->argv[0]))) return;
+    size_t room = sizeof(s->buf) - s->used;
+    int len = snprintf(s->buf + s->used, room, "%s", text);
+    if (len < 0 || (size_t)len >= room) return;
+    s->argv[s->argc] = s->buf + s->used;
+    s->argvlen[s->argc++] = len;
+    s->used += len + 1;
+}
+
+void stats_begin(StatsHash *s, const char *key_fmt, int id) {
+    char key[64];
+    s->argc = 0;
+    s->used = 0;
+    snprintf(key, sizeof(key), key_fmt, id);
+    stats_push(s, "HSET");
+    stats_push(s, key);
+}
+
+void stats_add(StatsHash *s, const char *field, uint64_t value) {
+    char text[24];
+    snprintf(text, sizeof(text), "%llu", (unsigned long long)value);
+    int argc = s->argc;
+    size_t used = s->used;
+    stats_push(s, field);
+    stats_push(s, text);
+    if (s->argc != argc + 2) {
+        // out of room, keep field/value pairs whole
+        s->argc = argc;
+        s->used = used;
+    }
+}
+
+void stats_add_histogram(StatsHash *s, const char *name, const Histogram *h) {
+    char field[48];
+    snprintf(field, sizeof(field), "%s_count", name);
+    stats_add(s, field, h->count);
+    snprintf(field, sizeof(field), "%s_sum", name);
+    stats_add(s, field, h->sum_ms);
+    for (int i = 0; i < METRICS_BUCKET_COUNT; i++) {
+        snprintf(field, sizeof(field), "%s_le_%d", name, METRICS_BUCKETS_MS[i]);
+        stats_add(s, field, h->buckets[i]);
+    }
+}
+
+// Append the HSET to the pipeline. Returns the number of commands appended
+int stats_append(redisContext *redis, StatsHash *s) {
+    if (s->argc < 4 || s->argc % 2) return 0;
+    return redisAppendCommandArgv(redis, s->argc, s->argv, s->argvlen) == REDIS_OK ? 1 : 0;
+}
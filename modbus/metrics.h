@@ -0,0 +1,38 @@
+#ifndef METRICS_H
+#define METRICS_H
+
+#include <stdint.h>
+#include <stddef.h>
+#include <hiredis/hiredis.h>
+
+#define METRICS_BUCKET_COUNT 12
+#define METRICS_MAX_FIELDS 64
+#define METRICS_BUS_KEY "modbus:stats:bus:%d"      // hash per bus worker
+#define METRICS_SLAVE_KEY "modbus:stats:slave:%d"  // hash per device
+
+// Upper bounds (ms) of the latency buckets, the web tier's /metrics turns every
+// <name>_le_<bound> field into a Prometheus histogram bucket
+extern const int METRICS_BUCKETS_MS[METRICS_BUCKET_COUNT];
+
+typedef struct {
+    uint64_t count;
+    uint64_t sum_ms;
+    uint64_t buckets[METRICS_BUCKET_COUNT];   // cumulative, observations <= METRICS_BUCKETS_MS[i]
+} Histogram;
+
+// Arguments of one HSET <key> <field> <value> ... command
+typedef struct {
+    int argc;
+    const char *argv[2 + 2 * METRICS_MAX_FIELDS];
+    size_t argvlen[2 + 2 * METRICS_MAX_FIELDS];
+    char buf[(2 + 2 * METRICS_MAX_FIELDS) * 40];
+    size_t used;
+} StatsHash;
+
+void histogram_observe(Histogram *h, uint64_t ms);
+void stats_begin(StatsHash *s, const char *key_fmt, int id);
+void stats_add(StatsHash *s, const char *field, uint64_t value);
+void stats_add_histogram(StatsHash *s, const char *name, const Histogram *h);
+int stats_append(redisContext *redis, StatsHash *s);
+
+#endif
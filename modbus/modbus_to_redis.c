@@ -1,74 +1,207 @@
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
+#include <strings.h>
 #include <unistd.h>
 #include <sqlite3.h>
 #include <modbus/modbus.h>
 #include <hiredis/hiredis.h>
 #include <cjson/cJSON.h>
 #include "config.h"
+#include "historian.h"
 #include <errno.h>
+#include <time.h>
+#include <sys/time.h>
+#include <stdint.h>
+#include <pthread.h>
+#include "redis_pool.h"
+#include "metrics.h"
+#include "alarms.h"
+#include "util.h"
 //#include <arpa/inet.h>  // for socket functions
 
-#define MAX_DEVICES 128
-#define MAX_REGISTERS 64
 #define RETRY_DELAY 5   // seconds between retries for checking status of redis server
+#define UPDATES_CHANNEL "modbus:updates"   // slaveid is published here after every device read
+#define WRITE_QUEUE "modbus:writequeue"   // pending register writes, "slaveid:address:value:request_id"
+#define MAX_WRITE_BATCH 64                 // writes popped from the queue at once
+#define MAX_WRITE_RETRIES 3
+#define REQUEST_ID_LEN 33                  // hex correlation id from /api/update-parameters
+#define MAX_BLOCK_REGISTERS 512            // largest device published as a modbus:{slave}:block snapshot
+#define BLOCK_HEADER_SIZE 14               // uint32 poll cycle, uint64 poll time (ms), uint16 register count
+#define MAX_BACKOFF_MS 300000              // longest a silent slave is skipped
+#define MAX_BACKOFF_SHIFT 6                // backoff doubles per failed cycle up to poll_interval * 64
+#define MAX_BUS_WRITES 256                 // writes routed to a bus and not applied yet
+#define CONTROL_QUEUE "modbus:control"     // RPUSH "reload" to re-read the device topology now
 
-//gcc -o  modbus_to_redis  modbus_to_redis.c config.c -lmodbus -lcjson -lsqlite3 -lhiredis 
+// register_store in config.ini
+#define STORE_KEYS 1    // one modbus:{slave}:reg{n} string key per register
+#define STORE_BLOCK 2   // one packed modbus:{slave}:block per device
 
+//gcc -o  modbus_to_redis  modbus_to_redis.c config.c historian.c redis_pool.c metrics.c alarms.c util.c -pthread -lm -lmodbus -lcjson -lsqlite3 -lhiredis 
 
+
+// One entry of iot_devices_types.register_list:
+//   {"function": 3, "address": 0, "count": 22, "interval": 60}
+// interval (seconds) is optional and defaults to poll_interval
 typedef struct {
     int function;
     int address;
     int count;
+    int offset;          // first register index in modbus:{slave}:reg{n} and in the device block
+    int interval_ms;     // 0 = every poll_interval
+    uint64_t next_due;
+    int valid;           // last read of this group succeeded
+    int updated;         // read in the current poll
 } RegisterDef;
 
+// Change filter of a mapped parameter, sensor_data_register_mapping.deadband > 0
+typedef struct {
+    int offset;          // first register in the device block
+    int count;           // 1 or 2 (LSB word first)
+    int is_signed;
+    double deadband;     // raw counts, changes smaller than this are not uploaded
+} DeadbandDef;
+
+// Cumulative read statistics, exported to modbus:stats:slave:{slaveid}
+typedef struct {
+    uint64_t reads;                        // modbus read requests
+    uint64_t read_errors;
+    uint64_t timeouts;
+    uint64_t crc_errors;
+    Histogram read_ms;                     // latency of each read request
+} DeviceStats;
+
 typedef struct {
     int slaveid;
     char devicename[64];
-    RegisterDef registers[MAX_REGISTERS];
+    int bus;                               // config.ini bus, iotdevices.bus
+    RegisterDef *registers;                // register_count groups of register_list
+    RegisterDef **due;                     // poll_device scratch, one slot per group
     int register_count;
+    int register_total;                    // registers in the device block
+    uint16_t *values;                      // last value read of every register, register_total
+    int failures;                          // consecutive polls without any successful read
+    uint64_t retry_at;                     // backoff, the slave is skipped until then
+    uint16_t *published;                   // values last uploaded to redis
+    uint8_t *changed;                      // registers to upload in this poll
+    uint64_t keyframe_at;                  // next upload of every register, refreshing the key TTLs
+    DeadbandDef *deadbands;
+    int deadband_count;
+    int deadband_capacity;
+    DeviceStats stats;
 } Device;
 
-int parse_register_list(const char *json_str, RegisterDef *regs, int *count) {
+// Every device of the database, as loaded by load_devices()
+typedef struct {
+    Device **devices;
+    int count;
+    int capacity;
+} DeviceTable;
+
+void free_device(Device *dev) {
+    if (!dev) return;
+    free(dev->registers);
+    free(dev->due);
+    free(dev->values);
+    free(dev->published);
+    free(dev->changed);
+    free(dev->deadbands);
+    free(dev);
+}
+
+void free_device_list(Device **devices, int count) {
+    for (int i = 0; i < count; i++) free_device(devices[i]);
+    free(devices);
+}
+
+// Fills the register groups of dev and allocates its register buffers. A group that cannot be
+// read in one request is skipped with a message. Returns 0, -1 on a bad list or when out of memory
+int parse_register_list(const char *json_str, Device *dev) {
     cJSON *root = cJSON_Parse(json_str);
-    if (!root || !cJSON_IsArray(root)) return -1;
+    if (!root || !cJSON_IsArray(root)) {
+        cJSON_Delete(root);
+        return -1;
+    }
 
-    *count = 0;
     int len = cJSON_GetArraySize(root);
-    for (int i = 0; i < len && i < MAX_REGISTERS; i++) {
+    int *count = &dev->register_count;
+    int *total = &dev->register_total;
+    RegisterDef *regs = dev->registers = calloc(len ? len : 1, sizeof(RegisterDef));
+    dev->due = calloc(len ? len : 1, sizeof(RegisterDef *));
+    if (!regs || !dev->due) {
+        cJSON_Delete(root);
+        return -1;
+    }
+    *count = 0;
+    *total = 0;
+    for (int i = 0; i < len; i++) {
         cJSON *item = cJSON_GetArrayItem(root, i);
         cJSON *fn = cJSON_GetObjectItem(item, "function");
         cJSON *addr = cJSON_GetObjectItem(item, "address");
         cJSON *cnt = cJSON_GetObjectItem(item, "count");
+        cJSON *interval = cJSON_GetObjectItem(item, "interval");
         if (cJSON_IsNumber(fn) && cJSON_IsNumber(addr) && cJSON_IsNumber(cnt)) {
-            regs[*count].function = fn->valueint;
-            regs[*count].address = addr->valueint;
-            regs[*count].count = cnt->valueint;
+            if (cnt->valueint <= 0 || cnt->valueint > MODBUS_MAX_READ_REGISTERS) {
+                fprintf(stderr, "Slave %d: register group %d (address %d, count %d) skipped, count must be 1..%d\n",
+                        dev->slaveid, i, addr->valueint, cnt->valueint, MODBUS_MAX_READ_REGISTERS);
+                continue;
+            }
+            RegisterDef *reg = &regs[*count];
+            memset(reg, 0, sizeof(*reg));
+            reg->function = fn->valueint;
+            reg->address = addr->valueint;
+            reg->count = cnt->valueint;
+            reg->offset = *total;
+            reg->interval_ms = cJSON_IsNumber(interval) && interval->valueint > 0 ? interval->valueint * 1000 : 0;
+            *total += reg->count;
             (*count)++;
         }
     }
     cJSON_Delete(root);
-    return 0;
+    if (*total > MAX_BLOCK_REGISTERS)
+        fprintf(stderr, "Slave %d: %d registers exceed the %d of modbus:%d:block, stored as register keys only\n",
+                dev->slaveid, *total, MAX_BLOCK_REGISTERS, dev->slaveid);
+
+    int size = *total ? *total : 1;
+    dev->values = calloc(size, sizeof(uint16_t));
+    dev->published = calloc(size, sizeof(uint16_t));
+    dev->changed = calloc(size, sizeof(uint8_t));
+    return dev->values && dev->published && dev->changed ? 0 : -1;
+}
+
+Device *find_device(DeviceTable *table, int slaveid) {
+    for (int i = 0; i < table->count; i++)
+        if (table->devices[i] && table->devices[i]->slaveid == slaveid) return table->devices[i];
+    return NULL;
 }
 
-int load_devices(sqlite3 *db, Device *devices, int *device_count) {
+// Devices are returned grouped by bus, each bus polls a contiguous slice
+int load_devices(sqlite3 *db, DeviceTable *table) {
     sqlite3_stmt *stmt;
     const char *sql =
-        "SELECT d.slaveid, d.devicename, t.register_list "
-        "FROM iotdevices d JOIN iot_devices_types t ON d.devices_type_id = t.devices_type_id";
+        "SELECT d.slaveid, d.devicename, t.register_list, d.bus "
+        "FROM iotdevices d JOIN iot_devices_types t ON d.devices_type_id = t.devices_type_id "
+        "ORDER BY d.bus, d.slaveid";
 
     if (sqlite3_prepare_v2(db, sql, -1, &stmt, NULL) != SQLITE_OK) return -1;
 
-    *device_count = 0;
-    while (sqlite3_step(stmt) == SQLITE_ROW && *device_count < MAX_DEVICES) {
-        Device *dev = &devices[*device_count];
-        dev->slaveid = sqlite3_column_int(stmt, 0);
+    table->count = 0;
+    while (sqlite3_step(stmt) == SQLITE_ROW) {
         const unsigned char *name = sqlite3_column_text(stmt, 1);
         const unsigned char *reglist = sqlite3_column_text(stmt, 2);
-        strncpy(dev->devicename, name ? (const char *)name : "", sizeof(dev->devicename));
-        if (reglist && parse_register_list((const char *)reglist, dev->registers, &dev->register_count) == 0) {
-            (*device_count)++;
+        Device *dev = calloc(1, sizeof(Device));
+        if (!dev || grow_array((void **)&table->devices, &table->capacity, table->count, sizeof(Device *)) != 0) {
+            fprintf(stderr, "Out of memory loading devices\n");
+            free(dev);
+            break;
+        }
+        dev->slaveid = sqlite3_column_int(stmt, 0);
+        snprintf(dev->devicename, sizeof(dev->devicename), "%s", name ? (const char *)name : "");
+        dev->bus = sqlite3_column_int(stmt, 3);
+        if (reglist && parse_register_list((const char *)reglist, dev) == 0) {
+            table->devices[table->count++] = dev;
+        } else {
+            free_device(dev);
         }
     }
 
@@ -76,8 +209,51 @@ int load_devices(sqlite3 *db, Device *devices, int *device_count) {
     return 0;
 }
 
+// Deadbands are configured in engineering units, compared in raw register counts
+int load_deadbands(sqlite3 *db, DeviceTable *table) {
+    sqlite3_stmt *stmt;
+    const char *sql =
+        "SELECT d.slaveid, m.register_address, m.register_count, m.data_type, m.decimal_shift, m.deadband "
+        "FROM iotdevices d JOIN sensor_data_register_mapping m ON d.devices_type_id = m.devices_type_id "
+        "WHERE m.deadband > 0";
+
+    if (sqlite3_prepare_v2(db, sql, -1, &stmt, NULL) != SQLITE_OK) return -1;
+
+    while (sqlite3_step(stmt) == SQLITE_ROW) {
+        Device *dev = find_device(table, sqlite3_column_int(stmt, 0));
+        if (!dev || grow_array((void **)&dev->deadbands, &dev->deadband_capacity, dev->deadband_count, sizeof(DeadbandDef)) != 0)
+            continue;
+        DeadbandDef *band = &dev->deadbands[dev->deadband_count];
+        const unsigned char *data_type = sqlite3_column_text(stmt, 3);
+        band->offset = sqlite3_column_int(stmt, 1);
+        band->count = sqlite3_column_int(stmt, 2) > 1 ? 2 : 1;
+        band->is_signed = !(data_type && strncasecmp((const char *)data_type, "uint", 4) == 0);
+        band->deadband = sqlite3_column_double(stmt, 5);
+        for (int k = 0; k < sqlite3_column_int(stmt, 4); k++) band->deadband *= 10;
+        if (band->offset >= 0 && band->offset + band->count <= dev->register_total) dev->deadband_count++;
+    }
+
+    sqlite3_finalize(stmt);
+    return 0;
+}
+
+// Monotonic milliseconds for poll deadlines, backoff and waits; a stepped wall clock must
+// neither stall the buses nor make them spin
+uint64_t now_ms(void) {
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return (uint64_t)ts.tv_sec * 1000 + ts.tv_nsec / 1000000;
+}
+
+// Wall clock time of a now_ms() timestamp, for what is reported: block headers and alarm events
+uint64_t wall_time_ms(uint64_t monotonic_ms) {
+    struct timeval tv;
+    gettimeofday(&tv, NULL);
+    return (uint64_t)tv.tv_sec * 1000 + tv.tv_usec / 1000 - (now_ms() - monotonic_ms);
+}
+
 int read_modbus(modbus_t *ctx, int function, int address, int count, uint16_t *buffer) {
-    if (count <= 0 || count > 64) return -1;
+    if (count <= 0 || count > MODBUS_MAX_READ_REGISTERS) return -1;
 
     int rc = -1;
     if (function == 3) {
@@ -89,118 +265,856 @@ int read_modbus(modbus_t *ctx, int function, int address, int count, uint16_t *b
     return (rc == count) ? 0 : -1;
 }
 
+static int group_interval_ms(const RegisterDef *reg, int poll_interval_ms) {
+    return reg->interval_ms > 0 ? reg->interval_ms : poll_interval_ms;
+}
+
+// Keys of slow groups must outlive their poll interval
+static int group_ttl(const RegisterDef *reg, int poll_interval_ms, int ttl) {
+    int min_ttl = 2 * group_interval_ms(reg, poll_interval_ms) / 1000;
+    return ttl > min_ttl ? ttl : min_ttl;
+}
+
+static int compare_due_group(const void *a, const void *b) {
+    const RegisterDef *x = *(RegisterDef * const *)a, *y = *(RegisterDef * const *)b;
+    if (x->function != y->function) return x->function - y->function;
+    return x->address - y->address;
+}
+
+// Earliest time anything on this slave needs the bus
+uint64_t device_next_due(const Device *dev) {
+    uint64_t due = UINT64_MAX;
+    for (int j = 0; j < dev->register_count; j++)
+        if (dev->registers[j].next_due < due) due = dev->registers[j].next_due;
+    return due > dev->retry_at ? due : dev->retry_at;
+}
+
+// Make the groups holding a freshly written register due now, so a slow group does not
+// keep serving the value from before the write
+void invalidate_register(Device **devices, int device_count, int slaveid, int address) {
+    for (int i = 0; i < device_count; i++) {
+        if (devices[i]->slaveid != slaveid) continue;
+        for (int j = 0; j < devices[i]->register_count; j++) {
+            RegisterDef *reg = &devices[i]->registers[j];
+            if (address >= reg->address && address < reg->address + reg->count) reg->next_due = 0;
+        }
+    }
+}
+
+// Read the register groups of a device that are due. Adjacent or overlapping ranges with the
+// same function code are merged into one request of at most MODBUS_MAX_READ_REGISTERS, so a
+// device costs as few bus transactions as its layout allows.
+// Returns the number of groups read, 0 if nothing was due, -1 if every due group failed
+int poll_device(modbus_t *ctx, Device *dev, uint64_t now, int poll_interval_ms) {
+    RegisterDef **due = dev->due;
+    int due_count = 0;
+    for (int j = 0; j < dev->register_count; j++) {
+        RegisterDef *reg = &dev->registers[j];
+        reg->updated = 0;
+        if (reg->next_due > now) continue;
+        due[due_count++] = reg;
+        // deadline based, a late poll does not push the following ones back
+        int interval = group_interval_ms(reg, poll_interval_ms);
+        reg->next_due = (reg->next_due + interval > now) ? reg->next_due + interval : now + interval;
+    }
+    if (due_count == 0) return 0;
 
-void upload_registers(redisContext *redis, int slaveid, int base_index, uint16_t *regs, int count, int ttl) {
+    qsort(due, due_count, sizeof(RegisterDef *), compare_due_group);
+    modbus_set_slave(ctx, dev->slaveid);
+
+    int read = 0;
+    for (int i = 0; i < due_count; ) {
+        int start = due[i]->address;
+        int end = start + due[i]->count;
+        int j = i + 1;
+        while (j < due_count && due[j]->function == due[i]->function && due[j]->address <= end) {
+            int next_end = due[j]->address + due[j]->count;
+            if (next_end > end) {
+                if (next_end - start > MODBUS_MAX_READ_REGISTERS) break;
+                end = next_end;
+            }
+            j++;
+        }
+
+        uint16_t span[MODBUS_MAX_READ_REGISTERS];
+        uint64_t started = now_ms();
+        errno = 0;
+        int ok = read_modbus(ctx, due[i]->function, start, end - start, span) == 0;
+        histogram_observe(&dev->stats.read_ms, now_ms() - started);
+        dev->stats.reads++;
+        if (!ok) {
+            dev->stats.read_errors++;
+            if (errno == ETIMEDOUT) dev->stats.timeouts++;
+            else if (errno == EMBBADCRC) dev->stats.crc_errors++;
+        }
+        for (int k = i; k < j; k++) {
+            due[k]->valid = ok;
+            if (!ok) continue;
+            memcpy(dev->values + due[k]->offset, span + (due[k]->address - start), due[k]->count * sizeof(uint16_t));
+            due[k]->updated = 1;
+            read++;
+        }
+        i = j;
+    }
+
+    if (read > 0) {
+        dev->failures = 0;
+        dev->retry_at = 0;
+        return read;
+    }
+    // back off from a slave that keeps timing out so it does not eat the bus time of the others
+    if (dev->failures < MAX_BACKOFF_SHIFT) dev->failures++;
+    uint64_t backoff = (uint64_t)poll_interval_ms << dev->failures;
+    dev->retry_at = now + (backoff < MAX_BACKOFF_MS ? backoff : MAX_BACKOFF_MS);
+    fprintf(stderr, "Slave %d not responding, next attempt in %llu ms\n", dev->slaveid,
+            (unsigned long long)(dev->retry_at - now));
+    return -1;
+}
+
+
+// Register SETs are only appended to the hiredis output buffer here, the whole poll cycle
+// is sent in one write and its replies drained by flush_pipeline().
+// Returns the number of commands appended.
+int upload_registers(redisContext *redis, int slaveid, int base_index, uint16_t *regs, int count, int ttl) {
+    int queued = 0;
     for (int k = 0; k < count; k++) {
-        char key[64], val[32];
-        snprintf(key, sizeof(key), "modbus:%d:reg%d", slaveid, base_index + k);
-        snprintf(val, sizeof(val), "%d", regs[k]);
-        redisReply *reply = redisCommand(redis, "SET %s %s EX %d", key, val, ttl);
-        if (reply) freeReplyObject(reply);
+        if (redisAppendCommand(redis, "SET modbus:%d:reg%d %d EX %d", slaveid, base_index + k, regs[k], ttl) == REDIS_OK)
+            queued++;
     }
+    return queued;
+}
+
+static void put_le(unsigned char *buf, uint64_t value, int bytes) {
+    for (int i = 0; i < bytes; i++) buf[i] = (value >> (8 * i)) & 0xFF;
 }
 
-void populate_redis_keys_for_flask(sqlite3 *db, redisContext *redis, int ttl) {
-    sqlite3_stmt *stmt1, *stmt2;
+// Packed little-endian snapshot of a whole device, written with one SET so readers never
+// mix registers of two poll cycles:
+//   uint32 cycle | uint64 poll time ms | uint16 count | count x uint16 registers
+int upload_register_block(redisContext *redis, int slaveid, uint32_t cycle, uint64_t polled_ms,
+                          uint16_t *regs, int count, int ttl) {
+    unsigned char blob[BLOCK_HEADER_SIZE + 2 * MAX_BLOCK_REGISTERS];
+    put_le(blob, cycle, 4);
+    put_le(blob + 4, polled_ms, 8);
+    put_le(blob + 12, count, 2);
+    for (int k = 0; k < count; k++) put_le(blob + BLOCK_HEADER_SIZE + 2 * k, regs[k], 2);
 
-    const char *sql1 = "SELECT slaveid, devices_type_id FROM iotdevices";
-    if (sqlite3_prepare_v2(db, sql1, -1, &stmt1, NULL) != SQLITE_OK) {
-        fprintf(stderr, "Failed to prepare iotdevices query: %s\n", sqlite3_errmsg(db));
-        return;
+    size_t len = BLOCK_HEADER_SIZE + 2 * (size_t)count;
+    return redisAppendCommand(redis, "SET modbus:%d:block %b EX %d", slaveid, blob, len, ttl) == REDIS_OK ? 1 : 0;
+}
+
+int parse_register_store(const char *value) {
+    if (strcmp(value, "block") == 0) return STORE_BLOCK;
+    if (strcmp(value, "both") == 0) return STORE_KEYS | STORE_BLOCK;
+    return STORE_KEYS;
+}
+
+// Wake up the web tier stream listener, it re-reads the registers of the published slave
+int publish_update(redisContext *redis, int slaveid) {
+    return redisAppendCommand(redis, "PUBLISH %s %d", UPDATES_CHANNEL, slaveid) == REDIS_OK ? 1 : 0;
+}
+
+// Send the queued commands and discard their replies
+void flush_pipeline(redisContext *redis, int pending) {
+    for (int i = 0; i < pending; i++) {
+        redisReply *reply = NULL;
+        if (redisGetReply(redis, (void **)&reply) != REDIS_OK) {
+            fprintf(stderr, "Redis pipeline error: %s\n", redis->errstr);
+            return;
+        }
+        freeReplyObject(reply);
     }
+}
 
-    while (sqlite3_step(stmt1) == SQLITE_ROW) {
-        int slaveid = sqlite3_column_int(stmt1, 0);
-        int devices_type_id = sqlite3_column_int(stmt1, 1);
+// modbus:{slaveid}:{parameter_name} -> register address of every mapped parameter, one query
+// over the join and one pipelined write. Returns the number of keys written, -1 on error
+int populate_redis_keys_for_flask(sqlite3 *db, redisContext *redis, int ttl) {
+    sqlite3_stmt *stmt;
+    const char *sql =
+        "SELECT d.slaveid, m.parameter_name, m.register_address "
+        "FROM iotdevices d JOIN sensor_data_register_mapping m ON d.devices_type_id = m.devices_type_id";
+    if (sqlite3_prepare_v2(db, sql, -1, &stmt, NULL) != SQLITE_OK) {
+        fprintf(stderr, "Failed to prepare parameter key query: %s\n", sqlite3_errmsg(db));
+        return -1;
+    }
 
-        const char *sql2 =
-            "SELECT parameter_name, register_address FROM sensor_data_register_mapping "
-            "WHERE devices_type_id = ?";
-        if (sqlite3_prepare_v2(db, sql2, -1, &stmt2, NULL) != SQLITE_OK) continue;
+    int pending = 0;
+    while (sqlite3_step(stmt) == SQLITE_ROW) {
+        const unsigned char *param = sqlite3_column_text(stmt, 1);
+        if (!param) continue;
+        if (redisAppendCommand(redis, "SET modbus:%d:%s %d EX %d", sqlite3_column_int(stmt, 0),
+                               (const char *)param, sqlite3_column_int(stmt, 2), ttl) == REDIS_OK)
+            pending++;
+    }
+    sqlite3_finalize(stmt);
 
-        sqlite3_bind_int(stmt2, 1, devices_type_id);
+    flush_pipeline(redis, pending);
+    printf("Loaded %d parameter key(s) into Redis\n", pending);
+    return pending;
+}
 
-        while (sqlite3_step(stmt2) == SQLITE_ROW) {
-            const unsigned char *param = sqlite3_column_text(stmt2, 0);
-            int address = sqlite3_column_int(stmt2, 1);
+// RPUSH modbus:writequeue 7:4:3:<id>  SLAVEID=7, register_address=4, value=3, request id
+// Every write is acknowledged with RPUSH modbus:ack:<id> "<address>:OK|ERROR|SUPERSEDED"
+typedef struct {
+    int slaveid;
+    int address;
+    int value;
+    uint64_t seq;   // dispatch order on the bus, the latest write to a register wins
+    int attempts;   // failed attempts of this write
+    char request_id[REQUEST_ID_LEN];
+} WriteCommand;
 
-            if (!param) continue;
+static int compare_write_command(const void *a, const void *b) {
+    const WriteCommand *x = a, *y = b;
+    if (x->slaveid != y->slaveid) return x->slaveid - y->slaveid;
+    if (x->address != y->address) return x->address - y->address;
+    return (x->seq > y->seq) - (x->seq < y->seq);
+}
 
-            char key[128], val[32];
-            snprintf(key, sizeof(key), "modbus:%d:%s", slaveid, param);
-            snprintf(val, sizeof(val), "%d", address);
+static int parse_write_command(const char *str, WriteCommand *cmd) {
+    cmd->request_id[0] = '\0';
+    cmd->attempts = 0;
+    return str && sscanf(str, "%d:%d:%d:%32[0-9a-zA-Z]", &cmd->slaveid, &cmd->address, &cmd->value, cmd->request_id) >= 3
+           && cmd->address >= 0;
+}
 
-            redisReply *reply = redisCommand(redis, "SET %s %s EX %d", key, val, ttl);
-            if (reply) freeReplyObject(reply);
+// Pop up to max queued writes. With wait_ms > 0 blocks until the first write arrives or
+// wait_ms elapses. Returns the number of commands, -1 on redis error
+int pop_write_commands(redisContext *redis, WriteCommand *cmds, int max, uint64_t wait_ms) {
+    int n = 0;
+    redisReply *reply;
+    if (wait_ms > 0) {
+        reply = redisCommand(redis, "BLPOP %s %.3f", WRITE_QUEUE, wait_ms / 1000.0);
+        if (!reply) return -1;
+        if (reply->type == REDIS_REPLY_ARRAY && reply->elements == 2) {
+            cmds[n].seq = n;
+            if (parse_write_command(reply->element[1]->str, &cmds[n])) n++;
+        }
+        int timed_out = reply->type == REDIS_REPLY_NIL;
+        freeReplyObject(reply);
+        if (timed_out) return 0;
+    }
+    // drain whatever else is queued so consecutive registers can be coalesced
+    reply = redisCommand(redis, "LPOP %s %d", WRITE_QUEUE, max - n);
+    if (!reply) return -1;
+    if (reply->type == REDIS_REPLY_ARRAY) {
+        for (size_t i = 0; i < reply->elements && n < max; i++) {
+            cmds[n].seq = n;
+            if (parse_write_command(reply->element[i]->str, &cmds[n])) n++;
+        }
+    }
+    freeReplyObject(reply);
+    return n;
+}
+
+void acknowledge_write(redisContext *redis, WriteCommand *cmd, const char *status, int redis_ttl) {
+    if (!redis || !cmd->request_id[0]) return;
+    redisReply *reply = redisCommand(redis, "RPUSH modbus:ack:%s %d:%s", cmd->request_id, cmd->address, status);
+    if (reply) freeReplyObject(reply);
+    reply = redisCommand(redis, "EXPIRE modbus:ack:%s %d", cmd->request_id, redis_ttl);
+    if (reply) freeReplyObject(reply);
+}
 
-            printf("Loaded Redis key: %s → %s\n", key, val);
+// Acknowledge an applied write or one that failed MAX_WRITE_RETRIES times.
+// Returns 1 when the failed write is to be retried
+int report_write_result(redisContext *redis, WriteCommand *cmd, int ok, int redis_ttl) {
+    if (ok) {
+        acknowledge_write(redis, cmd, "OK", redis_ttl);
+        return 0;
+    }
+    fprintf(stderr, "Modbus write failed for slave %d register %d\n", cmd->slaveid, cmd->address);
+    if (++cmd->attempts >= MAX_WRITE_RETRIES) {
+        acknowledge_write(redis, cmd, "ERROR", redis_ttl);
+        return 0;
+    }
+    return 1;
+}
+
+// One bus worker per configured [modbus]/[busN] section. It owns the modbus context and the
+// devices on that line; writes and topology reloads reach it through lock-guarded hand-offs.
+typedef struct Poller Poller;
+
+typedef struct {
+    int index;
+    const BusConfig *cfg;
+    modbus_t *ctx;
+    Device **devices;                      // swapped by the worker only, under lock
+    int device_count;
+    Device **pending;                      // reloaded device list not adopted yet, guarded by lock
+    int pending_count;
+    int reload;                            // pending holds a new list
+    WriteCommand writes[MAX_BUS_WRITES];   // routed by the dispatcher, guarded by lock
+    int write_count;
+    uint64_t write_seq;                    // seq of the next routed write, guarded by lock
+    WriteCommand retries[MAX_BUS_WRITES];  // failed writes, retried before newer ones; worker only
+    int retry_count;
+    pthread_mutex_t lock;
+    pthread_cond_t wake;                   // signalled when writes are routed to the bus
+    pthread_t thread;
+    Poller *poller;
+    // cumulative, exported to modbus:stats:bus:{index}
+    uint64_t cycles;                       // poll cycles that read at least one device
+    Histogram cycle_ms;                    // modbus time of those cycles
+    Histogram redis_ms;                    // pipeline flush round trips
+    uint64_t writes_ok;
+    uint64_t writes_failed;
+} Bus;
+
+// State shared by the bus workers
+struct Poller {
+    Bus buses[MAX_BUSES];
+    RedisPool pool;
+    Historian historian;
+    pthread_mutex_t history_lock;
+    int history_enabled;
+    AlarmEngine alarms;
+    pthread_mutex_t alarm_lock;
+    int register_store;
+    int poll_interval_ms;
+    int redis_ttl;
+    int keyframe_ms;                       // 0 uploads every register of every poll
+    int debug;
+};
+
+// Bus polling a slave, writes to unknown slaves go to bus 0 as they did with a single bus
+Bus *bus_for_slave(Poller *poller, int slaveid) {
+    Bus *fallback = NULL;
+    for (int b = 0; b < MAX_BUSES; b++) {
+        Bus *bus = &poller->buses[b];
+        if (!bus->ctx) continue;
+        if (!fallback) fallback = bus;
+        pthread_mutex_lock(&bus->lock);
+        int found = 0;
+        for (int i = 0; i < bus->device_count && !found; i++)
+            found = bus->devices[i]->slaveid == slaveid;
+        pthread_mutex_unlock(&bus->lock);
+        if (found) return bus;
+    }
+    return fallback;
+}
+
+// Route queued writes to the bus of their slave and wake its worker.
+// Returns the number of commands routed, -1 on redis error
+int dispatch_writes(redisContext *redis, Poller *poller, uint64_t wait_ms) {
+    WriteCommand cmds[MAX_WRITE_BATCH];
+    int count = pop_write_commands(redis, cmds, MAX_WRITE_BATCH, wait_ms);
+    for (int i = 0; i < count; i++) {
+        Bus *bus = bus_for_slave(poller, cmds[i].slaveid);
+        int routed = 0;
+        if (bus) {
+            pthread_mutex_lock(&bus->lock);
+            if (bus->write_count < MAX_BUS_WRITES) {
+                cmds[i].seq = bus->write_seq++;
+                bus->writes[bus->write_count++] = cmds[i];
+                routed = 1;
+                pthread_cond_signal(&bus->wake);
+            }
+            pthread_mutex_unlock(&bus->lock);
         }
+        if (!routed) {
+            fprintf(stderr, "No bus accepts writes for slave %d\n", cmds[i].slaveid);
+            acknowledge_write(redis, &cmds[i], "ERROR", poller->redis_ttl);
+        }
+    }
+    return count;
+}
+
+// Apply the writes routed to this bus, one FC16 request per run of consecutive registers of a
+// slave (single registers keep using FC6). Failed writes from the previous pass come first and
+// keep their seq, so a write routed since then supersedes the retry instead of being
+// overwritten by it. Returns the number of registers handled
+int service_write_queue(Bus *bus) {
+    WriteCommand cmds[2 * MAX_BUS_WRITES];
+    int count = bus->retry_count;
+    memcpy(cmds, bus->retries, count * sizeof(WriteCommand));
+    bus->retry_count = 0;
+    pthread_mutex_lock(&bus->lock);
+    memcpy(cmds + count, bus->writes, bus->write_count * sizeof(WriteCommand));
+    count += bus->write_count;
+    bus->write_count = 0;
+    pthread_mutex_unlock(&bus->lock);
+    if (count == 0) return 0;
 
-        sqlite3_finalize(stmt2);
+    int redis_ttl = bus->poller->redis_ttl;
+    redisContext *redis = redis_pool_acquire(&bus->poller->pool);
+    qsort(cmds, count, sizeof(WriteCommand), compare_write_command);
+    // drop writes superseded by a later one to the same register
+    int n = 0;
+    for (int i = 0; i < count; i++) {
+        if (i + 1 < count && cmds[i + 1].slaveid == cmds[i].slaveid && cmds[i + 1].address == cmds[i].address) {
+            acknowledge_write(redis, &cmds[i], "SUPERSEDED", redis_ttl);
+            continue;
+        }
+        cmds[n++] = cmds[i];
+    }
+
+    for (int i = 0; i < n; ) {
+        int j = i + 1;
+        while (j < n && j - i < MODBUS_MAX_WRITE_REGISTERS &&
+               cmds[j].slaveid == cmds[i].slaveid && cmds[j].address == cmds[j - 1].address + 1) j++;
+
+        uint16_t values[MODBUS_MAX_WRITE_REGISTERS];
+        for (int k = i; k < j; k++) values[k - i] = cmds[k].value;
+
+        modbus_set_slave(bus->ctx, cmds[i].slaveid);
+        errno = 0;
+        int rc = (j - i == 1) ? modbus_write_register(bus->ctx, cmds[i].address, values[0])
+                              : modbus_write_registers(bus->ctx, cmds[i].address, j - i, values);
+        int ok = rc >= 0 || errno == 0;
+        if (ok) bus->writes_ok += j - i;
+        else bus->writes_failed += j - i;
+        for (int k = i; k < j; k++) {
+            if (report_write_result(redis, &cmds[k], ok, redis_ttl)) {
+                if (bus->retry_count < MAX_BUS_WRITES) bus->retries[bus->retry_count++] = cmds[k];
+                else acknowledge_write(redis, &cmds[k], "ERROR", redis_ttl);
+            }
+            if (ok) invalidate_register(bus->devices, bus->device_count, cmds[k].slaveid, cmds[k].address);
+        }
+        i = j;
     }
+    if (redis) redis_pool_release(&bus->poller->pool, redis);
+    return n;
+}
 
-    sqlite3_finalize(stmt1);
+modbus_t *open_bus(const BusConfig *cfg) {
+    modbus_t *ctx = cfg->type == BUS_TCP
+        ? modbus_new_tcp(cfg->host, cfg->port)
+        : modbus_new_rtu(cfg->device, cfg->baudrate, cfg->parity, cfg->data_bits, cfg->stop_bits);
+    // a gateway that dropped the TCP connection is reconnected by the next request
+    if (ctx && cfg->type == BUS_TCP) modbus_set_error_recovery(ctx, MODBUS_ERROR_RECOVERY_LINK);
+    return ctx;
 }
 
-//SET modbus:write:7:4 3  SLAVEID=7, register_address=4, value=3
-void handle_modbus_write_command(sqlite3 *db, redisContext *redis, modbus_t *ctx, int redis_ttl) {
-    redisReply *keys = redisCommand(redis, "KEYS modbus:write:*");
-    if (!keys || keys->type != REDIS_REPLY_ARRAY) {
-        if (keys) freeReplyObject(keys);
-        return;
+static double register_value(const uint16_t *regs, int count, int is_signed) {
+    if (count > 1) {
+        uint32_t value = (uint32_t)regs[1] << 16 | regs[0];
+        return is_signed ? (double)(int32_t)value : (double)value;
     }
+    return is_signed ? (double)(int16_t)regs[0] : (double)regs[0];
+}
 
-    for (size_t i = 0; i < keys->elements; i++) {
-        const char *key = keys->element[i]->str;
-        int slaveid;
-        int address;
-        if (sscanf(key, "modbus:write:%d:%d", &slaveid, &address) != 2) continue;
+// Flag the registers of the groups read in this poll whose value moved away from the last
+// uploaded one, by more than its deadband where the parameter has one. Returns the count
+static int detect_changes(Device *dev) {
+    memset(dev->changed, 0, dev->register_total);
+    for (int j = 0; j < dev->register_count; j++) {
+        RegisterDef *reg = &dev->registers[j];
+        if (!reg->updated) continue;
+        for (int k = reg->offset; k < reg->offset + reg->count; k++)
+            dev->changed[k] = dev->values[k] != dev->published[k];
+    }
+    for (int d = 0; d < dev->deadband_count; d++) {
+        DeadbandDef *band = &dev->deadbands[d];
+        int touched = 0;
+        for (int k = band->offset; k < band->offset + band->count; k++) touched |= dev->changed[k];
+        if (!touched) continue;
+        double delta = register_value(dev->values + band->offset, band->count, band->is_signed) -
+                       register_value(dev->published + band->offset, band->count, band->is_signed);
+        // both words of a 32 bit value go out together
+        int upload = delta >= band->deadband || -delta >= band->deadband;
+        for (int k = band->offset; k < band->offset + band->count; k++) dev->changed[k] = upload;
+    }
+    int changes = 0;
+    for (int k = 0; k < dev->register_total; k++) {
+        if (!dev->changed[k]) continue;
+        dev->published[k] = dev->values[k];
+        changes++;
+    }
+    return changes;
+}
 
-        redisReply *val = redisCommand(redis, "GET %s", key);
-        if (!val || val->type != REDIS_REPLY_STRING) {
-            if (val) freeReplyObject(val);
+// Upload a device after a poll. Between keyframes only the registers that changed are SET and
+// the block and update notification are skipped when nothing changed; a keyframe SETs every
+// valid group again so the key TTLs keep meaning "device online".
+// Returns the number of commands appended
+static int upload_device(redisContext *redis, Poller *poller, Device *dev, uint32_t cycle, uint64_t polled_ms) {
+    uint64_t polled_at = wall_time_ms(polled_ms);
+    int keyframe = poller->keyframe_ms <= 0 || polled_ms >= dev->keyframe_at;
+    int changes = 0;
+    if (keyframe) {
+        dev->keyframe_at = polled_ms + poller->keyframe_ms;
+        memcpy(dev->published, dev->values, dev->register_total * sizeof(uint16_t));
+    } else {
+        changes = detect_changes(dev);
+    }
+
+    int pending = 0;
+    int complete = 1;
+    int block_ttl = poller->redis_ttl;
+    // a device too large for the block falls back to the per-register keys
+    int store = dev->register_total > MAX_BLOCK_REGISTERS ? STORE_KEYS : poller->register_store;
+    for (int j = 0; j < dev->register_count; j++) {
+        RegisterDef *reg = &dev->registers[j];
+        int ttl = group_ttl(reg, poller->poll_interval_ms, poller->redis_ttl);
+        if (ttl > block_ttl) block_ttl = ttl;
+        if (!reg->valid) complete = 0;
+        if (!reg->valid || (!keyframe && !reg->updated)) continue;
+        uint16_t *regs = dev->values + reg->offset;
+        if (poller->debug && reg->updated) {
+            printf("slaveid: %d  ", dev->slaveid);
+            for (int k = 0; k < reg->count; k++) {
+                printf("%02d, ", regs[k]);
+            }
+            printf("\n");
+        }
+        if (!(store & STORE_KEYS)) continue;
+        if (keyframe) {
+            pending += upload_registers(redis, dev->slaveid, reg->offset, regs, reg->count, ttl);
             continue;
         }
+        for (int k = 0; k < reg->count; k++)
+            if (dev->changed[reg->offset + k])
+                pending += upload_registers(redis, dev->slaveid, reg->offset + k, regs + k, 1, ttl);
+    }
+    if (keyframe || changes) {
+        // only publish a block whose every group holds a successful read
+        if ((store & STORE_BLOCK) && complete)
+            pending += upload_register_block(redis, dev->slaveid, cycle, polled_at, dev->values, dev->register_total, block_ttl);
+        pending += publish_update(redis, dev->slaveid);
+    }
+    if (poller->history_enabled && complete) {
+        pthread_mutex_lock(&poller->history_lock);
+        historian_sample(&poller->historian, dev->slaveid, dev->values, dev->register_total, time(NULL));
+        pthread_mutex_unlock(&poller->history_lock);
+    }
+    if (complete) {
+        pthread_mutex_lock(&poller->alarm_lock);
+        pending += alarms_evaluate(&poller->alarms, redis, dev->slaveid, dev->values, dev->register_total,
+                                  polled_ms, polled_at);
+        pthread_mutex_unlock(&poller->alarm_lock);
+    }
+    return pending;
+}
+
+// A device that just stopped answering: its keys are dropped at once instead of when their
+// TTLs run out, so readers and the stream show it offline, and the next successful read
+// uploads a keyframe again. Returns the number of commands appended
+static int upload_device_offline(redisContext *redis, Device *dev) {
+    int pending = 0;
+    if (redisAppendCommand(redis, "DEL modbus:%d:block", dev->slaveid) == REDIS_OK) pending++;
+    for (int k = 0; k < dev->register_total; k++)
+        if (redisAppendCommand(redis, "DEL modbus:%d:reg%d", dev->slaveid, k) == REDIS_OK) pending++;
+    dev->keyframe_at = 0;
+    return pending + publish_update(redis, dev->slaveid);
+}
+
+static int append_device_stats(redisContext *redis, Device *dev) {
+    static __thread StatsHash stats;
+    stats_begin(&stats, METRICS_SLAVE_KEY, dev->slaveid);
+    stats_add(&stats, "bus", dev->bus);
+    stats_add(&stats, "reads", dev->stats.reads);
+    stats_add(&stats, "read_errors", dev->stats.read_errors);
+    stats_add(&stats, "timeouts", dev->stats.timeouts);
+    stats_add(&stats, "crc_errors", dev->stats.crc_errors);
+    stats_add(&stats, "backoff_failures", dev->failures);
+    stats_add_histogram(&stats, "read_ms", &dev->stats.read_ms);
+    return stats_append(redis, &stats);
+}
+
+static int append_bus_stats(redisContext *redis, Bus *bus) {
+    static __thread StatsHash stats;
+    pthread_mutex_lock(&bus->lock);
+    int queued = bus->write_count;
+    pthread_mutex_unlock(&bus->lock);
+    stats_begin(&stats, METRICS_BUS_KEY, bus->index);
+    stats_add(&stats, "devices", bus->device_count);
+    stats_add(&stats, "cycles", bus->cycles);
+    stats_add(&stats, "writes_queued", queued);
+    stats_add(&stats, "writes_ok", bus->writes_ok);
+    stats_add(&stats, "writes_failed", bus->writes_failed);
+    stats_add_histogram(&stats, "cycle_ms", &bus->cycle_ms);
+    stats_add_histogram(&stats, "redis_ms", &bus->redis_ms);
+    return stats_append(redis, &stats);
+}
+
+static int same_layout(const Device *a, const Device *b) {
+    if (a->register_count != b->register_count || a->register_total != b->register_total ||
+        a->deadband_count != b->deadband_count) return 0;
+    for (int j = 0; j < a->register_count; j++) {
+        const RegisterDef *x = &a->registers[j], *y = &b->registers[j];
+        if (x->function != y->function || x->address != y->address || x->count != y->count ||
+            x->interval_ms != y->interval_ms) return 0;
+    }
+    for (int d = 0; d < a->deadband_count; d++) {
+        const DeadbandDef *x = &a->deadbands[d], *y = &b->deadbands[d];
+        if (x->offset != y->offset || x->count != y->count || x->is_signed != y->is_signed ||
+            x->deadband != y->deadband) return 0;
+    }
+    return 1;
+}
+
+// Take over the device list of a topology reload between two poll cycles. A device whose
+// register layout did not change is kept as it is (values, schedule, backoff, statistics),
+// a changed one starts over with the statistics carried across. Returns 1 if a list was adopted
+static int adopt_devices(Bus *bus) {
+    pthread_mutex_lock(&bus->lock);
+    int reload = bus->reload;
+    Device **devices = bus->pending;
+    int count = bus->pending_count;
+    bus->pending = NULL;
+    bus->pending_count = 0;
+    bus->reload = 0;
+    pthread_mutex_unlock(&bus->lock);
+    if (!reload) return 0;
+
+    // the dispatcher may be reading the old list until the swap, it is only freed after it
+    Device **old = bus->devices;
+    int old_count = bus->device_count;
+    int kept = 0;
+    for (int i = 0; i < count; i++) {
+        for (int k = 0; k < old_count; k++) {
+            if (old[k]->slaveid != devices[i]->slaveid) continue;
+            if (same_layout(old[k], devices[i])) {
+                snprintf(old[k]->devicename, sizeof(old[k]->devicename), "%s", devices[i]->devicename);
+                free_device(devices[i]);
+                devices[i] = old[k];
+                kept++;
+            } else {
+                devices[i]->stats = old[k]->stats;
+                devices[i]->failures = old[k]->failures;
+                devices[i]->retry_at = old[k]->retry_at;
+            }
+            break;
+        }
+    }
+
+    pthread_mutex_lock(&bus->lock);
+    bus->devices = devices;
+    bus->device_count = count;
+    pthread_mutex_unlock(&bus->lock);
+
+    for (int k = 0; k < old_count; k++) {
+        int still_used = 0;
+        for (int i = 0; i < count && !still_used; i++) still_used = devices[i] == old[k];
+        if (!still_used) free_device(old[k]);
+    }
+    free(old);
+    printf("Bus %d: polling %d device(s), %d unchanged\n", bus->index, count, kept);
+    return 1;
+}
+
+void *bus_worker(void *arg) {
+    Bus *bus = arg;
+    Poller *poller = bus->poller;
+    while (modbus_connect(bus->ctx) == -1) {
+        fprintf(stderr, "Bus %d: modbus connection failed, retrying in %d second(s)\n", bus->index, RETRY_DELAY);
+        sleep(RETRY_DELAY);
+    }
+
+    uint64_t *polled = NULL;        // poll time of the devices read this cycle, 0 if not read
+    uint8_t *attempted = NULL;      // devices asked for registers this cycle
+    int scratch = 0;
+    uint32_t cycle = 0;
+    while (1) {
+        if (adopt_devices(bus) && bus->device_count > scratch) {
+            scratch = bus->device_count;
+            polled = realloc(polled, scratch * sizeof(uint64_t));
+            attempted = realloc(attempted, scratch * sizeof(uint8_t));
+            if (!polled || !attempted) {
+                fprintf(stderr, "Bus %d: out of memory\n", bus->index);
+                exit(1);
+            }
+        }
+        cycle++;
+        if (bus->retry_count) service_write_queue(bus);
+        int read_count = 0;
+        int attempt_count = 0;
+        uint64_t cycle_start = now_ms();
+        for (int i = 0; i < bus->device_count; i++) {
+            Device *dev = bus->devices[i];
+            uint64_t now = now_ms();
+            polled[i] = 0;
+            attempted[i] = 0;
+            if (device_next_due(dev) > now) continue;
+
+            service_write_queue(bus);
+            int groups = poll_device(bus->ctx, dev, now, poller->poll_interval_ms);
+            attempted[i] = groups != 0;
+            attempt_count += attempted[i];
+            if (groups <= 0) continue;
+            polled[i] = now_ms();
+            read_count++;
+        }
+        if (attempt_count) {
+            bus->cycles++;
+            histogram_observe(&bus->cycle_ms, now_ms() - cycle_start);
+        }
+
+        // the whole cycle goes to redis in one pipelined write on a pooled connection
+        redisContext *redis = attempt_count ? redis_pool_acquire(&poller->pool) : NULL;
+        if (redis) {
+            int pending = 0;
+            for (int i = 0; i < bus->device_count; i++) {
+                if (polled[i]) pending += upload_device(redis, poller, bus->devices[i], cycle, polled[i]);
+                else if (attempted[i] && bus->devices[i]->failures == 1) pending += upload_device_offline(redis, bus->devices[i]);
+                if (attempted[i]) pending += append_device_stats(redis, bus->devices[i]);
+            }
+            pending += append_bus_stats(redis, bus);
+            uint64_t flush_start = now_ms();
+            flush_pipeline(redis, pending);
+            histogram_observe(&bus->redis_ms, now_ms() - flush_start);
+            redis_pool_release(&poller->pool, redis);
+        }
 
-        int value = atoi(val->str);
-        freeReplyObject(val);
- 
-        if (address < 0) continue; 
-        modbus_set_slave(ctx, slaveid);
-		char fail_key[128], result_key[128];
-		snprintf(result_key, sizeof(result_key), "modbus:result:%d:%d", slaveid, address);
-		snprintf(fail_key, sizeof(fail_key), "modbus:failcount:%d:%d", slaveid, address);
+        // idle until the next register group is due, applying writes as soon as they are routed
+        for (;;) {
+            uint64_t next_poll = UINT64_MAX;
+            for (int i = 0; i < bus->device_count; i++) {
+                uint64_t due = device_next_due(bus->devices[i]);
+                if (due < next_poll) next_poll = due;
+            }
+            if (next_poll == UINT64_MAX) next_poll = now_ms() + poller->poll_interval_ms;
 
-		//printf("WRITING TO MODBUS SLAVEID: %D,address: %d, value: %d\n", slaveid ,address,value);
-		int rc = modbus_write_register(ctx, address, value);
-		//printf("modbus_write_register returned %d for slave %d addr %d\n", rc, slaveid, address);
+            pthread_mutex_lock(&bus->lock);
+            while (bus->write_count == 0 && !bus->reload && now_ms() < next_poll) {
+                struct timespec until = { next_poll / 1000, (next_poll % 1000) * 1000000 };
+                if (pthread_cond_timedwait(&bus->wake, &bus->lock, &until) == ETIMEDOUT) break;
+            }
+            int writes = bus->write_count;
+            int reload = bus->reload;
+            pthread_mutex_unlock(&bus->lock);
+            if (!writes || reload) break;
+            service_write_queue(bus);
+        }
+    }
+    return NULL;
+}
+
+// Hand every bus worker the devices of its bus, adopted between two poll cycles. A list the
+// worker has not picked up yet is replaced. Devices of buses without a worker are dropped
+void distribute_devices(Poller *poller, DeviceTable *table) {
+    for (int b = 0; b < MAX_BUSES; b++) {
+        Bus *bus = &poller->buses[b];
+        int count = 0;
+        for (int i = 0; i < table->count; i++) count += table->devices[i] && table->devices[i]->bus == b;
+        if (!bus->ctx) {
+            if (count) fprintf(stderr, "Bus %d is not configured, %d device(s) not polled\n", b, count);
+            continue;
+        }
+        Device **devices = malloc((count ? count : 1) * sizeof(Device *));
+        if (!devices) {
+            fprintf(stderr, "Bus %d: out of memory, keeping the previous devices\n", b);
+            continue;
+        }
+        int n = 0;
+        for (int i = 0; i < table->count; i++) {
+            if (!table->devices[i] || table->devices[i]->bus != b) continue;
+            devices[n++] = table->devices[i];
+            table->devices[i] = NULL;
+        }
 
-		if (rc >= 0 || errno == 0) {
-			//printf("Wrote %d to slave %d register %d\n", value, slaveid, address);
-			redisCommand(redis, "SET %s OK EX %d", result_key,redis_ttl);
-			redisCommand(redis, "DEL %s", key);
-			redisCommand(redis, "DEL %s", fail_key);  // reset failure count
-		} else {
-			fprintf(stderr, "Modbus write failed for %s\n", key);
-			redisReply *fail = redisCommand(redis, "INCR %s", fail_key);
-			int attempts = (fail && fail->type == REDIS_REPLY_INTEGER) ? fail->integer : 0;
-			if (fail) freeReplyObject(fail);
+        pthread_mutex_lock(&bus->lock);
+        free_device_list(bus->pending, bus->pending_count);
+        bus->pending = devices;
+        bus->pending_count = n;
+        bus->reload = 1;
+        pthread_cond_signal(&bus->wake);
+        pthread_mutex_unlock(&bus->lock);
+    }
+    for (int i = 0; i < table->count; i++) {
+        Device *dev = table->devices[i];
+        if (!dev) continue;
+        if (dev->bus < 0 || dev->bus >= MAX_BUSES)
+            fprintf(stderr, "Slave %d is on unknown bus %d, not polled\n", dev->slaveid, dev->bus);
+        free_device(dev);
+    }
+    table->count = 0;
+}
 
-			if (attempts >= 3) {				
-				redisCommand(redis, "SET %s ERROR: Max retries reached EX %d", result_key,redis_ttl);
-				redisCommand(redis, "DEL %s", key);
-				redisCommand(redis, "DEL %s", fail_key);
-				redisCommand(redis, "DEL %s", result_key); // delete result key too
+// Detects edits of the device topology in iot.db: PRAGMA data_version moves on every commit of
+// another connection (the historian's included), a fingerprint of the tables tells whether the
+// commit touched devices, types or mappings
+typedef struct {
+    sqlite3_stmt *data_version;
+    sqlite3_stmt *tables[3];
+    sqlite3_int64 version;
+    uint64_t signature;
+} TopologyWatch;
 
-			} else {				
-				redisCommand(redis, "SET %s ERROR: Attempt %d EX %d", result_key, attempts,redis_ttl);
-			}
-		}
+int topology_watch_open(sqlite3 *db, TopologyWatch *watch) {
+    const char *sql[3] = {
+        "SELECT * FROM iotdevices ORDER BY slaveid",
+        "SELECT * FROM iot_devices_types ORDER BY devices_type_id",
+        "SELECT * FROM sensor_data_register_mapping ORDER BY mapid",
+    };
+    memset(watch, 0, sizeof(*watch));
+    if (sqlite3_prepare_v2(db, "PRAGMA data_version", -1, &watch->data_version, NULL) != SQLITE_OK) return -1;
+    for (int t = 0; t < 3; t++)
+        if (sqlite3_prepare_v2(db, sql[t], -1, &watch->tables[t], NULL) != SQLITE_OK) return -1;
+    return 0;
+}
 
+// FNV-1a over every column of the topology tables
+static uint64_t topology_signature(TopologyWatch *watch) {
+    uint64_t hash = 14695981039346656037ULL;
+    for (int t = 0; t < 3; t++) {
+        sqlite3_stmt *stmt = watch->tables[t];
+        while (sqlite3_step(stmt) == SQLITE_ROW) {
+            for (int c = 0; c < sqlite3_column_count(stmt); c++) {
+                const unsigned char *text = sqlite3_column_text(stmt, c);
+                int len = sqlite3_column_bytes(stmt, c);
+                for (int k = 0; text && k < len; k++) hash = (hash ^ text[k]) * 1099511628211ULL;
+                hash = (hash ^ (text ? 0x1F : 0x1E)) * 1099511628211ULL;   // column separator, NULL marker
+            }
+        }
+        sqlite3_reset(stmt);
+    }
+    return hash;
+}
 
+// Returns 1 when the topology changed since the last call (always on the first one)
+int topology_changed(TopologyWatch *watch) {
+    if (sqlite3_step(watch->data_version) != SQLITE_ROW) {
+        sqlite3_reset(watch->data_version);
+        return 0;
     }
+    sqlite3_int64 version = sqlite3_column_int64(watch->data_version, 0);
+    sqlite3_reset(watch->data_version);
+    if (version == watch->version && watch->signature) return 0;
+    watch->version = version;
 
-    freeReplyObject(keys);
+    uint64_t signature = topology_signature(watch);
+    if (signature == watch->signature) return 0;
+    watch->signature = signature;
+    return 1;
+}
+
+void topology_watch_close(TopologyWatch *watch) {
+    sqlite3_finalize(watch->data_version);
+    for (int t = 0; t < 3; t++) sqlite3_finalize(watch->tables[t]);
+}
+
+// A "reload" pushed to the control list forces a reload. Returns 1 if one was requested
+int reload_requested(redisContext *redis) {
+    redisReply *reply = redisCommand(redis, "LPOP %s", CONTROL_QUEUE);
+    int reload = reply && reply->type == REDIS_REPLY_STRING && strcmp(reply->str, "reload") == 0;
+    if (reply) freeReplyObject(reply);
+    return reload;
+}
+
+// Re-read devices, deadbands, parameter keys and alarm channels and hand them to the bus
+// workers. Pending writes stay queued on their buses. Returns 0, -1 if the devices could not
+// be loaded
+int reload_topology(sqlite3 *db, redisContext *redis, Poller *poller, DeviceTable *table) {
+    if (load_devices(db, table) != 0) {
+        fprintf(stderr, "Failed to load devices: %s\n", sqlite3_errmsg(db));
+        return -1;
+    }
+    if (load_deadbands(db, table) != 0)
+        fprintf(stderr, "Failed to load deadbands, every change is uploaded: %s\n", sqlite3_errmsg(db));
+    printf("Loaded %d device(s)\n", table->count);
+    distribute_devices(poller, table);
+    if (redis) populate_redis_keys_for_flask(db, redis, poller->redis_ttl);
+    pthread_mutex_lock(&poller->alarm_lock);
+    if (alarms_load(&poller->alarms, db, redis) != 0)
+        fprintf(stderr, "Failed to load alarm channels: %s\n", sqlite3_errmsg(db));
+    pthread_mutex_unlock(&poller->alarm_lock);
+    if (poller->history_enabled) {
+        pthread_mutex_lock(&poller->history_lock);
+        historian_reload(&poller->historian, time(NULL));
+        pthread_mutex_unlock(&poller->history_lock);
+    }
+    return 0;
 }
 
 // Function to check if Redis is accepting TCP connections
@@ -228,6 +1142,8 @@ int main() {
         fprintf(stderr, "Failed to load config.ini\n");
         return 1;
     }
+    // optional site overrides, e.g. the simulator's bus in docker-compose.sim.yml
+    if (load_config_overlay("config.local.ini", &cfg) == 0) printf("Applied config.local.ini\n");
 	if (cfg.redis_ttl <= 0) cfg.redis_ttl = 60;
 
     sqlite3 *db;
@@ -242,59 +1158,119 @@ int main() {
 
     printf("✅ Redis server is running! Proceeding...\n");
 
-    redisContext *redis = redisConnect(cfg.redis_host, cfg.redis_port);
-    if (!redis || redis->err) {
-        fprintf(stderr, "Redis error: %s\n", redis ? redis->errstr : "NULL");
+	// the write queue dispatcher keeps its own connection, BLPOP blocks it
+    redisContext *cmd_redis = redisConnect(cfg.redis_host, cfg.redis_port);
+    if (!cmd_redis || cmd_redis->err) {
+        fprintf(stderr, "Redis error: %s\n", cmd_redis ? cmd_redis->errstr : "NULL");
+        sqlite3_close(db);
+        return 1;
+    }
+    // Columns added to the schema after the first release are created here on older databases:
+    //   iotdevices.bus                          config.ini bus of the device, 0 by default
+    //   sensor_data_register_mapping.deadband   smallest change uploaded, 0 uploads every change
+    ensure_column(db, "iotdevices", "bus", "INTEGER NOT NULL DEFAULT 0");
+    ensure_column(db, "sensor_data_register_mapping", "deadband", "REAL NOT NULL DEFAULT 0");
+    TopologyWatch watch;
+    if (topology_watch_open(db, &watch) != 0) {
+        fprintf(stderr, "Failed to read the device tables: %s\n", sqlite3_errmsg(db));
+        redisFree(cmd_redis);
         sqlite3_close(db);
         return 1;
     }
-	populate_redis_keys_for_flask(db, redis, cfg.redis_ttl);
-	
-    modbus_t *ctx = modbus_new_rtu(cfg.device, cfg.baudrate, cfg.parity, cfg.data_bits, cfg.stop_bits);
-	//modbus_set_debug(ctx, TRUE);
-    if (!ctx || modbus_connect(ctx) == -1) {
+
+    static Poller poller;
+    poller.register_store = parse_register_store(cfg.register_store);
+    poller.poll_interval_ms = (cfg.poll_interval > 0 ? cfg.poll_interval : 1) * 1000;
+    poller.redis_ttl = cfg.redis_ttl;
+    // a keyframe has to land before the keys of the previous one expire
+    if (cfg.keyframe_interval >= cfg.redis_ttl) cfg.keyframe_interval = cfg.redis_ttl / 2;
+    poller.keyframe_ms = cfg.keyframe_interval > 0 ? cfg.keyframe_interval * 1000 : 0;
+    poller.debug = cfg.debug;
+    pthread_mutex_init(&poller.history_lock, NULL);
+    poller.history_enabled = historian_open(&poller.historian, cfg.db_path, cfg.log_interval, cfg.history_days) == 0;
+    if (!poller.history_enabled) fprintf(stderr, "History logging disabled\n");
+    pthread_mutex_init(&poller.alarm_lock, NULL);
+    alarms_init(&poller.alarms, cfg.alarm_hysteresis, cfg.alarm_rate_limit, cfg.alarm_rate_window);
+
+    int bus_count = 0;
+    for (int b = 0; b < MAX_BUSES; b++) {
+        Bus *bus = &poller.buses[b];
+        bus->index = b;
+        bus->cfg = &cfg.buses[b];
+        bus->poller = &poller;
+        pthread_mutex_init(&bus->lock, NULL);
+        // the idle wait runs on now_ms() deadlines
+        pthread_condattr_t wake_attr;
+        pthread_condattr_init(&wake_attr);
+        pthread_condattr_setclock(&wake_attr, CLOCK_MONOTONIC);
+        pthread_cond_init(&bus->wake, &wake_attr);
+        pthread_condattr_destroy(&wake_attr);
+        if (!bus->cfg->configured) continue;
+        bus->ctx = open_bus(bus->cfg);
+        if (!bus->ctx) {
+            fprintf(stderr, "Bus %d: failed to create modbus context\n", b);
+            continue;
+        }
+        bus_count++;
+    }
+    if (bus_count == 0) {
         fprintf(stderr, "Modbus connection failed\n");
-        redisFree(redis);
+        redisFree(cmd_redis);
         sqlite3_close(db);
         return 1;
     }
 
-    Device devices[MAX_DEVICES];
-    int device_count = 0;
-    if (load_devices(db, devices, &device_count) != 0) {
-        fprintf(stderr, "Failed to load devices\n");
-        modbus_close(ctx);
-        modbus_free(ctx);
-        redisFree(redis);
+    // the first topology_changed() always reports a change, loading the devices
+    static DeviceTable table;
+    topology_changed(&watch);
+    if (reload_topology(db, cmd_redis, &poller, &table) != 0) {
+        redisFree(cmd_redis);
         sqlite3_close(db);
         return 1;
     }
 
+    redis_pool_init(&poller.pool, cfg.redis_host, cfg.redis_port, bus_count);
+    for (int b = 0; b < MAX_BUSES; b++) {
+        Bus *bus = &poller.buses[b];
+        if (bus->ctx && pthread_create(&bus->thread, NULL, bus_worker, bus) != 0) {
+            fprintf(stderr, "Bus %d: failed to start worker\n", b);
+        }
+    }
+
+    // main thread: route queued writes to the bus workers, reload the device topology when
+    // iot.db changes and commit history batches
     while (1) {
-        for (int i = 0; i < device_count; i++) {
-            modbus_set_slave(ctx, devices[i].slaveid);
-			int reg_offset = 0;
-			for (int j = 0; j < devices[i].register_count; j++) {
-				RegisterDef *reg = &devices[i].registers[j];
-				uint16_t regs[64];
-				if (read_modbus(ctx, reg->function, reg->address, reg->count, regs) == 0) {
-					printf("slaveid: %d  ",devices[i].slaveid);
-					for (int k = 0; k < reg->count; k++) {
-						printf("%02d, ",regs[k]);
-					}
-					printf("\n");
-					upload_registers(redis, devices[i].slaveid, reg_offset, regs, reg->count, cfg.redis_ttl);
-					reg_offset += reg->count;
-				}
-			}
+        if (dispatch_writes(cmd_redis, &poller, 1000) < 0) {
+            fprintf(stderr, "Redis write queue error: %s\n", cmd_redis->errstr);
+            redisFree(cmd_redis);
+            sleep(RETRY_DELAY);
+            cmd_redis = redisConnect(cfg.redis_host, cfg.redis_port);
+            if (!cmd_redis) break;
+            continue;
+        }
+        // not short-circuited, a pending control message is consumed either way
+        if (topology_changed(&watch) | reload_requested(cmd_redis)) {
+            printf("Device topology changed, reloading\n");
+            reload_topology(db, cmd_redis, &poller, &table);
+        }
+        if (poller.history_enabled) {
+            pthread_mutex_lock(&poller.history_lock);
+            historian_tick(&poller.historian, time(NULL));
+            pthread_mutex_unlock(&poller.history_lock);
         }
-        handle_modbus_write_command(db, redis, ctx, cfg.redis_ttl);
-        sleep(cfg.poll_interval);
     }
 
-    modbus_close(ctx);
-    modbus_free(ctx);
-    redisFree(redis);
+    if (poller.history_enabled) historian_close(&poller.historian);
+    alarms_free(&poller.alarms);
+    for (int b = 0; b < MAX_BUSES; b++) {
+        if (!poller.buses[b].ctx) continue;
+        modbus_close(poller.buses[b].ctx);
+        modbus_free(poller.buses[b].ctx);
+    }
+    redis_pool_destroy(&poller.pool);
+    if (cmd_redis) redisFree(cmd_redis);
+    topology_watch_close(&watch);
+    free(table.devices);
     sqlite3_close(db);
     return 0;
 
@@ -0,0 +1,66 @@
+#include <stdio.h>
+#include <string.h>
+#include "redis_pool.h"
+
+void redis_pool_init(RedisPool *pool, const char *host, int port, int size) {
+    memset(pool, 0, sizeof(*pool));
+    snprintf(pool->host, sizeof(pool->host), "%s", host);
+    pool->port = port;
+    pool->size = size < 1 ? 1 : size > REDIS_POOL_MAX ? REDIS_POOL_MAX : size;
+    pthread_mutex_init(&pool->lock, NULL);
+    pthread_cond_init(&pool->available, NULL);
+}
+
+// Wait for a free connection, (re)connecting it if needed.
+// Returns NULL when redis cannot be reached, nothing has to be released then
+redisContext *redis_pool_acquire(RedisPool *pool) {
+    pthread_mutex_lock(&pool->lock);
+    int slot;
+    for (;;) {
+        for (slot = 0; slot < pool->size && pool->in_use[slot]; slot++);
+        if (slot < pool->size) break;
+        pthread_cond_wait(&pool->available, &pool->lock);
+    }
+    pool->in_use[slot] = 1;
+    pthread_mutex_unlock(&pool->lock);
+
+    if (!pool->conns[slot]) {
+        redisContext *redis = redisConnect(pool->host, pool->port);
+        if (!redis || redis->err) {
+            fprintf(stderr, "Redis pool connect error: %s\n", redis ? redis->errstr : "NULL");
+            if (redis) redisFree(redis);
+            pthread_mutex_lock(&pool->lock);
+            pool->in_use[slot] = 0;
+            pthread_cond_signal(&pool->available);
+            pthread_mutex_unlock(&pool->lock);
+            return NULL;
+        }
+        pool->conns[slot] = redis;
+    }
+    return pool->conns[slot];
+}
+
+// A connection that failed is dropped and reconnected by the next acquire
+void redis_pool_release(RedisPool *pool, redisContext *redis) {
+    pthread_mutex_lock(&pool->lock);
+    for (int slot = 0; slot < pool->size; slot++) {
+        if (pool->conns[slot] != redis) continue;
+        if (redis->err) {
+            redisFree(redis);
+            pool->conns[slot] = NULL;
+        }
+        pool->in_use[slot] = 0;
+        pthread_cond_signal(&pool->available);
+        break;
+    }
+    pthread_mutex_unlock(&pool->lock);
+}
+
+void redis_pool_destroy(RedisPool *pool) {
+    for (int slot = 0; slot < pool->size; slot++) {
+        if (pool->conns[slot]) redisFree(pool->conns[slot]);
+        pool->conns[slot] = NULL;
+    }
+    pthread_mutex_destroy(&pool->lock);
+    pthread_cond_destroy(&pool->available);
+}
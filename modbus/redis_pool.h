@@ -0,0 +1,26 @@
+#ifndef REDIS_POOL_H
+#define REDIS_POOL_H
+
+#include <pthread.h>
+#include <hiredis/hiredis.h>
+
+#define REDIS_POOL_MAX 16
+
+// Fixed set of redis connections shared by the bus workers. A hiredis context is not
+// thread safe, a worker owns the context it acquired until it releases it.
+typedef struct {
+    char host[64];
+    int port;
+    redisContext *conns[REDIS_POOL_MAX];   // NULL until connected or after an error
+    int in_use[REDIS_POOL_MAX];
+    int size;
+    pthread_mutex_t lock;
+    pthread_cond_t available;
+} RedisPool;
+
+void redis_pool_init(RedisPool *pool, const char *host, int port, int size);
+redisContext *redis_pool_acquire(RedisPool *pool);
+void redis_pool_release(RedisPool *pool, redisContext *redis);
+void redis_pool_destroy(RedisPool *pool);
+
+#endif
@@ -0,0 +1,40 @@
+#include <stdio.h>
+#include <stdlib.h>
+#include "util.h"
+
+int grow_array(void **array, int *capacity, int count, size_t item_size) {
+    if (count < *capacity) return 0;
+    int next = *capacity ? 2 * *capacity : 16;
+    void *grown = realloc(*array, next * item_size);
+    if (!grown) return -1;
+    *array = grown;
+    *capacity = next;
+    return 0;
+}
+
+int table_exists(sqlite3 *db, const char *table) {
+    sqlite3_stmt *stmt;
+    if (sqlite3_prepare_v2(db, "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", -1, &stmt, NULL) != SQLITE_OK)
+        return 0;
+    sqlite3_bind_text(stmt, 1, table, -1, SQLITE_STATIC);
+    int exists = sqlite3_step(stmt) == SQLITE_ROW;
+    sqlite3_finalize(stmt);
+    return exists;
+}
+
+int has_column(sqlite3 *db, const char *table, const char *column) {
+    char sql[128];
+    sqlite3_stmt *stmt;
+    snprintf(sql, sizeof(sql), "SELECT %s FROM %s LIMIT 0", column, table);
+    if (sqlite3_prepare_v2(db, sql, -1, &stmt, NULL) != SQLITE_OK) return 0;
+    sqlite3_finalize(stmt);
+    return 1;
+}
+
+void ensure_column(sqlite3 *db, const char *table, const char *column, const char *definition) {
+    char sql[256];
+    if (has_column(db, table, column)) return;
+    snprintf(sql, sizeof(sql), "ALTER TABLE %s ADD COLUMN %s %s", table, column, definition);
+    if (sqlite3_exec(db, sql, NULL, NULL, NULL) != SQLITE_OK)
+        fprintf(stderr, "Failed to add %s.%s: %s\n", table, column, sqlite3_errmsg(db));
+}
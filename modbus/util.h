@@ -0,0 +1,17 @@
+#ifndef UTIL_H
+#define UTIL_H
+
+#include <stddef.h>
+#include <sqlite3.h>
+
+// Helpers shared by the poller and the historian
+
+// Make room for one more item, doubling the allocation. Returns 0, -1 when out of memory
+int grow_array(void **array, int *capacity, int count, size_t item_size);
+
+int table_exists(sqlite3 *db, const char *table);
+int has_column(sqlite3 *db, const char *table, const char *column);
+// ALTER TABLE ADD COLUMN unless the column exists, a failure is reported on stderr
+void ensure_column(sqlite3 *db, const char *table, const char *column, const char *definition);
+
+#endif
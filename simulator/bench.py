@@ -0,0 +1,363 @@
+# End-to-end load benchmark of the stack against the simulated slaves.
+#
+#   python3 bench.py --devices 6,32,96 --intervals 1,5 --clients 1,16,64 --duration 10
+#
+# For every device count and poll interval a throwaway stack is started in a temp dir:
+# redis-server on a free port (no persistence), modbus_sim.py, the poller built from ../modbus
+# and gunicorn serving ../webserver with the production worker settings. Every client count is
+# then run against /api/readings, /api/iot_data and the write/ack path (/api/update-parameters
+# followed by /api/get-update-status) and throughput and p50/p99 latencies are reported, next
+# to the poller's cycle time taken from its modbus:stats:bus:0 histogram.
+#
+#   python3 bench.py --url http://pi.local --redis pi.local:6379 --clients 1,16
+#
+# benchmarks a running deployment instead (no device/interval sweep, nothing is started). The
+# write scenario rewrites LEVEL_HIGH_IN_PERC_SET of the real sensors, so against --url it only
+# runs when asked for with --scenarios ...,write --allow-writes.
+import argparse
+import http.client
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+import redis
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TANKS = ('overhead1', 'overhead2', 'underground')
+MAX_SLAVEID = 247
+READY_TIMEOUT = 60          # seconds for the poller's first cycles and gunicorn to come up
+
+POLLER_CONFIG = """[modbus]
+{bus}
+
+[redis]
+redis_host=127.0.0.1
+redis_port={redis_port}
+redis_ttl=60
+register_store={register_store}
+keyframe_interval=30
+
+[sqlite]
+db_path={db_path}
+
+[daemon]
+poll_interval={interval}
+log_interval=5
+history_days=0
+debug=0
+"""
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def prepare_db(source, path, devices):
+    # Copy of the database with at least `devices` devices, the extra ones cloned from the
+    # existing devices' types on free slave ids. Returns the device count
+    shutil.copy(source, path)
+    conn = sqlite3.connect(path)
+    rows = conn.execute("SELECT slaveid, devices_type_id, location FROM iotdevices ORDER BY slaveid").fetchall()
+    names = dict(conn.execute("SELECT devices_type_id, devices_type_name FROM iot_devices_types"))
+    taken = {row[0] for row in rows}
+    slaveid = 1
+    for i in range(max(0, devices - len(rows))):
+        while slaveid in taken:
+            slaveid += 1
+        if slaveid > MAX_SLAVEID:
+            break
+        _, type_id, location = rows[i % len(rows)]
+        conn.execute("INSERT INTO iotdevices (slaveid, devices_type_id, devicename, location) VALUES (?, ?, ?, ?)",
+                     (slaveid, type_id, f"Simulated {names.get(type_id)} {slaveid}", location))
+        taken.add(slaveid)
+    conn.commit()
+    conn.close()
+    return len(taken)
+
+
+class Stack:
+    # redis-server, simulator, poller and gunicorn of one device count / poll interval
+
+    def __init__(self, args, devices, interval):
+        self.args = args
+        self.devices = devices
+        self.interval = interval
+        self.processes = []
+
+    def start(self, name, command, **kwargs):
+        log = open(os.path.join(self.dir, f"{name}.log"), 'w')
+        process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, **kwargs)
+        self.processes.append((name, process, log))
+        return process
+
+    def __enter__(self):
+        args = self.args
+        self.dir = tempfile.mkdtemp(prefix='iot-bench-')
+        try:
+            db_path = os.path.join(self.dir, 'iot.db')
+            self.devices = prepare_db(args.db, db_path, self.devices)
+
+            redis_port = free_port()
+            self.start('redis', [args.redis_server, '--port', str(redis_port), '--bind', '127.0.0.1',
+                                 '--save', '', '--appendonly', 'no'])
+            self.redis = redis.Redis(port=redis_port, decode_responses=True)
+
+            simulator = [sys.executable, os.path.join(ROOT, 'simulator', 'modbus_sim.py'), '--db', db_path,
+                         '--latency', str(args.sim_latency)]
+            if args.transport == 'rtu':
+                link = os.path.join(self.dir, 'ttySIM0')
+                simulator += ['--pty', link, '--baud', str(args.baud)]
+                bus = f"type=rtu\ndevice={link}\nbaudrate={args.baud}\nparity=N\ndata_bits=8\nstop_bits=1"
+            else:
+                modbus_port = free_port()
+                simulator += ['--tcp', f"127.0.0.1:{modbus_port}"]
+                bus = f"type=tcp\nhost=127.0.0.1\nport={modbus_port}"
+            self.start('simulator', simulator)
+
+            with open(os.path.join(self.dir, 'config.ini'), 'w') as f:
+                f.write(POLLER_CONFIG.format(bus=bus, redis_port=redis_port, register_store=args.register_store,
+                                             db_path=db_path, interval=self.interval))
+            self.wait(lambda: self.redis.ping(), "redis-server")
+            self.start('poller', [os.path.abspath(args.poller)], cwd=self.dir)
+
+            web_port = free_port()
+            env = dict(os.environ, REDIS_HOST='127.0.0.1', REDIS_PORT=str(redis_port), DB_PATH=db_path)
+            self.start('gunicorn', [sys.executable, '-m', 'gunicorn', '--workers', str(args.workers),
+                                    '--worker-class', 'gthread', '--threads', '256',
+                                    '--bind', f"127.0.0.1:{web_port}", '--chdir', os.path.join(ROOT, 'webserver'),
+                                    'main:app'], env=env)
+            self.url = f"http://127.0.0.1:{web_port}"
+
+            self.wait(lambda: int(self.redis.hget('modbus:stats:bus:0', 'cycles') or 0) >= 2, "poller cycles")
+            self.wait(lambda: HttpClient(self.url).request('GET', '/health')[0] == 200, "gunicorn")
+        except BaseException:
+            self.__exit__(*sys.exc_info())
+            raise
+        return self
+
+    def wait(self, ready, what):
+        deadline = time.monotonic() + READY_TIMEOUT + 3 * self.interval
+        while time.monotonic() < deadline:
+            for name, process, _ in self.processes:
+                if process.poll() is not None:
+                    raise RuntimeError(f"{name} exited with {process.returncode}, see {self.dir}/{name}.log")
+            try:
+                if ready():
+                    return
+            except (redis.exceptions.RedisError, OSError):
+                pass
+            time.sleep(0.2)
+        raise RuntimeError(f"timed out waiting for {what}, logs in {self.dir}")
+
+    def __exit__(self, *exc):
+        for name, process, log in reversed(self.processes):
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+            log.close()
+        if exc[0] is None and not self.args.keep:
+            shutil.rmtree(self.dir, ignore_errors=True)
+        else:
+            print(f"stack files kept in {self.dir}", file=sys.stderr)
+
+
+class HttpClient:
+    # One keep-alive connection per benchmark client
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.conn = None
+
+    def request(self, method, path, body=None):
+        # (status, decoded json) or (None, None) when the request failed
+        try:
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+            headers = {'Content-Type': 'application/json'} if body is not None else {}
+            self.conn.request(method, path, body=json.dumps(body) if body is not None else None, headers=headers)
+            response = self.conn.getresponse()
+            data = response.read()
+            return response.status, json.loads(data) if data else None
+        except (OSError, http.client.HTTPException, ValueError):
+            if self.conn is not None:
+                self.conn.close()
+            self.conn = None
+            return None, None
+
+
+# Scenarios: one request (or request pair) of client n, iteration i. True if it succeeded
+def readings(client, n, i):
+    status, _ = client.request('GET', f"/api/readings?tank={TANKS[(n + i) % len(TANKS)]}")
+    return status == 200
+
+def iot_data(client, n, i):
+    status, _ = client.request('GET', '/api/iot_data')
+    return status == 200
+
+def write(client, n, i):
+    # Toggle the high level setting of one tank and wait for the poller's acks
+    tank = TANKS[n % len(TANKS)]
+    status, values = client.request('GET', f"/api/parameters?tank={tank}")
+    if status != 200:
+        return False
+    body = {field: values.get(field) for field in ('zeroPf', 'fullPf', 'levelFullMm', 'levelLowSet')}
+    body.update(tank=tank, levelHighSet=85 + (n + i) % 2)
+    status, queued = client.request('POST', '/api/update-parameters', body)
+    if status != 200 or queued.get('status') != 'ok':
+        return False
+    if not queued['queued']:
+        return True
+    status, result = client.request('GET', f"/api/get-update-status?id={queued['id']}&count={queued['queued']}")
+    return status == 200 and result.get('status') != 'Failed'
+
+SCENARIOS = {'readings': readings, 'iot_data': iot_data, 'write': write}
+READ_ONLY_SCENARIOS = ('readings', 'iot_data')
+
+
+def percentile(values, q):
+    # nearest rank of a sorted list
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def run_clients(url, scenario, clients, duration):
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client_loop(n):
+        client = HttpClient(url)
+        own, failed, i = [], 0, 0
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            ok = SCENARIOS[scenario](client, n, i)
+            own.append(time.perf_counter() - started)
+            failed += not ok
+            i += 1
+        with lock:
+            latencies.extend(own)
+            errors[0] += failed
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=client_loop, args=(n,)) for n in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'rps': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 0.50) * 1000 if latencies else None,
+        'p99_ms': percentile(latencies, 0.99) * 1000 if latencies else None,
+    }
+
+
+def poller_stats(client):
+    try:
+        return client.hgetall('modbus:stats:bus:0') if client else {}
+    except redis.exceptions.RedisError:
+        return {}
+
+def cycle_times(before, after):
+    # Mean and bucket-bound p99 (ms) of the bus 0 poll cycles between two stats snapshots
+    delta = lambda field: int(after.get(field, 0)) - int(before.get(field, 0))
+    count = delta('cycle_ms_count')
+    if count <= 0:
+        return None, None
+    buckets = sorted((int(field.rpartition('_le_')[2]), delta(field))
+                     for field in after if field.startswith('cycle_ms_le_'))
+    p99 = next((bound for bound, observed in buckets if observed >= 0.99 * count), None)
+    return delta('cycle_ms_sum') / count, p99
+
+
+def fmt(value, digits=1):
+    return '-' if value is None else f"{value:.{digits}f}"
+
+def report(row):
+    print(f"{row['devices']:>7} {row['interval']:>8} {row['clients']:>7} {row['scenario']:>9} "
+          f"{row['requests']:>8} {row['errors']:>6} {fmt(row['rps']):>8} {fmt(row['p50_ms'], 2):>9} "
+          f"{fmt(row['p99_ms'], 2):>9} {fmt(row['cycle_ms']):>9} {fmt(row['cycle_p99_ms'], 0):>9}", flush=True)
+
+def sweep(url, stats, devices, interval, args, results):
+    for clients in args.clients:
+        for scenario in args.scenarios:
+            before = poller_stats(stats)
+            result = run_clients(url, scenario, clients, args.duration)
+            cycle_ms, cycle_p99 = cycle_times(before, poller_stats(stats))
+            row = dict(devices=devices, interval=interval, clients=clients, scenario=scenario,
+                       cycle_ms=cycle_ms, cycle_p99_ms=cycle_p99, **result)
+            results.append(row)
+            report(row)
+
+
+def int_list(text):
+    return [int(item) for item in text.split(',') if item]
+
+def main():
+    parser = argparse.ArgumentParser(description="Load benchmark of the web tier and poller against simulated slaves")
+    parser.add_argument('--devices', type=int_list, default=[6, 32, 96], help="device counts to sweep")
+    parser.add_argument('--intervals', type=int_list, default=[1, 5], help="poll intervals (s) to sweep")
+    parser.add_argument('--clients', type=int_list, default=[1, 16, 64], help="concurrent HTTP clients to sweep")
+    parser.add_argument('--scenarios', help="readings, iot_data and/or write (default: all, read-only with --url)")
+    parser.add_argument('--duration', type=float, default=10, help="seconds per client count and scenario")
+    parser.add_argument('--transport', choices=('tcp', 'rtu'), default='tcp', help="how the poller reaches the slaves")
+    parser.add_argument('--baud', type=int, default=9600, help="emulated RTU line speed")
+    parser.add_argument('--sim-latency', type=float, default=0, help="extra slave response delay (ms)")
+    parser.add_argument('--register-store', default='block', help="poller register_store setting")
+    parser.add_argument('--workers', type=int, default=2, help="gunicorn workers")
+    parser.add_argument('--db', default=os.path.join(ROOT, 'modbus', 'db', 'iot.db'), help="database to clone devices from")
+    parser.add_argument('--poller', default=os.path.join(ROOT, 'modbus', 'modbus_to_redis'), help="built poller binary")
+    parser.add_argument('--redis-server', default='redis-server', help="redis-server binary of the throwaway redis")
+    parser.add_argument('--url', help="benchmark this running web tier instead of starting stacks")
+    parser.add_argument('--allow-writes', action='store_true',
+                        help="let the write scenario change the sensor settings of the --url deployment")
+    parser.add_argument('--redis', help="host:port of the running deployment's redis, for the poller stats")
+    parser.add_argument('--json', help="also write the results to this file")
+    parser.add_argument('--keep', action='store_true', help="keep the stacks' temp dirs and logs")
+    args = parser.parse_args()
+    if args.scenarios is None:
+        args.scenarios = ','.join(READ_ONLY_SCENARIOS if args.url else SCENARIOS)
+    args.scenarios = [name for name in args.scenarios.split(',') if name]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    if args.url and 'write' in args.scenarios and not args.allow_writes:
+        parser.error("the write scenario changes real sensor settings of --url, add --allow-writes to run it")
+
+    print(f"{'devices':>7} {'interval':>8} {'clients':>7} {'scenario':>9} {'requests':>8} {'errors':>6} "
+          f"{'req/s':>8} {'p50 ms':>9} {'p99 ms':>9} {'cycle ms':>9} {'cycle p99':>9}", flush=True)
+    results = []
+    if args.url:
+        stats = None
+        if args.redis:
+            host, _, port = args.redis.rpartition(':')
+            stats = redis.Redis(host=host, port=int(port), decode_responses=True)
+        sweep(args.url, stats, '-', '-', args, results)
+    else:
+        for devices in args.devices:
+            for interval in args.intervals:
+                with Stack(args, devices, interval) as stack:
+                    sweep(stack.url, stack.redis, stack.devices, interval, args, results)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,336 @@
+# Simulated Modbus slave farm for running the stack without the RS-485 sensors.
+#
+# Every row of iotdevices becomes a slave serving the register layout of its type
+# (iot_devices_types.register_list and sensor_data_register_mapping), over Modbus TCP
+# (one gateway for all slave ids) and/or an RTU pty pair the poller opens like /dev/ttyS1:
+#
+#   python3 modbus_sim.py --db ../modbus/db/iot.db --tcp 0.0.0.0:1502
+#   python3 modbus_sim.py --db ../modbus/db/iot.db --pty /tmp/ttySIM0 --baud 9600
+#
+# Live values (levels, temperatures, wind) random-walk every --tick seconds, the settings
+# keep whatever the poller writes, so the write/ack path behaves like the real sensors.
+import argparse
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import struct
+import sys
+import termios
+import tty
+
+READ_HOLDING = 3
+READ_INPUT = 4
+WRITE_SINGLE = 6
+WRITE_MULTIPLE = 16
+
+ILLEGAL_FUNCTION = 1
+ILLEGAL_ADDRESS = 2
+GATEWAY_TARGET_FAILED = 0x0B
+
+MAX_READ_COUNT = 125
+
+# Physical value of the settings and other static parameters, by parameter_name
+STATIC_VALUES = {
+    'BAUD_RATE_INDEX': 3,
+    'CAP_LEVEL_ZERO_PF': 50.0,
+    'CAP_LEVEL_FULL_PF': 250.0,
+    'LEVEL_FULL_MM': 1000.0,
+    'OSC_RES1_VAL': 10000,
+    'OSC_RES2_VAL': 10000,
+    'OSC_K_VAL': 0.693,
+    'LEVEL_HIGH_IN_PERC_SET': 90.0,
+    'LEVEL_LOW_IN_PERC_SET': 10.0,
+    'FREQUENCY': 1000,
+    'MM_RAIN_PER_TIP': 0.2794,
+    'RTC_BAT_VCC_MV': 3000,
+    'TMP_SENSOR_FOUND': 1,
+    'DS18B20_COUNT': 1,
+    'DS18B20_ROM': 0x28FF4C1A0316034E,
+}
+
+# Live parameters: (low, high, largest step per tick), physical units
+RANDOM_WALKS = {
+    'Wind Speed': (0.0, 15.0, 0.5),
+    'Wind Level': (0, 7, 1),
+    'Wind Direction Angle': (0, 359, 10),
+    'Wind Direction': (0, 7, 1),
+    'MM_RAIN_PER_HOUR': (0.0, 5.0, 0.1),
+    'MM_RAIN_PER_DAY': (0.0, 50.0, 0.2),
+    'TEMPERATURE': (20.0, 35.0, 0.2),
+    'HUMIDITY': (40.0, 95.0, 0.5),
+    'LEVEL_IN_MM': (60.0, 1000.0, 8.0),   # firmware adds LEVEL_SENSOR_OFFSET (10 mm)
+    'LIQUID_TEMP': (35.0, 40.0, 0.1),     # +10 °C offset as well
+}
+
+
+class Slave:
+    # Registers of one simulated device plus the mapping used to fill and animate them
+
+    def __init__(self, slaveid, register_count, channels):
+        self.slaveid = slaveid
+        self.register_count = register_count
+        self.channels = channels        # [{parameter_name: (address, count, data_type, divisor)}]
+        self.registers = {}             # address -> uint16, unmapped addresses read as 0
+        self.requests = 0
+        for channel in channels:
+            for name, entry in channel.items():
+                if name == 'SLAVEID':
+                    self.set(entry, slaveid)
+                elif name in STATIC_VALUES:
+                    self.set(entry, STATIC_VALUES[name])
+                elif name in RANDOM_WALKS:
+                    low, high, step = RANDOM_WALKS[name]
+                    self.set(entry, random.uniform(low, high))
+        self.update_level_sensors()
+
+    def get(self, entry):
+        address, count, data_type, divisor = entry
+        value = 0
+        for k in reversed(range(count)):      # LSB word first, like the sensors
+            value = value << 16 | self.registers.get(address + k, 0)
+        if data_type != 'hex' and not data_type.startswith('uint') and value >> (16 * count - 1):
+            value -= 1 << (16 * count)
+        return value / divisor
+
+    def set(self, entry, value):
+        address, count, data_type, divisor = entry
+        raw = int(round(value * divisor)) & ((1 << (16 * count)) - 1)
+        for k in range(count):
+            self.registers[address + k] = raw >> (16 * k) & 0xFFFF
+
+    def tick(self):
+        for channel in self.channels:
+            for name, entry in channel.items():
+                if name in RANDOM_WALKS:
+                    low, high, step = RANDOM_WALKS[name]
+                    value = self.get(entry) + random.uniform(-step, step)
+                    self.set(entry, min(high, max(low, value)))
+        self.update_level_sensors()
+
+    def update_level_sensors(self):
+        # Capacitance and alarm flags follow the level the way the level sensor firmware does
+        for channel in self.channels:
+            if 'LEVEL_IN_MM' not in channel or 'CAP_PF' not in channel:
+                continue
+            full = self.get(channel['LEVEL_FULL_MM']) if 'LEVEL_FULL_MM' in channel else 0
+            zero = self.get(channel['CAP_LEVEL_ZERO_PF']) if 'CAP_LEVEL_ZERO_PF' in channel else 0
+            full_pf = self.get(channel['CAP_LEVEL_FULL_PF']) if 'CAP_LEVEL_FULL_PF' in channel else 0
+            level = self.get(channel['LEVEL_IN_MM']) - 10
+            pct = level * 100 / full if full > 0 else 0
+            self.set(channel['CAP_PF'], zero + (full_pf - zero) * max(0.0, min(pct, 100.0)) / 100)
+            if 'ALARM_LEVEL_HIGH' in channel and 'LEVEL_HIGH_IN_PERC_SET' in channel:
+                self.set(channel['ALARM_LEVEL_HIGH'], pct >= self.get(channel['LEVEL_HIGH_IN_PERC_SET']))
+            if 'ALARM_LEVEL_LOW' in channel and 'LEVEL_LOW_IN_PERC_SET' in channel:
+                self.set(channel['ALARM_LEVEL_LOW'], pct <= self.get(channel['LEVEL_LOW_IN_PERC_SET']))
+
+
+def load_slaves(db_path):
+    # {slaveid: Slave} for every device of the database, same channel rule as the web tier:
+    # a parameter name seen again in a type's mapping starts the next sensor channel
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    conn.row_factory = sqlite3.Row
+    plans = {}
+    for row in conn.execute("""
+        SELECT devices_type_id, parameter_name, register_address, register_count, data_type, decimal_shift
+        FROM sensor_data_register_mapping ORDER BY devices_type_id, mapid
+    """):
+        channels = plans.setdefault(row['devices_type_id'], [])
+        channel = next((c for c in channels if row['parameter_name'] not in c), None)
+        if channel is None:
+            channel = {}
+            channels.append(channel)
+        channel[row['parameter_name']] = (row['register_address'], row['register_count'],
+                                          (row['data_type'] or '').lower(), 10 ** row['decimal_shift'])
+    sizes = {}
+    for row in conn.execute("SELECT devices_type_id, register_list FROM iot_devices_types"):
+        try:
+            sizes[row['devices_type_id']] = max(g['address'] + g['count'] for g in json.loads(row['register_list']))
+        except (TypeError, ValueError, KeyError):
+            sizes[row['devices_type_id']] = 0
+    slaves = {row['slaveid']: Slave(row['slaveid'], sizes.get(row['devices_type_id'], 0),
+                                    plans.get(row['devices_type_id'], []))
+              for row in conn.execute("SELECT slaveid, devices_type_id FROM iotdevices")}
+    conn.close()
+    return slaves
+
+
+def exception(function, code):
+    return bytes((function | 0x80, code))
+
+def handle_pdu(slave, pdu):
+    # Response PDU to a request PDU of one slave
+    slave.requests += 1
+    function = pdu[0]
+    if function in (READ_HOLDING, READ_INPUT) and len(pdu) == 5:
+        address, count = struct.unpack('>HH', pdu[1:5])
+        if not 1 <= count <= MAX_READ_COUNT or address + count > 0x10000:
+            return exception(function, ILLEGAL_ADDRESS)
+        values = [slave.registers.get(a, 0) for a in range(address, address + count)]
+        return struct.pack(f'>BB{count}H', function, 2 * count, *values)
+    if function == WRITE_SINGLE and len(pdu) == 5:
+        address, value = struct.unpack('>HH', pdu[1:5])
+        slave.registers[address] = value
+        slave.update_level_sensors()
+        return pdu
+    if function == WRITE_MULTIPLE and len(pdu) >= 6:
+        address, count, size = struct.unpack('>HHB', pdu[1:6])
+        if size != 2 * count or len(pdu) != 6 + size:
+            return exception(function, ILLEGAL_ADDRESS)
+        for k, value in enumerate(struct.unpack(f'>{count}H', pdu[6:])):
+            slave.registers[address + k] = value
+        slave.update_level_sensors()
+        return pdu[:5]
+    return exception(function, ILLEGAL_FUNCTION)
+
+
+class Farm:
+    def __init__(self, slaves, latency, drop):
+        self.slaves = slaves
+        self.latency = latency      # seconds added to every response
+        self.drop = drop            # probability of not answering, the poller sees a timeout
+
+    def respond(self, unit, pdu):
+        # None: the slave stays silent
+        slave = self.slaves.get(unit)
+        if slave is None or random.random() < self.drop:
+            return None
+        return handle_pdu(slave, pdu)
+
+
+# Modbus TCP: MBAP header + PDU, unit id selects the slave like behind a TCP gateway
+async def serve_tcp_client(farm, reader, writer):
+    try:
+        while True:
+            header = await reader.readexactly(7)
+            transaction, protocol, length, unit = struct.unpack('>HHHB', header)
+            pdu = await reader.readexactly(length - 1)
+            response = farm.respond(unit, pdu)
+            if farm.latency:
+                await asyncio.sleep(farm.latency)
+            if response is None:
+                if unit not in farm.slaves:
+                    response = exception(pdu[0], GATEWAY_TARGET_FAILED)
+                else:
+                    continue
+            writer.write(struct.pack('>HHHB', transaction, protocol, len(response) + 1, unit) + response)
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+# Modbus RTU over a pty: the poller opens the symlinked slave side as its serial device
+def crc16(frame):
+    crc = 0xFFFF
+    for byte in frame:
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+    return crc
+
+def rtu_frame_length(buffer):
+    # Length of the request at the start of buffer, None until enough bytes arrived
+    if len(buffer) < 2:
+        return None
+    if buffer[1] == WRITE_MULTIPLE:
+        return 9 + buffer[6] if len(buffer) >= 7 else None
+    return 8
+
+class RtuLine:
+    def __init__(self, farm, link, baud):
+        self.farm = farm
+        self.baud = baud            # 0: answer immediately, else wait the frames' time on the wire
+        self.buffer = bytearray()
+        self.master, self.slave_fd = os.openpty()
+        tty.setraw(self.slave_fd)
+        attrs = termios.tcgetattr(self.master)
+        attrs[3] &= ~termios.ECHO
+        termios.tcsetattr(self.master, termios.TCSANOW, attrs)
+        self.link = link
+        if os.path.lexists(link):
+            os.unlink(link)
+        os.symlink(os.ttyname(self.slave_fd), link)
+        os.set_blocking(self.master, False)
+
+    def start(self, loop):
+        loop.add_reader(self.master, self.on_readable, loop)
+
+    def on_readable(self, loop):
+        try:
+            self.buffer += os.read(self.master, 512)
+        except BlockingIOError:
+            return
+        while True:
+            length = rtu_frame_length(self.buffer)
+            if length is None or len(self.buffer) < length:
+                return
+            frame, self.buffer = bytes(self.buffer[:length]), self.buffer[length:]
+            if crc16(frame[:-2]) != struct.unpack('<H', frame[-2:])[0]:
+                self.buffer.clear()     # out of sync, wait for the master to retry
+                return
+            response = self.farm.respond(frame[0], frame[1:-2]) if frame[0] else None
+            if response is None:
+                continue
+            reply = bytes((frame[0],)) + response
+            reply += struct.pack('<H', crc16(reply))
+            delay = self.farm.latency + (10 * (len(frame) + len(reply)) / self.baud if self.baud else 0)
+            loop.call_later(delay, os.write, self.master, reply)
+
+    def close(self):
+        if os.path.islink(self.link):
+            os.unlink(self.link)
+
+
+async def animate(slaves, interval):
+    while True:
+        await asyncio.sleep(interval)
+        for slave in slaves.values():
+            slave.tick()
+
+
+def parse_address(text):
+    host, _, port = text.rpartition(':')
+    return host or '0.0.0.0', int(port)
+
+async def main():
+    parser = argparse.ArgumentParser(description="Simulated Modbus slaves for every device of the database")
+    parser.add_argument('--db', default='/data/iot.db', help="iot.db with the devices to simulate")
+    parser.add_argument('--tcp', help="serve Modbus TCP on [host:]port")
+    parser.add_argument('--pty', help="serve Modbus RTU on a pty, symlinked to this path")
+    parser.add_argument('--baud', type=int, default=9600, help="emulated line speed of the pty, 0 for none")
+    parser.add_argument('--latency', type=float, default=0, help="extra response delay (ms)")
+    parser.add_argument('--drop', type=float, default=0, help="fraction of requests left unanswered")
+    parser.add_argument('--tick', type=float, default=1, help="seconds between live value updates")
+    args = parser.parse_args()
+    if not args.tcp and not args.pty:
+        parser.error("nothing to serve, give --tcp and/or --pty")
+
+    slaves = load_slaves(args.db)
+    farm = Farm(slaves, args.latency / 1000, args.drop)
+    loop = asyncio.get_running_loop()
+    tasks = [asyncio.create_task(animate(slaves, args.tick))]
+    line = None
+    if args.pty:
+        line = RtuLine(farm, args.pty, args.baud)
+        line.start(loop)
+        print(f"RTU slaves on {args.pty} -> {os.ttyname(line.slave_fd)}", flush=True)
+    if args.tcp:
+        host, port = parse_address(args.tcp)
+        server = await asyncio.start_server(lambda r, w: serve_tcp_client(farm, r, w), host, port)
+        tasks.append(asyncio.create_task(server.serve_forever()))
+        print(f"Modbus TCP gateway on {host}:{port}", flush=True)
+    print(f"Simulating slaves {sorted(slaves)}", flush=True)
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        if line:
+            line.close()
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        sys.exit(0)
@@ -1,111 +1,370 @@
-from flask import Flask, request, render_template, jsonify
+from flask import Flask, request, render_template, jsonify, Response, g
 import sqlite3
 import random
 import redis
-from enum import Enum
+from collections import namedtuple
 import time
+import json
+import queue
+import threading
+import struct
+import sys
+import os
+import hashlib
+import math
+import uuid
+from array import array
+
+# Decoded LIQUID_TEMP reported when the temperature probe is missing (raw 5010)
+TEMPERATURE_ERROR_VALUE=501.0
+# Level (mm) and temperature (°C) of the level sensor firmware are offset by +10
+LEVEL_SENSOR_OFFSET=10
+
+# Tank -> (iotdevices.devicename prefix, sensor channel of that device). The slave id is
+# looked up in the device registry, see get_tank_channels()
+TANK_SENSORS = {
+    'overhead1': ('Overhead', 0),
+    'overhead2': ('Overhead', 1),
+    'underground': ('Underground', 0),
+}
+TANKS = tuple(TANK_SENSORS)
+# mapping parameter every level sensor channel has
+TANK_LEVEL_PARAMETER = 'LEVEL_IN_MM'
+
+# /api/update-parameters form field -> sensor_data_register_mapping parameter
+LEVEL_SENSOR_SETTINGS = {
+    'zeroPf': 'CAP_LEVEL_ZERO_PF',
+    'fullPf': 'CAP_LEVEL_FULL_PF',
+    'levelFullMm': 'LEVEL_FULL_MM',
+    'levelHighSet': 'LEVEL_HIGH_IN_PERC_SET',
+    'levelLowSet': 'LEVEL_LOW_IN_PERC_SET',
+}
+LEVEL_SENSOR_ADVANCED_SETTINGS = {
+    'oscRes1': 'OSC_RES1_VAL',
+    'oscRes2': 'OSC_RES2_VAL',
+    'oscKVal': 'OSC_K_VAL',
+}
 
-TEMPERATURE_ERROR_VALUE=5010
-
-class SENS_PARAM_POS(Enum):
-    CAP_LEVEL_ZERO_PF       = 0        # cap_level_zero_pf
-    CAP_LEVEL_FULL_PF       = 1        # cap_level_full_pf
-    LEVEL_FULL_MM           = 2        # level full mm
-    OSC_RES1_VAL_LSB        = 3         # osc_res1_val_lsb
-    OSC_RES1_VAL_MSB        = 4         # osc_res1_val_msb
-    OSC_RES2_VAL_LSB        = 5         # osc_res2_val_lsb
-    OSC_RES2_VAL_MSB        = 6         # osc_res2_val_msb
-    OSC_K_VAL               = 7                # osc_k_val
-    LEVEL_HIGH_IN_PERC_SET  = 8   # level_high_in_perc_set
-    LEVEL_LOW_IN_PERC_SET   = 9    # level_low_in_perc_set    
-    SENS_PARAM_COUNT        = 10        # total count
-    
-class SENS_DATA_POS(Enum):
-    LEVEL_IN_MM         = 0         # level_in_mm
-    CAP_PF              = 1              # cap_pf
-    FREQUENCY_LSB       = 2       # frequency_lsb
-    FREQUENCY_MSB       = 3       # frequency_msb
-    LIQUID_TEMP         = 4         # liquid_temp    
-    ALARM_LEVEL_LOW     = 5     # level_alarm_low
-    ALARM_LEVEL_HIGH    = 6    # level_alarm_high
-    SENS_DATA_COUNT     = 7     # total number of data fields
-
-class holding_registers(Enum):
-    SLAVEID                 = 0
-    BAUDRATE                = 1
-    SENSOR1_CONFIG          = 2
-    SENSOR2_CONFIG          = SENSOR1_CONFIG    + SENS_PARAM_POS.SENS_PARAM_COUNT.value
-    SENSOR1_DATA            = SENSOR2_CONFIG    + SENS_PARAM_POS.SENS_PARAM_COUNT.value
-    SENSOR2_DATA            = SENSOR1_DATA      + SENS_DATA_POS.SENS_DATA_COUNT.value  
-    
 app = Flask(__name__)
 
-# Redis connection
-r = redis.Redis(host='redis', port=6379, decode_responses=True)
+# Redis connection, REDIS_HOST/REDIS_PORT point a local run (simulator/bench.py) elsewhere
+REDIS_HOST = os.environ.get('REDIS_HOST', 'redis')
+REDIS_PORT = int(os.environ.get('REDIS_PORT', 6379))
+WRITE_QUEUE = "modbus:writequeue"   # pending register writes, "slaveid:address:value:request_id"
+WRITE_ACK_KEY = "modbus:ack:{}"     # poller RPUSHes "address:OK|ERROR|SUPERSEDED" per write of a request
+WRITE_ACK_TIMEOUT = 15              # seconds
+WRITE_ACK_POLL_INTERVAL = 0.2       # seconds between reads of the ack list
+# Explicit bounded pools shared by every request thread of a worker: a burst of requests
+# waits up to REDIS_POOL_TIMEOUT for a free connection instead of opening a socket each
+REDIS_POOL_SIZE = 64
+REDIS_POOL_TIMEOUT = 5              # seconds
+r = redis.Redis(connection_pool=redis.BlockingConnectionPool(
+    host=REDIS_HOST, port=REDIS_PORT, decode_responses=True, max_connections=REDIS_POOL_SIZE, timeout=REDIS_POOL_TIMEOUT))
+# binary-safe client for the packed modbus:{slave}:block snapshots
+r_bin = redis.Redis(connection_pool=redis.BlockingConnectionPool(
+    host=REDIS_HOST, port=REDIS_PORT, max_connections=REDIS_POOL_SIZE, timeout=REDIS_POOL_TIMEOUT))
+
+# Micro-cache of computed responses. Identical requests within RESPONSE_CACHE_TTL share one
+# computation; concurrent misses of a key wait for the first one instead of all reading redis.
+# Expired entries and their locks are purged every TTL and the number of keys is capped, a
+# miss beyond the cap is computed without caching
+RESPONSE_CACHE_TTL = 1.0            # seconds, well below the poll interval
+RESPONSE_CACHE_MAX_KEYS = 256
+response_cache = {}                 # key -> (expires monotonic, value)
+response_cache_locks = {}           # key -> lock held while the value is computed
+response_cache_lock = threading.Lock()
+response_cache_purged = 0.0         # monotonic time of the last purge
+
+def purge_response_cache(now):
+    # caller holds response_cache_lock
+    global response_cache_purged
+    response_cache_purged = now
+    for key, entry in list(response_cache.items()):
+        if entry[0] <= now:
+            response_cache.pop(key, None)
+    for key, lock in list(response_cache_locks.items()):
+        if key not in response_cache and not lock.locked():
+            del response_cache_locks[key]
+
+def cached_response(key, compute):
+    entry = response_cache.get(key)
+    now = time.monotonic()
+    if entry is not None and entry[0] > now:
+        return entry[1]
+    with response_cache_lock:
+        if now - response_cache_purged >= RESPONSE_CACHE_TTL or len(response_cache_locks) >= RESPONSE_CACHE_MAX_KEYS:
+            purge_response_cache(now)
+        key_lock = response_cache_locks.get(key)
+        if key_lock is None and len(response_cache_locks) < RESPONSE_CACHE_MAX_KEYS:
+            key_lock = response_cache_locks[key] = threading.Lock()
+    if key_lock is None:
+        return compute()
+    with key_lock:
+        entry = response_cache.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+        value = compute()
+        response_cache[key] = (time.monotonic() + RESPONSE_CACHE_TTL, value)
+        return value
+
+def store_response(key, value):
+    if key in response_cache or len(response_cache) < RESPONSE_CACHE_MAX_KEYS:
+        response_cache[key] = (time.monotonic() + RESPONSE_CACHE_TTL, value)
+
+# modbus:{slave}:block header written by the poller (register_store=block|both)
+REGISTER_BLOCK_HEADER = struct.Struct('<IQH')   # poll cycle, poll time (ms), register count
 
 # SQLite connection
+DB_PATH = os.environ.get('DB_PATH', '/data/iot.db')
+
 def get_db_connection():
-    conn = sqlite3.connect('/data/iot.db')
+    conn = sqlite3.connect(DB_PATH)
     conn.row_factory = sqlite3.Row
     return conn
 
-def is_number(val):
-    if val is None:
-        return False
+# Device configuration (iotdevices, mappings) is read through one shared read-only connection
+# and cached per worker. PRAGMA data_version of that connection changes whenever another
+# connection commits to the database, which invalidates every cached entry.
+config_db = None
+config_db_lock = threading.Lock()
+config_cache = {}              # name -> (data_version, value)
+
+def cached_config(name, loader):
+    # loader(conn) result, reloaded only after the database changed
+    global config_db
+    with config_db_lock:
+        try:
+            if config_db is None:
+                config_db = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True, check_same_thread=False)
+                config_db.row_factory = sqlite3.Row
+            version = config_db.execute("PRAGMA data_version").fetchone()[0]
+            cached = config_cache.get(name)
+            if cached is None or cached[0] != version:
+                cached = config_cache[name] = (version, loader(config_db))
+            return cached[1]
+        except sqlite3.Error:
+            if config_db is not None:
+                config_db.close()
+            config_db = None
+            config_cache.clear()
+            raise
+
+def parse_number(val):
+    # Finite float of a request value, None when it is missing, not a number, nan or inf
     try:
-        float(val)
-        return True
-    except ValueError:
-        return False       
+        val = float(val)
+    except (TypeError, ValueError):
+        return None
+    return val if math.isfinite(val) else None
     
-def string_to_number(val):
-    return float(val) if '.' in val else int(val)
-    
-def string_to_int_by10_negated(val):
-    val= string_to_number(val) if is_number(val) else 0   
-    val=round((val/10 )-10 ,1)  
-    return val
-    
-def string_to_int(val):
-    val= string_to_number(val) if is_number(val) else 0    
-    return val
-def string_to_int_by10(val):
-    val= round(string_to_number(val)/10,1) if is_number(val) else 0    
-    return val
-def string_to_int_by1000(val):
-    val= round(string_to_number(val)/1000,4) if is_number(val) else 0    
-    return val
+def decodeRegisterBlock(blob):
+    # Returns (poll cycle, poll time ms, array of uint16 registers)
+    cycle, polled_ms, count = REGISTER_BLOCK_HEADER.unpack_from(blob)
+    registers = array('H')
+    registers.frombytes(blob[REGISTER_BLOCK_HEADER.size:REGISTER_BLOCK_HEADER.size + 2 * count])
+    if sys.byteorder == 'big':
+        registers.byteswap()
+    return cycle, polled_ms, registers
 
-    
-def string_to_intX10(val):
-    val= string_to_number(val)*10 if is_number(val) else 0    
-    return val
-def string_to_intX1000(val):
-    val= string_to_number(val)*1000 if is_number(val) else 0    
-    return val
-    
-def denormalize_data(val):
-    val= string_to_number(val)*10 if is_number(val) else 0    
-    return val
-    
-def getRegisterValue (slaveid,registeradress):
-    return r.get(f"modbus:{slaveid}:reg{registeradress}")
-    #try:
-    #    value = r.get(f"modbus:{slaveid}:reg{registeradress}")
-     #   return value
-    #except redis.exceptions.ConnectionError:
-    #    return None  # Redis not running / not reachable
-
-def check_redis_alive():
+def getRegisterSnapshots(addresses):
+    # Fetch the given registers of several devices, {slaveid: [register_address, ...]},
+    # in a single round trip. The packed per-device block is preferred, it always comes
+    # from one poll cycle; the per-register keys are read in the same pipeline as a fallback.
+    # Returns {slaveid: {register_address: int value or None}}
+    pipe = r_bin.pipeline(transaction=False)
+    for slaveid, device_addresses in addresses.items():
+        pipe.get(f"modbus:{slaveid}:block")
+        pipe.mget([f"modbus:{slaveid}:reg{address}" for address in device_addresses])
+    replies = pipe.execute()
+    snapshots = {}
+    for i, (slaveid, device_addresses) in enumerate(addresses.items()):
+        blob, values = replies[2 * i], replies[2 * i + 1]
+        if blob is not None:
+            registers = decodeRegisterBlock(blob)[2]
+            snapshots[slaveid] = {address: registers[address] if address < len(registers) else None
+                                  for address in device_addresses}
+        else:
+            snapshots[slaveid] = {address: int(value) if value is not None else None
+                                  for address, value in zip(device_addresses, values)}
+    return snapshots
+
+def getDeviceRegisters(devices):
+    # Whole register block of every device in one pipelined round trip, block preferred
+    # over the per-register keys as in getRegisterSnapshots.
+    # Returns {slaveid: sequence of register values, None where a key is missing}
+    pipe = r_bin.pipeline(transaction=False)
+    for device in devices:
+        pipe.get(f"modbus:{device.slaveid}:block")
+        pipe.mget([f"modbus:{device.slaveid}:reg{address}" for address in range(max(device.register_count, 1))])
+    replies = pipe.execute()
+    registers = {}
+    for i, device in enumerate(devices):
+        blob, values = replies[2 * i], replies[2 * i + 1]
+        if blob is not None:
+            registers[device.slaveid] = decodeRegisterBlock(blob)[2]
+        else:
+            registers[device.slaveid] = [int(value) if value is not None else None for value in values]
+    return registers
+
+# Register decode engine
+# Every sensor_data_register_mapping row of a device type is compiled once into a decoder
+# entry; decoding a device is then a single pass of its plan over the register snapshot.
+# A parameter name repeated within a type (the two sensors of a level sensor device) opens
+# a new channel: channel 0 holds the first occurrence, channel 1 the second, ...
+DecoderEntry = namedtuple('DecoderEntry', 'name channel address count decode divisor unit')
+DeviceDecoder = namedtuple('DeviceDecoder', 'slaveid devicename devices_type_id register_count plan channels')
+
+def decode_int16(registers, address, count):
+    value = registers[address]
+    return value - 0x10000 if value & 0x8000 else value
+
+def decode_uint16(registers, address, count):
+    return registers[address]
+
+def decode_int32(registers, address, count):
+    # LSB word first
+    value = registers[address + 1] << 16 | registers[address]
+    return value - 0x100000000 if value & 0x80000000 else value
+
+def decode_uint32(registers, address, count):
+    return registers[address + 1] << 16 | registers[address]
+
+def decode_hex(registers, address, count):
+    return ''.join(f"{registers[k]:04X}" for k in range(address, address + count))
+
+def decoder_for(data_type, count):
+    # Same rules as the poller's historian: int*/uint* by register count, hex as a string
+    data_type = (data_type or '').lower()
+    if data_type == 'hex':
+        return decode_hex
+    if data_type.startswith('uint'):
+        return decode_uint32 if count > 1 else decode_uint16
+    return decode_int32 if count > 1 else decode_int16
+
+def register_block_size(register_list):
+    # Registers per device in the poller's block, the register groups laid out back to back
     try:
-        r.set("health_check_key", "1")
-        return True
-    except redis.exceptions.ConnectionError:
-        return False
+        return sum(group['count'] for group in json.loads(register_list))
+    except (TypeError, ValueError, KeyError):
+        return 0
+
+def load_device_registry(conn):
+    # {slaveid: DeviceDecoder} compiled from iotdevices, iot_devices_types and the mappings
+    plans = {}
+    for row in conn.execute("""
+        SELECT devices_type_id, parameter_name, register_address, register_count, data_type, decimal_shift, unit
+        FROM sensor_data_register_mapping ORDER BY devices_type_id, mapid
+    """):
+        channels = plans.setdefault(row['devices_type_id'], [])
+        channel = next((i for i, names in enumerate(channels) if row['parameter_name'] not in names), len(channels))
+        if channel == len(channels):
+            channels.append({})
+        channels[channel][row['parameter_name']] = DecoderEntry(
+            row['parameter_name'], channel, row['register_address'], row['register_count'],
+            decoder_for(row['data_type'], row['register_count']), 10 ** row['decimal_shift'], row['unit'])
+    block_sizes = {row['devices_type_id']: register_block_size(row['register_list'])
+                   for row in conn.execute("SELECT devices_type_id, register_list FROM iot_devices_types")}
+
+    registry = {}
+    for row in conn.execute("SELECT slaveid, devicename, devices_type_id FROM iotdevices ORDER BY slaveid"):
+        channels = plans.get(row['devices_type_id'], [])
+        plan = tuple(entry for names in channels for entry in names.values())
+        registry[row['slaveid']] = DeviceDecoder(row['slaveid'], row['devicename'], row['devices_type_id'],
+                                                 block_sizes.get(row['devices_type_id'], 0), plan, channels)
+    return registry
+
+def get_device_registry():
+    # Compiled on first use and after the device configuration changed; an unreadable
+    # database leaves the registry empty until the next call
+    try:
+        return cached_config('device_registry', load_device_registry)
+    except sqlite3.Error:
+        return {}
+
+def load_tank_channels(registry):
+    # {tank: (slaveid, channel)} of the tanks whose sensor is configured, the first device
+    # by slave id whose name starts with the tank's prefix and that maps the channel
+    tank_channels = {}
+    for tank, (prefix, channel) in TANK_SENSORS.items():
+        for slaveid, device in registry.items():
+            if (device.devicename.lower().startswith(prefix.lower()) and channel < len(device.channels)
+                    and TANK_LEVEL_PARAMETER in device.channels[channel]):
+                tank_channels[tank] = (slaveid, channel)
+                break
+    return tank_channels
+
+tank_channels_cache = (None, {})   # (registry, load_tank_channels(registry))
+
+def get_tank_channels():
+    # Rebuilt whenever get_device_registry() returns a newly compiled registry
+    global tank_channels_cache
+    registry = get_device_registry()
+    cached = tank_channels_cache
+    if cached[0] is not registry:
+        cached = tank_channels_cache = (registry, load_tank_channels(registry))
+    return cached[1]
+
+def decode_device(device, registers):
+    # One pass over the plan. Returns a {parameter: value} dict per channel, None for
+    # parameters whose registers are missing from the snapshot
+    channels = [{} for _ in device.channels]
+    size = len(registers)
+    partial = None in registers
+    for entry in device.plan:
+        end = entry.address + entry.count
+        if end > size or (partial and None in registers[entry.address:end]):
+            value = None
+        else:
+            value = entry.decode(registers, entry.address, entry.count)
+            if entry.divisor != 1:
+                value = value / entry.divisor
+        channels[entry.channel][entry.name] = value
+    return channels
+
+def encodable(entry, value):
+    # The raw value fits the entry's registers, signed or unsigned
+    raw = value * entry.divisor
+    bits = 16 * entry.count
+    return math.isfinite(raw) and -(1 << (bits - 1)) <= round(raw) < 1 << bits
+
+def encode_value(entry, value):
+    # Register words for an engineering value of a numeric entry, LSB word first
+    raw = round(value * entry.divisor)
+    return [(raw >> (16 * k)) & 0xFFFF for k in range(entry.count)]
+
+def tank_device(tank):
+    # (DeviceDecoder, {parameter: DecoderEntry} of the tank's channel), (None, {}) if unknown
+    slaveid, channel = get_tank_channels().get(tank, (None, 0))
+    device = get_device_registry().get(slaveid)
+    if device is None or channel >= len(device.channels):
+        return None, {}
+    return device, device.channels[channel]
+
+def read_tanks(tanks):
+    # Decoded channel of every tank from one pipelined read, {} for an unconfigured tank.
+    # Every tank maps to None when redis is unreachable
+    devices = {}
+    for tank in tanks:
+        device = tank_device(tank)[0]
+        if device is not None:
+            devices[device.slaveid] = device
+    try:
+        registers = getDeviceRegisters(list(devices.values()))
     except redis.exceptions.RedisError:
-        # other Redis errors (e.g., read-only)
-        return False
-      
+        return {tank: None for tank in tanks}
+    decoded = {slaveid: decode_device(device, registers[slaveid]) for slaveid, device in devices.items()}
+    values = {}
+    tank_channels = get_tank_channels()
+    for tank in tanks:
+        slaveid, channel = tank_channels.get(tank, (None, 0))
+        channels = decoded.get(slaveid, [])
+        values[tank] = channels[channel] if channel < len(channels) else {}
+    return values
+
+def write_command(slaveid, address, value, request_id):
+    # modbus:writequeue entry consumed by the poller
+    return f"{slaveid}:{address}:{int(value)}:{request_id}"
+
 @app.route("/health")
 def health():
     """Optional: health check"""
@@ -120,160 +379,94 @@ def health():
 @app.route("/api/update-parameters", methods=['POST'])
 def updateParameters():
     if request.method == 'POST':
-        if not check_redis_alive():
-            return {"status": "redis-connection-error", "updated": "None"}
-        data = request.get_json()
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({"status": "invalid-request", "updated": "None"}), 400
         tank = data.get("tank")
-        zeroPf=  string_to_intX10(data.get('zeroPf'))        
-        fullPf = string_to_intX10(data.get('fullPf'))
-        levelFullMm = string_to_intX10(data.get('levelFullMm'))       
-        levelHighSet = string_to_intX10(data.get('levelHighSet'))
-        levelLowSet = string_to_intX10(data.get('levelLowSet'))
-        advanced_settings=False
+        device, entries = tank_device(tank)
+        if device is None:
+            return jsonify({"status": "unknown-tank", "updated": "None"}), 400
+        settings = dict(LEVEL_SENSOR_SETTINGS)
         if(data.get('oscRes1')is not None):
-            advanced_settings=True
-        if advanced_settings:    
-            oscRes1 = string_to_int(data.get('oscRes1'))
-            oscRes2 = string_to_int(data.get('oscRes2'))
-            oscKVal = string_to_intX1000(data.get('oscKVal'))
-        if(tank=='overhead1'):
-            slaveid =5       
-            sensorconfig=holding_registers.SENSOR1_CONFIG.value
-            sensordata=holding_registers.SENSOR1_DATA.value          
-        if(tank=='overhead2'):
-            slaveid =5       
-            sensorconfig=holding_registers.SENSOR2_CONFIG.value
-            sensordata=holding_registers.SENSOR2_DATA.value
-        if(tank=='underground'):
-            slaveid =6       
-            sensorconfig=holding_registers.SENSOR1_CONFIG.value
-            sensordata=holding_registers.SENSOR1_DATA.value
-        
-        zeroPf_modbus=string_to_int(getRegisterValue(slaveid,sensorconfig+SENS_PARAM_POS.CAP_LEVEL_ZERO_PF.value))
-        fullPf_modbus=string_to_int(getRegisterValue(slaveid,sensorconfig+SENS_PARAM_POS.CAP_LEVEL_FULL_PF.value))
-        levelFullMm_modbus=string_to_int(getRegisterValue(slaveid,sensorconfig+SENS_PARAM_POS.LEVEL_FULL_MM.value))
-        levelHighSet_modbus=string_to_int(getRegisterValue(slaveid,sensorconfig+SENS_PARAM_POS.LEVEL_HIGH_IN_PERC_SET.value))
-        levelLowSet_modbus=string_to_int(getRegisterValue(slaveid,sensorconfig+SENS_PARAM_POS.LEVEL_LOW_IN_PERC_SET.value))
-        if(zeroPf!=zeroPf_modbus):
-            r.set(f"modbus:write:{slaveid}:{sensorconfig+SENS_PARAM_POS.CAP_LEVEL_ZERO_PF.value}", zeroPf)
-            #r.set(f"modbus:{slaveid}:reg{sensorconfig+SENS_PARAM_POS.CAP_LEVEL_ZERO_PF.value}", zeroPf)
-        if(fullPf!=fullPf_modbus):
-            r.set(f"modbus:write:{slaveid}:{sensorconfig+SENS_PARAM_POS.CAP_LEVEL_FULL_PF.value}", fullPf)
-            #r.set(f"modbus:{slaveid}:reg{sensorconfig+SENS_PARAM_POS.CAP_LEVEL_FULL_PF.value}", fullPf)             
-        if(levelFullMm!=levelFullMm_modbus):
-            r.set(f"modbus:write:{slaveid}:{sensorconfig+SENS_PARAM_POS.LEVEL_FULL_MM.value}", levelFullMm)
-            #r.set(f"modbus:{slaveid}:reg{sensorconfig+SENS_PARAM_POS.LEVEL_FULL_MM.value}", levelFullMm)        
-        if(levelHighSet!=levelHighSet_modbus):
-            r.set(f"modbus:write:{slaveid}:{sensorconfig+SENS_PARAM_POS.LEVEL_HIGH_IN_PERC_SET.value}", levelHighSet)
-            #r.set(f"modbus:{slaveid}:reg{sensorconfig+SENS_PARAM_POS.LEVEL_HIGH_IN_PERC_SET.value}", levelHighSet)
-        if(levelLowSet!=levelLowSet_modbus):
-            r.set(f"modbus:write:{slaveid}:{sensorconfig+SENS_PARAM_POS.LEVEL_LOW_IN_PERC_SET.value}", levelLowSet)
-            #r.set(f"modbus:{slaveid}:reg{sensorconfig+SENS_PARAM_POS.LEVEL_LOW_IN_PERC_SET.value}", levelLowSet)         
-        if advanced_settings:
-            oscRes1_modbus_lsb=string_to_int(getRegisterValue(slaveid,sensorconfig+SENS_PARAM_POS.OSC_RES1_VAL_LSB.value))
-            oscRes1_modbus_msb=string_to_int(getRegisterValue(slaveid,sensorconfig+SENS_PARAM_POS.OSC_RES1_VAL_MSB.value))
-            oscRes2_modbus_lsb=string_to_int(getRegisterValue(slaveid,sensorconfig+SENS_PARAM_POS.OSC_RES2_VAL_LSB.value))
-            oscRes2_modbus_msb=string_to_int(getRegisterValue(slaveid,sensorconfig+SENS_PARAM_POS.OSC_RES2_VAL_MSB.value))
-            oscKVal_modbus=string_to_int(getRegisterValue(slaveid,sensorconfig+SENS_PARAM_POS.OSC_K_VAL.value))        
-            oscRes1_modbus=   oscRes1_modbus_msb<<16 | oscRes1_modbus_lsb
-            oscRes2_modbus=   oscRes2_modbus_msb<<16 | oscRes2_modbus_lsb
-
-            if(oscRes1!=oscRes1_modbus):
-                oscRes1_lsb=oscRes1 & 0xFFFF
-                oscRes1_msb=(oscRes1>>16) & 0xFFFF           
-                r.set(f"modbus:write:{slaveid}:{sensorconfig+SENS_PARAM_POS.OSC_RES1_VAL_LSB.value}", oscRes1_lsb)
-                r.set(f"modbus:write:{slaveid}:{sensorconfig+SENS_PARAM_POS.OSC_RES1_VAL_MSB.value}", oscRes1_msb)
-                #r.set(f"modbus:{slaveid}:reg{sensorconfig+SENS_PARAM_POS.OSC_RES1_VAL_LSB.value}", oscRes1_lsb)
-                #r.set(f"modbus:{slaveid}:reg{sensorconfig+SENS_PARAM_POS.OSC_RES1_VAL_MSB.value}", oscRes1_msb)            
-            if(oscRes2!=oscRes2_modbus):
-                oscRes2_lsb=oscRes2 & 0xFFFF
-                oscRes2_msb=(oscRes2>>16) & 0xFFFF 
-                r.set(f"modbus:write:{slaveid}:{sensorconfig+SENS_PARAM_POS.OSC_RES2_VAL_LSB.value}", oscRes2_lsb)
-                r.set(f"modbus:write:{slaveid}:{sensorconfig+SENS_PARAM_POS.OSC_RES2_VAL_MSB.value}", oscRes2_msb)
-                #r.set(f"modbus:{slaveid}:reg{sensorconfig+SENS_PARAM_POS.OSC_RES2_VAL_LSB.value}", oscRes2_lsb)
-                #r.set(f"modbus:{slaveid}:reg{sensorconfig+SENS_PARAM_POS.OSC_RES2_VAL_MSB.value}", oscRes2_msb)
-            if(oscKVal!=oscKVal_modbus):
-                r.set(f"modbus:write:{slaveid}:{sensorconfig+SENS_PARAM_POS.OSC_K_VAL.value}", oscKVal) 
-                #r.set(f"modbus:{slaveid}:reg{sensorconfig+SENS_PARAM_POS.OSC_K_VAL.value}", oscKVal)            
-            
-        return {"status": "ok", "updated": data['tank']}
-#GET /api/parameters?tank=if(tank=='overhead1'):|overhead2|underground
+            settings.update(LEVEL_SENSOR_ADVANCED_SETTINGS)
+
+        values = {}
+        for field, name in settings.items():
+            entry = entries.get(name)
+            if entry is None:
+                continue
+            value = parse_number(data.get(field))
+            if value is None or not encodable(entry, value):
+                return jsonify({"status": "invalid-value", "field": field, "updated": "None"}), 400
+            values[entry] = value
+
+        writes=[]
+        request_id=uuid.uuid4().hex
+        try:
+            registers = getDeviceRegisters([device])[device.slaveid]
+            for entry, value in values.items():
+                words = encode_value(entry, value)
+                current = [registers[address] if address < len(registers) else None
+                           for address in range(entry.address, entry.address + entry.count)]
+                # a 32 bit value is always written as both words
+                if words != current:
+                    writes.extend(write_command(device.slaveid, entry.address + k, word, request_id)
+                                  for k, word in enumerate(words))
+
+            # one RPUSH so the poller sees the whole set and can coalesce consecutive registers
+            if writes:
+                r.rpush(WRITE_QUEUE, *writes)
+        except redis.exceptions.RedisError:
+            return {"status": "redis-connection-error", "updated": "None"}
+        return {"status": "ok", "updated": data['tank'], "queued": len(writes), "id": request_id}
+#GET /api/parameters?tank=overhead1|overhead2|underground
 @app.route("/api/parameters")
 def parameters():
     tank = request.args.get('tank')
-    if(tank=='overhead1'):
-        slaveid =5       
-        sensorconfig=holding_registers.SENSOR1_CONFIG.value
-        sensordata=holding_registers.SENSOR1_DATA.value
-    if(tank=='overhead2'):
-        slaveid =5       
-        sensorconfig=holding_registers.SENSOR2_CONFIG.value
-        sensordata=holding_registers.SENSOR2_DATA.value
-    if(tank=='underground'):
-        slaveid =6       
-        sensorconfig=holding_registers.SENSOR1_CONFIG.value
-        sensordata=holding_registers.SENSOR1_DATA.value
-     
-    zeroPf=string_to_int_by10(getRegisterValue(slaveid,sensorconfig+SENS_PARAM_POS.CAP_LEVEL_ZERO_PF.value))
-    fullPf=string_to_int_by10(getRegisterValue(slaveid,sensorconfig+SENS_PARAM_POS.CAP_LEVEL_FULL_PF.value))
-    levelFullMm=string_to_int_by10(getRegisterValue(slaveid,sensorconfig+SENS_PARAM_POS.LEVEL_FULL_MM.value)) 
-    oscRes1_lsb=string_to_int(getRegisterValue(slaveid,sensorconfig+SENS_PARAM_POS.OSC_RES1_VAL_LSB.value))
-    oscRes1_msb=string_to_int(getRegisterValue(slaveid,sensorconfig+SENS_PARAM_POS.OSC_RES1_VAL_MSB.value))
-    oscRes2_lsb=string_to_int(getRegisterValue(slaveid,sensorconfig+SENS_PARAM_POS.OSC_RES2_VAL_LSB.value))
-    oscRes2_msb=string_to_int(getRegisterValue(slaveid,sensorconfig+SENS_PARAM_POS.OSC_RES2_VAL_MSB.value))
-    oscKVal=string_to_int_by1000(getRegisterValue(slaveid,sensorconfig+SENS_PARAM_POS.OSC_K_VAL.value)) 
-    levelHighSet=string_to_int_by10(getRegisterValue(slaveid,sensorconfig+SENS_PARAM_POS.LEVEL_HIGH_IN_PERC_SET.value))
-    levelLowSet=string_to_int_by10(getRegisterValue(slaveid,sensorconfig+SENS_PARAM_POS.LEVEL_LOW_IN_PERC_SET.value))    
-    oscRes1=   oscRes1_msb<<16 | oscRes1_lsb
-    oscRes2=   oscRes2_msb<<16 | oscRes2_lsb
-    
-    pfPerCm=round((fullPf-zeroPf)*10/levelFullMm,2) if levelFullMm>0 else 0
-    data = {
-        
-            "zeroPf": zeroPf,    
-            "fullPf": fullPf,   
-            "levelFullMm": levelFullMm,     
-            "levelHighSet": levelHighSet,   
-            "levelLowSet": levelLowSet ,
-            "oscRes1":oscRes1,
-            "oscRes2": oscRes2 , 
-            "oscKVal": oscKVal ,   
-            "pfPerCm": pfPerCm             
-        }
-    return jsonify(data)        
+    if tank_device(tank)[0] is None:
+        return jsonify({"status": "unknown-tank"}), 400
+    values = read_tanks([tank])[tank]
+    if values is None:
+        return jsonify({"status": "redis-connection-error"}), 503
+    data = {field: values.get(name) or 0
+            for field, name in {**LEVEL_SENSOR_SETTINGS, **LEVEL_SENSOR_ADVANCED_SETTINGS}.items()}
+    data["pfPerCm"] = round((data["fullPf"]-data["zeroPf"])*10/data["levelFullMm"],2) if data["levelFullMm"]>0 else 0
+    return jsonify(data)
 
-#GET "/api/get-update-status"
+#GET "/api/get-update-status?id=<id>&count=<queued>"  (both from /api/update-parameters)
+# Waits on the request's ack list and returns as soon as the poller acknowledged every write.
 @app.route("/api/get-update-status")
 def get_update_status():
-    if not check_redis_alive():
-        return {"status": "redis-connection-error", "updated": "None"}
-    write_pattern="modbus:write:*"
-    write_keys = []
-    for key in r.scan_iter(match=write_pattern):
-        write_keys.append(key) # Decode bytes to string  
-    if len(write_keys)==0:
+    request_id = request.args.get('id')
+    write_count = request.args.get('count', default=0, type=int)
+    if not request_id or write_count==0:
         return jsonify({"status":"Nothing to update"})        
-    result_key="modbus:result:*"
-    timeout = 15  # seconds
-    start_time = time.time() 
-    keys  =[]
-    while time.time() - start_time < timeout:
-        for key in r.scan_iter(match=result_key, count=10):
-            keys.append(key)
-            r.delete(key)    
-        if len(keys)>=len(write_keys):  # non-empty value found
-            break
-        time.sleep(0.1)  # small delay to avoid busy loop
-    if len(keys)>=len(write_keys):
-        return jsonify({"status": f"{len(keys)} parameter/s updated" })
+    ack_key = WRITE_ACK_KEY.format(request_id)
+    deadline = time.monotonic() + WRITE_ACK_TIMEOUT
+    try:
+        # polled rather than BLPOPed: a blocking wait would keep one of the pool's
+        # connections for up to WRITE_ACK_TIMEOUT while every thread shares the pool
+        while True:
+            acks = r.lrange(ack_key, 0, -1)
+            remaining = deadline - time.monotonic()
+            if len(acks) >= write_count or remaining <= 0:
+                break
+            time.sleep(min(WRITE_ACK_POLL_INTERVAL, remaining))
+        r.delete(ack_key)
+    except redis.exceptions.RedisError:
+        return {"status": "redis-connection-error", "updated": "None"}
+    updated = sum(1 for ack in acks if not ack.endswith(":ERROR"))
+    if updated>=write_count:
+        return jsonify({"status": f"{updated} parameter/s updated" })
     else:
         return jsonify({"status":"Failed"})        
 
-def level_sensor_sanity_check(slaveid,sensordata):
-    if check_redis_alive():        
-        sensor_check=getRegisterValue(slaveid,sensordata+SENS_DATA_POS.CAP_PF.value)
+def level_sensor_sanity_check(values):
+    # values is None when the register read could not reach redis
+    if values is not None:
+        sensor_check=values.get('CAP_PF')
         if sensor_check is not None :
-            if string_to_int(sensor_check)>0:
+            if sensor_check>0:
                 return "OK"
             else:
                 return "Sensor head is not connected"
@@ -282,45 +475,82 @@ def level_sensor_sanity_check(slaveid,sensordata):
     else:
         return "REDIS connection error."
 
-#GET /api/readings?tank=if(tank=='overhead1'):|overhead2|underground
+# Alarms
+# The poller evaluates the level set points (with hysteresis) and the rate of change of every
+# tank after each read. The current state of a channel is kept in ALARM_STATE_KEY, every
+# transition is PUBLISHed on ALARMS_CHANNEL and pushed to ALARM_LOG_KEY, newest first.
+ALARMS_CHANNEL = "modbus:alarms"
+ALARM_STATE_KEY = "modbus:alarm_state"    # "slaveid:channel" -> state JSON
+ALARM_LOG_KEY = "modbus:alarm_log"
+ALARM_LOG_DEFAULT = 50                    # transitions returned by /api/alarms
+
+def read_alarm_states():
+    # {tank: state} from the poller's alarm engine, {} when redis is unreachable
+    try:
+        states = r.hgetall(ALARM_STATE_KEY)
+    except redis.exceptions.RedisError:
+        return {}
+    alarms = {}
+    for tank, (slaveid, channel) in get_tank_channels().items():
+        state = states.get(f"{slaveid}:{channel}")
+        if state is not None:
+            alarms[tank] = json.loads(state)
+    return alarms
+
+#GET /api/alarms?limit=50  (current state per tank and the latest transitions)
+@app.route("/api/alarms")
+def alarms():
+    limit = request.args.get('limit', ALARM_LOG_DEFAULT, type=int)
+    limit = max(1, min(limit, 1000))
+    try:
+        with r.pipeline(transaction=False) as pipe:
+            pipe.hgetall(ALARM_STATE_KEY)
+            pipe.lrange(ALARM_LOG_KEY, 0, limit - 1)
+            states, log = pipe.execute()
+    except redis.exceptions.RedisError:
+        return jsonify({"status": "redis-connection-error"}), 503
+    return jsonify({
+        "states": {field: json.loads(state) for field, state in states.items()},
+        "log": [json.loads(entry) for entry in log],
+    })
+
+#GET /api/readings?tank=overhead1|overhead2|underground
 @app.route("/api/readings")
 def readings():
     tank = request.args.get('tank')
-    if(tank=='overhead1'):
-        slaveid =5       
-        sensorconfig=holding_registers.SENSOR1_CONFIG.value
-        sensordata=holding_registers.SENSOR1_DATA.value
-    if(tank=='overhead2'):
-        slaveid =5       
-        sensorconfig=holding_registers.SENSOR2_CONFIG.value
-        sensordata=holding_registers.SENSOR2_DATA.value
-    if(tank=='underground'):
-        slaveid =6       
-        sensorconfig=holding_registers.SENSOR1_CONFIG.value
-        sensordata=holding_registers.SENSOR1_DATA.value
-    #CAP_PF will return None if no modbus device available and return "0" if modbus available but sensor not connected, 
-    sensorStatus=level_sensor_sanity_check(slaveid,sensordata)
-
-    if sensorStatus=="OK": 
-        #sensorStatus="OK" if sensor_check>0 else ("No MODBUS device found" if sensor_check is None else "Sensor head not connected")
-        level_full=string_to_int_by10(getRegisterValue(slaveid,sensorconfig+SENS_PARAM_POS.LEVEL_FULL_MM.value)) 
-        liquidLevel=string_to_int_by10_negated(getRegisterValue(slaveid,sensordata+SENS_DATA_POS.LEVEL_IN_MM.value))
-        sensorCap=string_to_int_by10(getRegisterValue(slaveid,sensordata+SENS_DATA_POS.CAP_PF.value))
-        frequency_lsb=string_to_int(getRegisterValue(slaveid,sensordata+SENS_DATA_POS.FREQUENCY_LSB.value))
-        frequency_msb=string_to_int(getRegisterValue(slaveid,sensordata+SENS_DATA_POS.FREQUENCY_MSB.value))
-        temp=string_to_int(getRegisterValue(slaveid,sensordata+SENS_DATA_POS.LIQUID_TEMP.value))
+    if tank not in TANK_SENSORS:
+        return jsonify({"status": "unknown-tank"}), 400
+    return jsonify(cached_response(('readings', tank),
+                                   lambda: tank_readings(read_tanks([tank])[tank], read_alarm_states().get(tank))))
+
+def tank_readings(values, alarm_state=None):
+    # values: decoded channel of one tank from read_tanks()
+    # alarm_state: the tank's state from read_alarm_states(), the firmware alarm registers
+    # are used when the alarm engine has not evaluated the tank yet
+    #CAP_PF will be None if no modbus device available and 0 if modbus available but sensor not connected,
+    sensorStatus=level_sensor_sanity_check(values)
+
+    if sensorStatus=="OK":
+        level_full=values.get('LEVEL_FULL_MM') or 0
+        liquidLevel=round((values.get('LEVEL_IN_MM') or 0)-LEVEL_SENSOR_OFFSET,1)
+        sensorCap=values['CAP_PF']
+        freq=values.get('FREQUENCY') or 0
+        temp=values.get('LIQUID_TEMP') or 0
         if(temp!= TEMPERATURE_ERROR_VALUE):
-            temp=round((temp/10)-10,1)
+            temp=round(temp-LEVEL_SENSOR_OFFSET,1)
         else:
             temp=None
-        alarmLow=string_to_int_by10(getRegisterValue(slaveid,sensordata+SENS_DATA_POS.ALARM_LEVEL_LOW.value))
-        alarmHigh=string_to_int_by10(getRegisterValue(slaveid,sensordata+SENS_DATA_POS.ALARM_LEVEL_HIGH.value))
-        levelHighSet=string_to_int_by10(getRegisterValue(slaveid,sensorconfig+SENS_PARAM_POS.LEVEL_HIGH_IN_PERC_SET.value))
-        levelLowSet=string_to_int_by10(getRegisterValue(slaveid,sensorconfig+SENS_PARAM_POS.LEVEL_LOW_IN_PERC_SET.value))
-        freq=frequency_msb<<16 | frequency_lsb
+        alarmLow=values.get('ALARM_LEVEL_LOW')
+        alarmHigh=values.get('ALARM_LEVEL_HIGH')
+        levelHighSet=values.get('LEVEL_HIGH_IN_PERC_SET') or 0
+        levelLowSet=values.get('LEVEL_LOW_IN_PERC_SET') or 0
         liquidLevelPct=round(liquidLevel*100/level_full,1) if level_full>0 else 0
-        alarm="LOW" if (alarmLow==1) else "NORMAL"
-        alarm="HIGH" if (alarmHigh==1) else "NORMAL"
+        if alarm_state is not None:
+            alarm=alarm_state.get('alarm')
+            rateAlarm=alarm_state.get('rate')
+        else:
+            alarm="HIGH" if (alarmHigh==1) else "LOW" if (alarmLow==1) else "NORMAL"
+            rateAlarm=None
         data = {
                 "sensorStatus": sensorStatus  ,  
                 "liquidTemperature": temp if freq>0 else None,    
@@ -328,85 +558,33 @@ def readings():
                 "frequency": freq if freq>0 else None,     # °C
                 "liquidLevel": liquidLevel if freq>0 else None,   
                 "alarm": alarm if freq>0 else None,
+                "rateAlarm": rateAlarm if freq>0 else None,
                 "liquidLevelPct":liquidLevelPct if freq>0 else None,  
                 "liquidLevelHighSet":levelHighSet,
                 "liquidLevelLowSet":levelLowSet
             }
     else:
         data = { "sensorStatus": sensorStatus }    
-    return jsonify(data)
+    return data
     
 @app.route("/api/iot_data")
 def iot_data():
+    return jsonify(cached_response(('iot_data',), build_iot_data))
 
-    # Option B: Full JSON object
-    raw = r.get("iot:data")
-    capacitance1= (r.get("modbus:5:reg23"))
-    capacitance1= int(capacitance1) if is_number(capacitance1) else 0
-        
-    level_mm1=(r.get("modbus:5:reg22"))
-    level_mm1= int(level_mm1) if is_number(level_mm1) else 0
-    level_mm1=(level_mm1-10)/10
-    
-    level_full_mm1=(r.get("modbus:5:reg4"))
-    level_full_mm1= int(level_full_mm1) if is_number(level_full_mm1) else 0
-    level_full_mm1=(level_full_mm1)/10
-    
-    level_percentage1=round(level_mm1*100/level_full_mm1,1) if level_full_mm1>0 else 0
-    
-    temperature1=(r.get("modbus:5:reg26"))
-    temperature1= round((int(temperature1)/10)-10,1) if is_number(temperature1) else 0
-    
-    capacitance2= (r.get("modbus:5:reg30"))
-    capacitance2= int(capacitance2) if is_number(capacitance2) else 0 
-    
-    level_mm2=((r.get("modbus:5:reg29")))
-    level_mm2= int(level_mm2) if is_number(level_mm2) else 0 
-    level_mm2=(level_mm2-10)/10
-    
-    level_full_mm2=(r.get("modbus:5:reg14"))
-    level_full_mm2= int(level_full_mm2) if is_number(level_full_mm2) else 0 
-    level_full_mm2=(level_full_mm2)/10
-    
-    level_percentage2=round(level_mm2*100/level_full_mm2,1) if level_full_mm2>0 else 0
-    
-    temperature2=(r.get("modbus:5:reg33"))  
-    temperature2=round((int(temperature2)/10)-10,1) if is_number(temperature2) else 0     
-    temperature1=temperature2
-    
-    #Under Ground Tank
-    capacitance3= (r.get("modbus:6:reg23"))
-    capacitance3= int(capacitance1) if is_number(capacitance1) else 0
-        
-    level_mm3=(r.get("modbus:6:reg22"))
-    level_mm3= int(level_mm3) if is_number(level_mm3) else 0
-    level_mm3=(level_mm3-10)/10
-    
-    level_full_mm3=(r.get("modbus:6:reg4"))
-    level_full_mm3= int(level_full_mm3) if is_number(level_full_mm3) else 0
-    level_full_mm3=(level_full_mm3)/10
-    
-    level_percentage3=round(level_mm3*100/level_full_mm3,1) if level_full_mm3>0 else 0
-    
-    temperature3=(r.get("modbus:6:reg26"))
-    temperature3= round((int(temperature3)/10)-10,1) if is_number(temperature3) else 0
-    
+def build_iot_data(tank_data=None):
+    # tank_data: {tank: tank_readings()}, read here when not given
+    if tank_data is None:
+        alarm_states = read_alarm_states()
+        tank_data = {tank: tank_readings(values, alarm_states.get(tank)) for tank, values in read_tanks(TANKS).items()}
     data = {
-        "overhead1": {
-            "capacitance": capacitance1,    
-            "level": level_percentage1,   # percentage
-            "temp": temperature1     # °C
-        },
-        "overhead2": {
-            "capacitance": capacitance2,    
-            "level": level_percentage2,   # percentage
-            "temp": temperature2     # °C
-        },
-        "underground": {
-            "capacitance": capacitance3,  
-            "level": level_mm3,  # percentage
-            "temp": temperature3
-        },
+        tank: {
+            "capacitance": round((readings.get("sensorCap") or 0) * 10),   # raw CAP_PF register, 0.1 pF
+            "level": readings.get("liquidLevelPct") or 0,   # percentage
+            "temp": readings.get("liquidTemperature") or 0     # °C
+        }
+        for tank, readings in tank_data.items()
+    }
+    data.update({
         "humidity": random.randint(40, 70),      # %
         "ambient_temp": random.randint(20, 35),  # °C
         "rain": random.choice([0, 1]),           # 0=dry, 1=rain
@@ -420,8 +598,369 @@ def iot_data():
             "room3": random.randint(22, 28),
             "room4": random.randint(22, 28)
         }
+    })
+    return data
+
+# Device snapshots
+# Decoded values of any set of devices from one pipelined read. Only the registers of the
+# selected fields are requested; the ETag is a digest of the body, so a client polling an
+# unchanged snapshot gets an empty 304 instead.
+def parse_id_list(text):
+    # "5,6, 7" -> [5, 6, 7]; raises ValueError on anything else
+    return [int(item) for item in text.split(',') if item.strip()]
+
+def read_device_snapshot(slaveids, fields):
+    # {slaveid: [{parameter: value} per channel]} of the given devices, restricted to fields
+    # unless fields is empty. Raises RedisError
+    registry = get_device_registry()
+    devices = {}
+    for slaveid in slaveids:
+        device = registry.get(slaveid)
+        if device is None:
+            continue
+        if fields:
+            device = device._replace(plan=tuple(entry for entry in device.plan if entry.name in fields))
+        devices[slaveid] = device
+    addresses = {slaveid: sorted({entry.address + k for entry in device.plan for k in range(entry.count)})
+                 for slaveid, device in devices.items()}
+    snapshots = getRegisterSnapshots(addresses)
+    decoded = {}
+    for slaveid, device in devices.items():
+        registers = [None] * max(device.register_count, max(addresses[slaveid], default=-1) + 1)
+        for address, value in snapshots[slaveid].items():
+            registers[address] = value
+        decoded[slaveid] = {
+            "devicename": device.devicename,
+            "devicesTypeId": device.devices_type_id,
+            "channels": decode_device(device, registers),
+        }
+    return decoded
+
+#GET /api/devices/snapshot?slaves=5,6&fields=LEVEL_IN_MM,CAP_PF  (every device / field when omitted)
+@app.route("/api/devices/snapshot")
+def device_snapshot():
+    try:
+        slaveids = parse_id_list(request.args.get('slaves', ''))
+    except ValueError:
+        return jsonify({"status": "invalid slaves"}), 400
+    # only known devices and mapped parameter names make it into the cache key
+    registry = get_device_registry()
+    slaveids = [slaveid for slaveid in slaveids if slaveid in registry] if slaveids else list(registry)
+    requested = {field.strip() for field in request.args.get('fields', '').split(',') if field.strip()}
+    fields = frozenset(entry.name for slaveid in slaveids for entry in registry[slaveid].plan
+                       if entry.name in requested)
+    if requested and not fields:
+        return jsonify({"status": "unknown fields"}), 400
+    key = ('snapshot', tuple(sorted(set(slaveids))), tuple(sorted(fields)))
+
+    def compute():
+        devices = read_device_snapshot(key[1], fields)
+        body = json.dumps({"devices": devices}, sort_keys=True).encode()
+        return body, hashlib.sha1(body).hexdigest()
+
+    try:
+        body, etag = cached_response(key, compute)
+    except redis.exceptions.RedisError:
+        return jsonify({"status": "redis-connection-error"}), 503
+    response = Response(body, mimetype="application/json")
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
+
+# Live telemetry stream
+# The poller PUBLISHes the slaveid on UPDATES_CHANNEL after every device read, and when a
+# device stops answering (its keys are dropped then), and each alarm transition on
+# ALARMS_CHANNEL. One listener thread per worker holds the only subscription, renders the
+# dashboard payloads once and fans the frames out to every connected /api/stream client.
+# Without updates for STREAM_KEEPALIVE the frames are rendered again, so tanks whose keys
+# expired (a dead poller) or an unreachable redis show up as offline instead of frozen.
+UPDATES_CHANNEL = "modbus:updates"
+STREAM_KEEPALIVE = 15          # seconds between keep-alive comments to idle clients
+STREAM_COALESCE_DELAY = 0.2    # wait for the rest of the poll cycle before rendering
+STREAM_QUEUE_SIZE = 16         # frames buffered per client before a slow client drops frames
+
+stream_subscribers = set()
+stream_frames = {}             # event name -> last frame sent, replayed to new clients
+stream_lock = threading.Lock()
+stream_thread = None
+
+def sse_frame(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def broadcast_frame(frame):
+    # caller holds stream_lock
+    for subscriber in stream_subscribers:
+        try:
+            subscriber.put_nowait(frame)
+        except queue.Full:
+            pass
+
+def publish_alarm_frame(transition):
+    # transitions are events, not state: forwarded as they arrive and never replayed
+    with stream_lock:
+        broadcast_frame(sse_frame("alarm", json.loads(transition)))
+
+def publish_stream_frames():
+    with stream_lock:
+        if not stream_subscribers:
+            return
+    alarm_states = read_alarm_states()
+    tank_data = {tank: tank_readings(values, alarm_states.get(tank)) for tank, values in read_tanks(TANKS).items()}
+    # the stream just read every tank after an update, /api/readings can serve these
+    for tank, readings in tank_data.items():
+        store_response(('readings', tank), readings)
+    frames = {
+        "iot_data": sse_frame("iot_data", build_iot_data(tank_data)),
+        "readings": sse_frame("readings", tank_data),
     }
-    return jsonify(data)
+    with stream_lock:
+        for event, frame in frames.items():
+            if stream_frames.get(event) == frame:
+                continue
+            stream_frames[event] = frame
+            broadcast_frame(frame)
+
+def stream_listener():
+    while True:
+        try:
+            pubsub = r.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(UPDATES_CHANNEL, ALARMS_CHANNEL)
+            while True:
+                message = pubsub.get_message(timeout=STREAM_KEEPALIVE)
+                if message is None:
+                    publish_stream_frames()
+                    continue
+                if message['channel'] == ALARMS_CHANNEL:
+                    publish_alarm_frame(message['data'])
+                    continue
+                time.sleep(STREAM_COALESCE_DELAY)
+                while (message := pubsub.get_message()) is not None:
+                    if message['channel'] == ALARMS_CHANNEL:
+                        publish_alarm_frame(message['data'])
+                publish_stream_frames()
+        except redis.exceptions.RedisError:
+            publish_stream_frames()
+            time.sleep(STREAM_KEEPALIVE)
+
+def start_stream_listener():
+    global stream_thread
+    with stream_lock:
+        if stream_thread is None or not stream_thread.is_alive():
+            stream_thread = threading.Thread(target=stream_listener, daemon=True)
+            stream_thread.start()
+
+#GET /api/stream  (text/event-stream, events: iot_data, readings, alarm)
+@app.route("/api/stream")
+def stream():
+    start_stream_listener()
+    subscriber = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+    with stream_lock:
+        stream_subscribers.add(subscriber)
+        backlog = list(stream_frames.values())
+
+    def events():
+        try:
+            yield "retry: 5000\n\n"
+            for frame in backlog:
+                yield frame
+            while True:
+                try:
+                    yield subscriber.get(timeout=STREAM_KEEPALIVE)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+        finally:
+            with stream_lock:
+                stream_subscribers.discard(subscriber)
+
+    return Response(events(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# Metrics (Prometheus text format)
+# Request latency is measured per route here; the poller keeps cumulative counters in the
+# modbus:stats:bus:{n} and modbus:stats:slave:{slaveid} hashes, converted on every scrape.
+# Each web worker adds its request counts to WEB_STATS_KEY the same way (at most every
+# METRICS_FLUSH_INTERVAL), so whichever worker serves a scrape reports the totals of all.
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)   # seconds
+METRICS_FLUSH_INTERVAL = 1.0    # seconds
+WEB_STATS_KEY = "modbus:stats:web"   # "method|status|count|sum|le_<bound>|route" -> cumulative value
+POLLER_MAX_BUSES = 8            # MAX_BUSES of the poller
+POLLER_GAUGES = {'devices', 'writes_queued', 'backoff_failures'}   # every other plain field is a counter
+
+route_metrics = {}              # (route, method, status) -> [count, sum, [cumulative bucket counts]] not yet flushed
+route_metrics_lock = threading.Lock()
+route_metrics_flushed = 0.0     # monotonic time of the last flush
+
+def web_stats_field(method, status, suffix, route):
+    return f"{method}|{status}|{suffix}|{route}"
+
+def merge_route_metric(metrics, key, count, total, buckets):
+    # caller holds route_metrics_lock
+    metric = metrics.setdefault(key, [0, 0.0, [0] * len(METRICS_LATENCY_BUCKETS)])
+    metric[0] += count
+    metric[1] += total
+    for i, value in enumerate(buckets):
+        metric[2][i] += value
+
+def flush_route_metrics():
+    # Add the worker's pending counts to WEB_STATS_KEY; kept for the next flush if redis is down
+    global route_metrics, route_metrics_flushed
+    with route_metrics_lock:
+        pending, route_metrics = route_metrics, {}
+        route_metrics_flushed = time.monotonic()
+    if not pending:
+        return
+    try:
+        pipe = r.pipeline()
+        for (route, method, status), (count, total, buckets) in pending.items():
+            pipe.hincrby(WEB_STATS_KEY, web_stats_field(method, status, "count", route), count)
+            pipe.hincrbyfloat(WEB_STATS_KEY, web_stats_field(method, status, "sum", route), total)
+            for bound, value in zip(METRICS_LATENCY_BUCKETS, buckets):
+                if value:
+                    pipe.hincrby(WEB_STATS_KEY, web_stats_field(method, status, f"le_{bound}", route), value)
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        with route_metrics_lock:
+            for key, (count, total, buckets) in pending.items():
+                merge_route_metric(route_metrics, key, count, total, buckets)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_latency(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        elapsed = time.perf_counter() - started
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        with route_metrics_lock:
+            merge_route_metric(route_metrics, (route, request.method, response.status_code), 1, elapsed,
+                               [1 if elapsed <= bound else 0 for bound in METRICS_LATENCY_BUCKETS])
+        if time.monotonic() - route_metrics_flushed >= METRICS_FLUSH_INTERVAL:
+            flush_route_metrics()
+    return response
+
+def add_metric(families, name, kind, labels, value):
+    # families: {metric name: (type, [sample lines])}, one block per name in the output
+    samples = families.setdefault(name, (kind, []))[1]
+    samples.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+
+def add_histogram(families, name, labels, count, total, buckets):
+    # buckets: [(upper bound, cumulative count)]
+    sep = "," if labels else ""
+    samples = families.setdefault(name, ("histogram", []))[1]
+    for bound, value in buckets:
+        samples.append(f'{name}_bucket{{{labels}{sep}le="{bound}"}} {value}')
+    samples.append(f'{name}_bucket{{{labels}{sep}le="+Inf"}} {count}')
+    samples.append(f"{name}_sum{{{labels}}} {total}")
+    samples.append(f"{name}_count{{{labels}}} {count}")
+
+def add_poller_stats(families, prefix, labels, fields):
+    # <name>_count/_sum/_le_<ms> fields form a histogram, every other field is one sample
+    histograms = {}
+    for field, value in fields.items():
+        name, sep, bound = field.rpartition('_le_')
+        if sep and bound.isdigit():
+            histograms.setdefault(name, []).append((int(bound), int(value)))
+    for name, buckets in histograms.items():
+        add_histogram(families, f"{prefix}_{name}", labels, int(fields.get(f"{name}_count", 0)),
+                      int(fields.get(f"{name}_sum", 0)), sorted(buckets))
+    for field, value in fields.items():
+        if field in ('bus',) or field.rpartition('_')[0] in histograms or '_le_' in field:
+            continue
+        if field in POLLER_GAUGES:
+            add_metric(families, f"{prefix}_{field}", "gauge", labels, value)
+        else:
+            add_metric(families, f"{prefix}_{field}_total", "counter", labels, value)
+
+#GET /metrics
+@app.route("/metrics")
+def metrics():
+    families = {}
+    flush_route_metrics()
+    slaveids = sorted(get_device_registry())
+    try:
+        pipe = r.pipeline(transaction=False)
+        pipe.hgetall(WEB_STATS_KEY)
+        pipe.llen(WRITE_QUEUE)
+        for bus in range(POLLER_MAX_BUSES):
+            pipe.hgetall(f"modbus:stats:bus:{bus}")
+        for slaveid in slaveids:
+            pipe.hgetall(f"modbus:stats:slave:{slaveid}")
+        web_stats, *replies = pipe.execute()
+        routes = {}
+        for field, value in web_stats.items():
+            method, status, suffix, route = field.split('|', 3)
+            routes.setdefault((route, method, status), {})[suffix] = value
+        for (route, method, status), fields in sorted(routes.items()):
+            add_histogram(families, "http_request_duration_seconds", f'route="{route}",method="{method}",status="{status}"',
+                          int(fields.get("count", 0)), float(fields.get("sum", 0)),
+                          [(bound, int(fields.get(f"le_{bound}", 0))) for bound in METRICS_LATENCY_BUCKETS])
+        add_metric(families, "redis_up", "gauge", "", 1)
+        add_metric(families, "modbus_write_queue_depth", "gauge", "", replies[0])
+        for bus, fields in enumerate(replies[1:1 + POLLER_MAX_BUSES]):
+            if fields:
+                add_poller_stats(families, "modbus_bus", f'bus="{bus}"', fields)
+        for slaveid, fields in zip(slaveids, replies[1 + POLLER_MAX_BUSES:]):
+            if fields:
+                add_poller_stats(families, "modbus_slave", f'slave="{slaveid}",bus="{fields.get("bus", 0)}"', fields)
+    except redis.exceptions.RedisError:
+        add_metric(families, "redis_up", "gauge", "", 0)
+
+    lines = []
+    for name, (kind, samples) in families.items():
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(samples)
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+HISTORY_RESOLUTIONS = {'raw': None, '1m': 60, '1h': 3600}
+
+#GET /api/history?slaveid=5&channel=0&parameter=LEVEL_IN_MM&from=<unix ts>&to=<unix ts>&resolution=raw|1m|1h
+# raw rows come from iotdata, 1m/1h min/max/avg from the poller's iotdata_rollup buckets.
+# Both are kept per sensor channel, numbered as in the device registry
+@app.route("/api/history")
+def history():
+    slaveid = request.args.get('slaveid', type=int)
+    channel = request.args.get('channel', default=0, type=int)
+    parameter = request.args.get('parameter')
+    resolution = request.args.get('resolution', 'raw')
+    end = request.args.get('to', default=int(time.time()), type=int)
+    start = request.args.get('from', default=end - 86400, type=int)
+    if slaveid is None or resolution not in HISTORY_RESOLUTIONS:
+        return jsonify({"error": "slaveid and resolution=raw|1m|1h required"}), 400
+
+    points = []
+    conn = get_db_connection()
+    try:
+        if resolution == 'raw':
+            rows = conn.execute("""
+                SELECT CAST(strftime('%s', ts) AS INTEGER) AS ts, iotdata FROM iotdata
+                WHERE slaveid = ? AND channel = ? AND ts BETWEEN datetime(?, 'unixepoch') AND datetime(?, 'unixepoch')
+                ORDER BY ts
+            """, (slaveid, channel, start, end))
+            for row in rows:
+                values = json.loads(row['iotdata'])
+                if parameter is None:
+                    points.append({"ts": row['ts'], "values": {name: item.get('value') for name, item in values.items()}})
+                elif parameter in values:
+                    points.append({"ts": row['ts'], "value": values[parameter].get('value')})
+        else:
+            sql = """
+                SELECT bucket, parameter_name, min_value, max_value, sum_value / samples AS avg_value, samples
+                FROM iotdata_rollup WHERE period = ? AND slaveid = ? AND channel = ? AND bucket BETWEEN ? AND ?
+            """
+            args = [HISTORY_RESOLUTIONS[resolution], slaveid, channel, start - start % HISTORY_RESOLUTIONS[resolution], end]
+            if parameter is not None:
+                sql += " AND parameter_name = ?"
+                args.append(parameter)
+            for row in conn.execute(sql + " ORDER BY parameter_name, bucket", args):
+                points.append({"ts": row['bucket'], "parameter": row['parameter_name'], "min": row['min_value'],
+                               "max": row['max_value'], "avg": row['avg_value'], "samples": row['samples']})
+    except sqlite3.OperationalError as e:
+        return jsonify({"error": f"history not available: {e}"}), 503
+    finally:
+        conn.close()
+    return jsonify({"slaveid": slaveid, "channel": channel, "resolution": resolution, "from": start, "to": end, "points": points})
 
 @app.route('/')
 def index():
@@ -431,38 +970,34 @@ def index():
 def levelconfig():
     return render_template('levelconfig.html')
 
-@app.route('/registers')
-def registers():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # Join iotdevices and sensor_data_register_mapping
-    cursor.execute("""
+def load_register_map(conn):
+    # /registers rows without values and the register addresses to read per slave
+    rows = []
+    addresses = {}
+    for row in conn.execute("""
         SELECT d.slaveid, m.parameter_name, m.register_address
         FROM iotdevices d
         JOIN sensor_data_register_mapping m
         ON d.devices_type_id = m.devices_type_id
-    """)
-
-    rows = cursor.fetchall()
-    data = []
-
-    for row in rows:
+        ORDER BY d.slaveid, m.register_address
+    """):
         slaveid = row['slaveid']
-        param = row['parameter_name']
-        #redis_key = f"modbus:{slaveid}:{param}"
-        redis_key = f"modbus:{slaveid}:reg{row['register_address']}"
-        redis_val = r.get(redis_key)
-        data.append({
+        rows.append({
             'slaveid': slaveid,
-            'parameter': param,
+            'parameter': row['parameter_name'],
             'register': row['register_address'],
-            'redis_key': redis_key,
-            'redis_val': redis_val
+            'redis_key': f"modbus:{slaveid}:reg{row['register_address']}"
         })
+        addresses.setdefault(slaveid, []).append(row['register_address'])
+    return rows, addresses
 
-    conn.close()
+@app.route('/registers')
+def registers():
+    rows, addresses = cached_config('register_map', load_register_map)
+    snapshots = getRegisterSnapshots(addresses)
+    data = [dict(row, redis_val=snapshots[row['slaveid']][row['register']]) for row in rows]
     return render_template('registers.html', data=data)
+
 if __name__ == '__main__':
     app.run()
     
\ No newline at end of file